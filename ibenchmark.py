@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from ihelpers import load_and_preprocess_geodata, load_and_preprocess_incidents, \
+                     prepare_data_for_geoplot, filter_on_slider_value, \
+                     aggregate_data_for_time_series, build_incident_count_cube, \
+                     build_incident_index, feasible_combos
+from idatastore import INCIDENT_FILE, GEO_FILE
+from isynthetic import generate_dataset, parse_size
+
+# the slider values that filter_on_slider_value is timed with
+BENCHMARK_SLIDER_VALUES = {"hour": 12, "day": 3, "week": 20, "month": 6}
+
+def get_version_label():
+    """ Get a label for the version of the code that is benchmarked: the
+        output of `git describe`, or 'unknown' outside a git repository. """
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def time_function(func, repeat=3):
+    """ Time a function.
+
+    params
+    ------
+    func: the function to time, called without arguments.
+    repeat: the number of times to call func.
+
+    return
+    ------
+    tuple of (the list of durations in seconds, the result of the last call).
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return durations, result
+
+def benchmark_pipeline(incident_path, geo_path, repeat=3):
+    """ Time the steps of the data pipeline on one data set.
+
+    params
+    ------
+    incident_path: path to the csv file with incident data.
+    geo_path: path to the geojson file with the polygons (vakken).
+    repeat: the number of times to time every step.
+
+    notes
+    -----
+    Loading is timed without (cold) and with (warm) the on-disk cache.
+    aggregate_data_for_time_series is timed for every entry in
+    feasible_combos for all incident types, both by filtering the frame
+    and through the incident index (see build_incident_index), and
+    without caching of the results.
+
+    return
+    ------
+    list of dicts with keys "step", "params", "min", "median" and "repeat",
+    in the order the steps were run.
+    """
+    results = []
+    def record(step, func, params=None, n=repeat):
+        durations, result = time_function(func, n)
+        results.append(OrderedDict([("step", step), ("params", params or {}),
+                                    ("min", min(durations)),
+                                    ("median", float(np.median(durations))),
+                                    ("repeat", n)]))
+        print("{:<32} {:<48} {:8.4f}s".format(step, json.dumps(params or {}),
+                                              min(durations)))
+        return result
+
+    gdflocations = record("load_and_preprocess_geodata",
+                          lambda: load_and_preprocess_geodata(geo_path, use_cache=False),
+                          {"cache": False})
+    dfincident = record("load_and_preprocess_incidents",
+                        lambda: load_and_preprocess_incidents(incident_path, use_cache=False,
+                                                             geo_path=geo_path),
+                        {"cache": False}, n=1)
+    # the first call writes the cache, the timed calls read it
+    load_and_preprocess_incidents(incident_path, geo_path=geo_path)
+    record("load_and_preprocess_incidents",
+           lambda: load_and_preprocess_incidents(incident_path, geo_path=geo_path),
+           {"cache": True})
+
+    locdata = record("prepare_data_for_geoplot",
+                     lambda: prepare_data_for_geoplot(dfincident, gdflocations))
+    types = dfincident["dim_incident_incident_type"].astype(str).unique()
+    record("build_incident_count_cube",
+           lambda: build_incident_count_cube(dfincident, locdata["location_id"].values, types))
+    index = record("build_incident_index", lambda: build_incident_index(dfincident))
+
+    for time_unit, value in BENCHMARK_SLIDER_VALUES.items():
+        record("filter_on_slider_value",
+               lambda: filter_on_slider_value(dfincident, time_unit, value),
+               {"time_unit": time_unit, "value": value})
+
+    for pattern, combos in feasible_combos.items():
+        for agg in combos["agg"]:
+            for group in combos["group"]:
+                for use_index in [False, True]:
+                    record("aggregate_data_for_time_series",
+                           lambda: aggregate_data_for_time_series(
+                               dfincident, agg, pattern, group, types, None,
+                               index=index if use_index else None),
+                           OrderedDict([("pattern", pattern), ("agg", agg),
+                                        ("group", group), ("index", use_index)]))
+
+    return results
+
+def get_data_set(data_dir, n_rows, seed=0):
+    """ Get the paths of a synthetic data set of n_rows incidents in data_dir,
+        generating it if it does not exist yet (see isynthetic.generate_dataset).
+    """
+    directory = os.path.join(data_dir, "{}_{}".format(n_rows, seed))
+    incident_path = os.path.join(directory, INCIDENT_FILE)
+    geo_path = os.path.join(directory, GEO_FILE)
+    if not (os.path.exists(incident_path) and os.path.exists(geo_path)):
+        print("Generating {} incidents in {}".format(n_rows, directory))
+        generate_dataset(directory, n_rows, seed=seed)
+    return incident_path, geo_path
+
+def run_benchmarks(sizes, data_dir, output, label=None, seed=0, repeat=3):
+    """ Benchmark the pipeline on synthetic data sets of several sizes and
+        append the results to a file.
+
+    params
+    ------
+    sizes: list of the numbers of incidents to benchmark with.
+    data_dir: directory to keep the synthetic data sets in, so that they
+              are generated only once.
+    output: path of the results file, which gets one json object per line.
+    label: the version label to record, defaults to get_version_label().
+    seed: the seed of the synthetic data.
+    repeat: the number of times to time every step.
+
+    return
+    ------
+    list of the records written to output.
+    """
+    label = label or get_version_label()
+    context = OrderedDict([("label", label),
+                           ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                           ("host", platform.node()),
+                           ("python", platform.python_version()),
+                           ("numpy", np.__version__),
+                           ("pandas", pd.__version__),
+                           ("seed", seed)])
+    records = []
+    for n_rows in sizes:
+        incident_path, geo_path = get_data_set(data_dir, n_rows, seed)
+        print("Benchmarking {} with {} incidents".format(label, n_rows))
+        for result in benchmark_pipeline(incident_path, geo_path, repeat=repeat):
+            record = OrderedDict(context)
+            record["n_rows"] = n_rows
+            record.update(result)
+            records.append(record)
+
+    with open(output, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return records
+
+def compare_results(output, label, baseline):
+    """ Print how the timings of one version compare to another.
+
+    params
+    ------
+    output: path of the results file (see run_benchmarks).
+    label: the version to compare.
+    baseline: the version to compare to.
+
+    notes
+    -----
+    Steps are matched on their parameters and the number of incidents. If
+    a version was benchmarked several times, its latest results are used.
+    """
+    latest = {}
+    with open(output) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["label"] in (label, baseline):
+                key = (record["n_rows"], record["step"],
+                       json.dumps(record["params"], sort_keys=True))
+                latest[(record["label"],) + key] = record["min"]
+
+    print("{:>10} {:<32} {:<48} {:>9} {:>9} {:>7}".format(
+        "rows", "step", "params", baseline[:9], label[:9], "ratio"))
+    for key in sorted(k[1:] for k in latest if k[0] == label):
+        if (baseline,) + key in latest:
+            old, new = latest[(baseline,) + key], latest[(label,) + key]
+            print("{:>10} {:<32} {:<48} {:9.4f} {:9.4f} {:7.2f}".format(
+                key[0], key[1], key[2], old, new, new / old if old else np.nan))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the data pipeline "
+                                                 "of the dashboard on synthetic data.")
+    parser.add_argument("--rows", nargs="+", default=["10k", "100k", "1M"],
+                        help="the numbers of incidents to benchmark with, e.g., 10k 50M")
+    parser.add_argument("--data-dir", default="benchmark_data",
+                        help="where to keep the synthetic data sets")
+    parser.add_argument("--output", default="benchmark_results.jsonl",
+                        help="the file to append the results to")
+    parser.add_argument("--label", help="version label, defaults to git describe")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="compare the results to those of another version label")
+    args = parser.parse_args()
+
+    label = args.label or get_version_label()
+    run_benchmarks([parse_size(rows) for rows in args.rows], args.data_dir,
+                   args.output, label=label, seed=args.seed, repeat=args.repeat)
+    if args.compare:
+        compare_results(args.output, label, args.compare)
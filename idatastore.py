@@ -0,0 +1,535 @@
+import os
+import glob
+import time
+import shutil
+import multiprocessing
+from threading import Lock, Thread, Event
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from ihelpers import load_and_preprocess_geodata, load_and_preprocess_incidents, \
+                     prepare_data_for_geoplot, build_incident_count_cube, \
+                     build_map_levels, get_cache_path, export_shared_data, \
+                     attach_shared_data, build_incident_index, PREPROCESSING_VERSION, \
+                     get_incident_file_state, check_incident_file, read_incidents, \
+                     preprocess_incidents, append_incidents, update_incident_count_cube, \
+                     update_incident_index, aggregate_data_for_time_series, \
+                     aggregation_cache_key, lru_cache_put, feasible_combos, \
+                     build_density_grids, update_density_grids, incidents_in_order, \
+                     allocate_incident_buffers, append_to_incident_buffers, \
+                     incidents_from_buffers, AGGREGATION_CACHE
+
+# paths are relative to the working directory of the server (see main.py)
+DATA_DIR = os.environ.get("IDASHBOARD_DATA_DIR", "Data")
+# locations of the data files within DATA_DIR
+INCIDENT_FILE = "incidenten_2008-heden.csv"
+GEO_FILE = os.path.join("geoData", "vakken_dag_ts.geojson")
+INCIDENT_PATH = os.path.join(DATA_DIR, INCIDENT_FILE)
+GEO_PATH = os.path.join(DATA_DIR, GEO_FILE)
+# directory to share the incident data between server processes through, e.g.,
+# /dev/shm/idashboard. If not set, every process loads its own copy.
+SHARED_DIR = os.environ.get("IDASHBOARD_SHARED_DIR")
+# version of what is exported to SHARED_DIR, part of the key of the export
+# together with the preprocessing version: increase it when the exports change.
+SHARED_VERSION = 2
+# seconds after which a lock on the shared data is considered abandoned
+SHARED_LOCK_TIMEOUT = 600
+
+# number of threads that compute updates for the sessions, see get_worker_pool
+WORKER_THREADS = int(os.environ.get("IDASHBOARD_WORKER_THREADS", 4))
+
+# seconds between two checks for incidents appended to the incident file
+# (see refresh_data_store), 0 to disable. Not available with SHARED_DIR.
+INGEST_INTERVAL = float(os.environ.get("IDASHBOARD_INGEST_INTERVAL", 5))
+
+# number of processes that compute the time series of all feasible_combos
+# into the aggregation cache at startup (see warm_up_aggregation_cache),
+# 0 to not warm up the cache
+WARMUP_PROCESSES = int(os.environ.get("IDASHBOARD_WARMUP_PROCESSES", 0))
+
+# the process-wide data store, see get_data_store
+_DATA_STORE = None
+_DATA_STORE_LOCK = Lock()
+# held while refreshing the data store, see refresh_data_store
+_REFRESH_LOCK = Lock()
+# the process-wide worker pool, see get_worker_pool
+_WORKER_POOL = None
+_WORKER_POOL_LOCK = Lock()
+
+def _set_read_only(arrays):
+    """ Mark numpy arrays as read-only, so that sessions cannot
+        accidentally modify the shared data. """
+    for array in arrays:
+        array.flags.writeable = False
+
+def _load_incident_data(incident_path, geo_path, gdflocations, state=None):
+    """ Load the incidents (as of the given file state, see 
+        ihelpers.get_incident_file_state) and build the count cube and index.
+        Incidents without a vak id are assigned to the vak (in geo_path)
+        that contains their location.
+
+    return
+    ------
+    tuple of (dfincident, incident_cube, incident_index).
+    """
+    dfincident = load_and_preprocess_incidents(incident_path, state=state, geo_path=geo_path)
+    locdata = prepare_data_for_geoplot(dfincident, gdflocations)
+    incident_types = dfincident["dim_incident_incident_type"].astype(str).unique()
+    incident_cube = build_incident_count_cube(dfincident, locdata["location_id"].values,
+                                              incident_types)
+    incident_index = build_incident_index(dfincident)
+    return dfincident, incident_cube, incident_index
+
+def _cube_to_arrays(cube):
+    """ Flatten a count cube to a dict of arrays for export_shared_data. """
+    arrays = {"cube_" + key: cube[key] for key in ["counts", "totals", "locations"]}
+    arrays["cube_types"] = np.asarray(cube["types"], dtype=str)
+    for time_unit, marginal in cube["marginals"].items():
+        arrays["cube_marginals_" + time_unit] = marginal
+    return arrays
+
+def _arrays_to_cube(arrays):
+    """ Inverse of _cube_to_arrays. """
+    cube = {key: arrays["cube_" + key] for key in ["counts", "totals", "locations"]}
+    cube["types"] = np.array(arrays["cube_types"].tolist(), dtype=object)
+    cube["marginals"] = {time_unit: arrays["cube_marginals_" + time_unit]
+                         for time_unit in ["hour", "day", "month"]}
+    return cube
+
+def _index_to_arrays(index):
+    """ Flatten an incident index to a dict of arrays for export_shared_data. """
+    arrays = {"index_n_rows": np.array([index["n_rows"]])}
+    for key in ["type", "location"]:
+        for part in ["rows", "offsets"]:
+            arrays["index_{}_{}".format(key, part)] = index[key][part]
+    arrays["index_type_values"] = np.asarray(index["type"]["values"], dtype=str)
+    arrays["index_location_values"] = index["location"]["values"]
+    return arrays
+
+def _arrays_to_index(arrays):
+    """ Inverse of _index_to_arrays. """
+    index = {"n_rows": int(arrays["index_n_rows"][0])}
+    for key in ["type", "location"]:
+        index[key] = {part: arrays["index_{}_{}".format(key, part)]
+                      for part in ["rows", "offsets", "values"]}
+    index["type"]["values"] = np.array(index["type"]["values"].tolist(), dtype=object)
+    return index
+
+def _keep_lock_alive(lock_path, stop):
+    """ Touch a lock file until stop is set, so that processes waiting
+        for it do not consider it abandoned (see SHARED_LOCK_TIMEOUT). """
+    while not stop.wait(SHARED_LOCK_TIMEOUT / 10):
+        try:
+            os.utime(lock_path, None)
+        except OSError:
+            pass
+
+def _release_lock(lock, lock_path):
+    """ Close and remove a lock file, unless another process replaced it. """
+    try:
+        if os.path.samestat(os.fstat(lock), os.stat(lock_path)):
+            os.remove(lock_path)
+    except OSError:
+        pass
+    finally:
+        os.close(lock)
+
+def _load_shared_incident_data(incident_path, geo_path, gdflocations, shared_dir):
+    """ Attach to the incident data shared by all server processes,
+        exporting it first if no process has done so yet.
+
+    params
+    ------
+    incident_path: path to the csv file with incident data.
+    geo_path: path to the geojson file with the polygons.
+    gdflocations: GeoDataFrame of polygons.
+    shared_dir: the directory to share the data through.
+
+    notes
+    -----
+    The data is exported to a subdirectory named after the cache key of
+    the incident file (see ihelpers.get_cache_path). One process exports
+    it while holding a lock file, the others wait for it to finish. The
+    lock file is touched during the export, so that it is only taken over
+    when the exporting process died. Exports of older versions of the 
+    file are removed.
+
+    return
+    ------
+    tuple of (dfincident, incident_cube, incident_index), backed by 
+    read-only memory maps.
+    """
+    version = "{}.{}".format(PREPROCESSING_VERSION, SHARED_VERSION)
+    directory = get_cache_path(incident_path, "shared", version, cache_dir=shared_dir,
+                               dependencies=[geo_path])
+    lock_path = directory + ".lock"
+    if not os.path.isdir(shared_dir):
+        os.makedirs(shared_dir)
+
+    while not os.path.isdir(directory):
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            # another process is exporting, wait for it unless it died
+            try:
+                if time.time() - os.path.getmtime(lock_path) > SHARED_LOCK_TIMEOUT:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            time.sleep(0.5)
+            continue
+
+        stop = Event()
+        Thread(target=_keep_lock_alive, args=(lock_path, stop), daemon=True).start()
+        try:
+            if not os.path.isdir(directory):
+                dfincident, incident_cube, incident_index = \
+                    _load_incident_data(incident_path, geo_path, gdflocations)
+                arrays = _cube_to_arrays(incident_cube)
+                arrays.update(_index_to_arrays(incident_index))
+                export_shared_data(directory, dfincident, arrays)
+                name = os.path.basename(directory).rsplit(".", 2)[0]
+                for stale in glob.glob(os.path.join(shared_dir, name + ".*.shared")):
+                    if stale != directory:
+                        shutil.rmtree(stale, ignore_errors=True)
+        finally:
+            stop.set()
+            _release_lock(lock, lock_path)
+
+    dfincident, arrays = attach_shared_data(directory)
+    return dfincident, _arrays_to_cube(arrays), _arrays_to_index(arrays)
+
+def _derived_arrays(incident_cube, incident_index):
+    """ Get the arrays of the count cube and index. """
+    return [incident_cube["counts"], incident_cube["totals"]] + \
+           list(incident_cube["marginals"].values()) + \
+           [incident_index[key][part] for key in ["type", "location"]
+            for part in ["rows", "offsets"]]
+
+def load_data_store(incident_path=INCIDENT_PATH, geo_path=GEO_PATH,
+                    shared_dir=SHARED_DIR):
+    """ Load and preprocess all data that the dashboard needs.
+
+    params
+    ------
+    incident_path: path to the csv file with incident data.
+    geo_path: path to the geojson file with the polygons (vakken).
+    shared_dir: directory to share the incident data, count cube and
+                index between processes through (see 
+                _load_shared_incident_data), or None to load them into
+                this process only.
+
+    return
+    ------
+    dict with keys:
+        "version": number of the version of the data, which increases 
+                   whenever the data store is refreshed,
+        "incident_path", "geo_path", "shared": the arguments it was loaded with,
+        "incident_state": the state of the incident file that the data
+                          reflects (see ihelpers.get_incident_file_state),
+        "gdflocations": GeoDataFrame of polygons
+                        (see load_and_preprocess_geodata),
+        "dfincident": DataFrame of incidents, sorted by timestamp
+                      (see load_and_preprocess_incidents),
+        "incident_buffers": the arrays with spare room that dfincident is
+                            a view of once incidents have been ingested
+                            (see _ingest_incidents), None until then,
+        "incident_times": the timestamps of the incidents, to find the
+                          rows of a range of time with (see 
+                          ihelpers.get_time_range_rows),
+        "locdata": GeoDataFrame of the polygons on the map with the total
+                   number of incidents (see prepare_data_for_geoplot),
+        "incident_types": array of all incident types,
+        "incident_cube": count cube (see build_incident_count_cube),
+        "incident_index": index of the incidents per type and location
+                          (see build_incident_index),
+        "map_levels": the polygons in locdata, simplified for several
+                      zoom levels of the map (see build_map_levels),
+        "density_grids": the number of incidents per type in grid cells of
+                         several sizes (see build_density_grids), in the
+                         order of incident_types.
+    """
+    gdflocations = load_and_preprocess_geodata(geo_path)
+    incident_state = get_incident_file_state(incident_path)
+    if shared_dir is None:
+        dfincident, incident_cube, incident_index = \
+            _load_incident_data(incident_path, geo_path, gdflocations, incident_state)
+    else:
+        dfincident, incident_cube, incident_index = \
+            _load_shared_incident_data(incident_path, geo_path, gdflocations, shared_dir)
+    locdata = prepare_data_for_geoplot(dfincident, gdflocations)
+    incident_types = incident_cube["types"]
+    map_levels = build_map_levels(locdata["geometry"])
+    density_grids = build_density_grids(dfincident, incident_types)
+
+    _set_read_only(_derived_arrays(incident_cube, incident_index))
+
+    return {"version": 0,
+            "incident_path": incident_path,
+            "geo_path": geo_path,
+            "shared": shared_dir is not None,
+            "incident_state": incident_state,
+            "gdflocations": gdflocations,
+            "dfincident": dfincident,
+            "incident_buffers": None,
+            "incident_times": dfincident["timestamp"].values,
+            "locdata": locdata,
+            "incident_types": incident_types,
+            "incident_cube": incident_cube,
+            "incident_index": incident_index,
+            "map_levels": map_levels,
+            "density_grids": density_grids}
+
+def get_data_store():
+    """ Get the data store of this process, loading it on first use.
+
+    notes
+    -----
+    Under `bokeh serve`, main.py runs for every new session, but imported
+    modules (like this one) are loaded once per server process. The data
+    is therefore loaded only once and shared by all sessions, which must
+    treat it as read-only and only create their own widgets and sources.
+
+    return
+    ------
+    the dict returned by load_data_store.
+    """
+    global _DATA_STORE
+    with _DATA_STORE_LOCK:
+        if _DATA_STORE is None:
+            _DATA_STORE = load_data_store()
+    return _DATA_STORE
+
+def get_worker_pool():
+    """ Get the thread pool of this process that sessions use to compute
+        updates without blocking their document.
+
+    notes
+    -----
+    The pool is shared by all sessions, so that the number of concurrent
+    computations (and their memory use) is bounded by WORKER_THREADS, 
+    however many sessions there are. Threads, rather than processes, 
+    can work on the data store without copying it.
+
+    return
+    ------
+    a concurrent.futures.ThreadPoolExecutor.
+    """
+    global _WORKER_POOL
+    with _WORKER_POOL_LOCK:
+        if _WORKER_POOL is None:
+            _WORKER_POOL = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+    return _WORKER_POOL
+
+def _ingest_incidents(data_store, incident_state):
+    """ Add the incidents that were appended to the incident file to a
+        copy of the data store.
+
+    params
+    ------
+    data_store: the data store (see load_data_store).
+    incident_state: the current state of the incident file 
+                    (see ihelpers.get_incident_file_state).
+
+    notes
+    -----
+    Only the new rows are parsed and preprocessed. They are written after
+    the other incidents in arrays with spare room, which are allocated on
+    the first ingest (see ihelpers.allocate_incident_buffers), so that the
+    incidents are not copied. The count cube is small, so it is updated
+    in a copy: sessions may still be reading the previous one, which is
+    read-only. The index is updated with the new incidents, rather than 
+    rebuilt. The incidents are
+    copied and the index is rebuilt only if a new incident is older than
+    the last one, so that the incidents have to be sorted again (see 
+    ihelpers.append_incidents). The map data is rebuilt only if incidents
+    occur at a location that had none before.
+
+    return
+    ------
+    the new data store.
+    """
+    new_incidents = preprocess_incidents(read_incidents(
+        data_store["incident_path"], data_store["incident_state"]["end"], 
+        incident_state["end"]), data_store["gdflocations"])
+
+    data_store = dict(data_store)
+    data_store["version"] += 1
+    data_store["incident_state"] = incident_state
+    if len(new_incidents) == 0:
+        return data_store
+
+    in_order = incidents_in_order(data_store["dfincident"], new_incidents)
+    if in_order:
+        buffers = data_store["incident_buffers"] or \
+                  allocate_incident_buffers(data_store["dfincident"])
+        buffers = append_to_incident_buffers(buffers, new_incidents)
+        dfincident = incidents_from_buffers(buffers)
+    else:
+        buffers = None
+        dfincident = append_incidents(data_store["dfincident"], new_incidents)
+    gdflocations = data_store["gdflocations"]
+    cube = data_store["incident_cube"]
+
+    # new incident types are added at the end, the map gets new locations
+    new_types = new_incidents["dim_incident_incident_type"].astype(str).unique()
+    types = np.concatenate([cube["types"], 
+                            [t for t in new_types if t not in set(cube["types"])]])
+    new_locations = np.setdiff1d(np.intersect1d(new_incidents["hub_vak_bk"].unique(),
+                                                gdflocations["vak"].values),
+                                 cube["locations"])
+    if len(new_locations) > 0:
+        locdata = prepare_data_for_geoplot(dfincident, gdflocations)
+        data_store["map_levels"] = build_map_levels(locdata["geometry"])
+    else:
+        locdata = data_store["locdata"].copy()
+
+    incident_cube = update_incident_count_cube(cube, new_incidents,
+                                               locdata["location_id"].values, types)
+    if in_order:
+        incident_index = update_incident_index(data_store["incident_index"], new_incidents)
+    else:
+        incident_index = build_incident_index(dfincident)
+    density_grids = update_density_grids(data_store["density_grids"], new_incidents, types)
+    locdata["incident_rate"] = incident_cube["totals"].sum(axis=1)
+    _set_read_only(_derived_arrays(incident_cube, incident_index))
+
+    data_store.update({"dfincident": dfincident,
+                       "incident_buffers": buffers,
+                       "incident_times": dfincident["timestamp"].values,
+                       "locdata": locdata,
+                       "incident_types": incident_cube["types"],
+                       "incident_cube": incident_cube,
+                       "incident_index": incident_index,
+                       "density_grids": density_grids})
+    return data_store
+
+def refresh_data_store():
+    """ Update the data store of this process with the incidents that were
+        appended to the incident file since it was loaded.
+
+    notes
+    -----
+    If the file was rewritten rather than appended to, the data store is
+    loaded again. The data store is replaced as a whole, never modified,
+    so sessions that use the previous one are not affected until they
+    call get_data_store again. Data shared between processes (see 
+    SHARED_DIR) is not refreshed.
+
+    return
+    ------
+    True if the data store changed, False otherwise.
+    """
+    global _DATA_STORE
+    # nothing to refresh before the data is loaded, or while refreshing
+    if (_DATA_STORE is None) or not _REFRESH_LOCK.acquire(False):
+        return False
+
+    try:
+        data_store = _DATA_STORE
+        if data_store["shared"]:
+            return False
+        status, incident_state = check_incident_file(data_store["incident_path"],
+                                                     data_store["incident_state"])
+        if status == "unchanged":
+            return False
+        elif status == "rewritten":
+            print("{} was rewritten, reloading it.".format(data_store["incident_path"]))
+            new_store = load_data_store(data_store["incident_path"], 
+                                        data_store["geo_path"], shared_dir=None)
+            new_store["version"] = data_store["version"] + 1
+        else:
+            new_store = _ingest_incidents(data_store, incident_state)
+
+        with _DATA_STORE_LOCK:
+            _DATA_STORE = new_store
+        return True
+    finally:
+        _REFRESH_LOCK.release()
+
+def get_warm_up_combinations(data_store):
+    """ Get the arguments of aggregate_data_for_time_series for every
+        feasible combination of pattern, aggregation and grouping (see
+        ihelpers.feasible_combos), with all incident types and locations,
+        which is what a new session shows. """
+    types = list(data_store["incident_types"])
+    return [(agg, pattern, group, types, None)
+            for pattern, combos in feasible_combos.items()
+            for agg in combos["agg"] for group in combos["group"]]
+
+def _aggregate_for_warm_up(combination):
+    """ Compute one combination of get_warm_up_combinations in a worker
+        process of warm_up_aggregation_cache.
+
+    return
+    ------
+    tuple of (the result, the (end, head) of the incident file state 
+    that the result was computed with).
+    """
+    # every (spawned) worker loads the data store once
+    data_store = get_data_store()
+    agg, pattern, group, types, locations = combination
+    result = aggregate_data_for_time_series(data_store["dfincident"], agg, pattern,
+                                            group, types, locations,
+                                            index=data_store["incident_index"])
+    state = data_store["incident_state"]
+    return result, (state["end"], state["head"])
+
+def warm_up_aggregation_cache(processes=WARMUP_PROCESSES, cache=AGGREGATION_CACHE):
+    """ Compute the time series of every feasible view of a new session in
+        parallel and put them in the aggregation cache, so that the first
+        session does not have to wait for them.
+
+    params
+    ------
+    processes: the number of worker processes.
+    cache: the LRU cache to fill (see ihelpers.create_lru_cache).
+
+    notes
+    -----
+    The aggregations are CPU-bound pandas code, so they run in processes
+    rather than threads. The workers are spawned rather than forked, since
+    this runs in a thread of the server (forking a process with threads 
+    can deadlock the child on locks those threads held), so every worker
+    loads the data store first (from the on-disk cache, or SHARED_DIR). 
+    Results of workers that read the incident file in another state than
+    this process are not used, so that the cache only contains results of
+    the data that the sessions see.
+
+    The results are only put in the cache as long as they fit in its
+    memory budget, as evicting other results (or earlier results of the 
+    warm-up) would not speed up anything.
+
+    return
+    ------
+    the number of results put in the cache.
+    """
+    data_store = get_data_store()
+    state = data_store["incident_state"]
+    combinations = get_warm_up_combinations(data_store)
+    start = time.time()
+    count, skipped = 0, 0
+    with ProcessPoolExecutor(max_workers=processes, 
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(_aggregate_for_warm_up, combination): combination
+                   for combination in combinations}
+        for future in as_completed(futures):
+            try:
+                result, worker_state = future.result()
+            except Exception as e:
+                print("Could not warm up the aggregation cache: {}".format(e))
+                continue
+            if worker_state != (state["end"], state["head"]):
+                continue
+            agg, pattern, group, types, locations = futures[future]
+            key = aggregation_cache_key(agg, pattern, group, types, locations,
+                                        data_store["version"])
+            if lru_cache_put(cache, key, result, evict=False):
+                count += 1
+            else:
+                skipped += 1
+    print("Warmed up the aggregation cache with {} of {} views in {:.1f} seconds"
+          " ({} did not fit in its budget).".format(count, len(combinations), 
+                                                    time.time() - start, skipped))
+    return count
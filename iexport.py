@@ -0,0 +1,309 @@
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from bokeh.embed import file_html
+from bokeh.layouts import row
+from bokeh.models import ColumnDataSource
+from bokeh.resources import CDN
+
+from ihelpers import load_and_preprocess_geodata, load_and_preprocess_incidents, \
+                     prepare_data_for_geoplot, aggregate_data_for_time_series, \
+                     build_map_levels, feasible_combos
+from idatastore import DATA_DIR, INCIDENT_FILE, GEO_FILE
+from iplotcreators import create_time_series_figure, create_static_map
+
+# the columns of the incidents that reports are made per value of
+EXPORT_REGION_COLUMNS = ["kazerne_groep", "cluster_naam"]
+# simplification tolerance (meters) of the polygons on the report maps
+EXPORT_MAP_TOLERANCE = 8
+
+# the data of this process, see load_export_data
+_EXPORT_DATA = None
+
+def load_export_data(incident_path, geo_path):
+    """ Load the data that reports are made from.
+
+    return
+    ------
+    dict with keys:
+        "dfincident": DataFrame of incidents (see load_and_preprocess_incidents),
+        "gdflocations": GeoDataFrame of the polygons (vakken),
+        "incident_types": array of all incident types,
+        "map_xs", "map_ys": dicts of the simplified polygons by vak.
+    """
+    dfincident = load_and_preprocess_incidents(incident_path, geo_path=geo_path)
+    gdflocations = load_and_preprocess_geodata(geo_path)
+    level = build_map_levels(gdflocations["geometry_lonlat"], [EXPORT_MAP_TOLERANCE])[0]
+    return {"dfincident": dfincident,
+            "gdflocations": gdflocations,
+            "incident_types": np.sort(dfincident["dim_incident_incident_type"].unique()
+                                      .astype(str)),
+            "map_xs": dict(zip(gdflocations["vak"], level["xs"])),
+            "map_ys": dict(zip(gdflocations["vak"], level["ys"]))}
+
+def _init_export_worker(incident_path, geo_path):
+    """ Load the data in a worker process of run_export, unless it was
+        inherited from the parent process (when forked). """
+    global _EXPORT_DATA
+    if _EXPORT_DATA is None:
+        _EXPORT_DATA = load_export_data(incident_path, geo_path)
+
+def default_jobs(dfincident, region_columns=EXPORT_REGION_COLUMNS):
+    """ Get the jobs for a report of every feasible combination of pattern,
+        aggregation and grouping (see ihelpers.feasible_combos) with all
+        incident types, for the whole area and for every value of the
+        region columns.
+
+    return
+    ------
+    list of jobs, see run_export.
+    """
+    regions = [None] + [(col, value) for col in region_columns
+                        for value in sorted(dfincident[col].dropna().unique())]
+    return [{"region": region, "types": None, "pattern": pattern, "agg": agg,
+             "group": group}
+            for region in regions
+            for pattern, combos in feasible_combos.items()
+            for agg in combos["agg"] for group in combos["group"]]
+
+def read_jobs(path):
+    """ Read jobs from a json file with a list of objects with keys
+        "region" (null or [column, value]), "types" (null for all types or
+        a list of types), "pattern", "agg" and "group". Jobs with a
+        combination that is not in feasible_combos are skipped.
+
+    return
+    ------
+    list of jobs, see run_export.
+    """
+    with open(path) as f:
+        jobs = json.load(f)
+
+    feasible = []
+    for job in jobs:
+        combos = feasible_combos.get(job["pattern"], {"agg": [], "group": []})
+        if (job["agg"] in combos["agg"]) and (job["group"] in combos["group"]):
+            job["region"] = tuple(job["region"]) if job.get("region") else None
+            job["types"] = job.get("types")
+            feasible.append(job)
+        else:
+            print("Skipping infeasible job: {}".format(json.dumps(job)))
+    return feasible
+
+def _slug(text):
+    return re.sub(r"[^A-Za-z0-9]+", "_", str(text)).strip("_").lower()
+
+def get_report_name(job):
+    """ Get the path of the report of a job, relative to the output directory
+        and without extension, e.g., 'cluster_naam_noordwest/daily_hour_type'. """
+    region = "all" if job["region"] is None else _slug("{}_{}".format(*job["region"]))
+    name = "_".join(_slug(job[key]) for key in ["pattern", "agg", "group"])
+    if job["types"] is not None:
+        name += "_" + hashlib.sha1("|".join(sorted(job["types"])).encode()).hexdigest()[:8]
+    return os.path.join(region, name)
+
+def filter_region(dfincident, region):
+    """ Get the incidents of a region, which is None for all incidents or
+        a tuple of (column, value). """
+    if region is None:
+        return dfincident
+    column, value = region
+    return dfincident[dfincident[column] == value]
+
+def time_series_to_frame(x, y, labels, group_by):
+    """ Convert the result of aggregate_data_for_time_series to a table.
+
+    return
+    ------
+    DataFrame with columns "group" (the label of the line, or 'None'),
+    "x" (or "x0", "x1" when the x-axis has two levels) and "y".
+    """
+    if group_by == "None":
+        x, y, labels = [x], [y], ["None"]
+    frames = []
+    for xs, ys, label in zip(x, y, labels):
+        if len(xs) and isinstance(xs[0], tuple):
+            frame = pd.DataFrame(list(xs), columns=["x{}".format(i) for i in range(len(xs[0]))])
+        else:
+            frame = pd.DataFrame({"x": list(xs)})
+        frame.insert(0, "group", str(label))
+        frame["y"] = ys
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+def write_table(frame, path, formats):
+    """ Write a DataFrame to path + '.csv' and/or path + '.parquet'.
+
+    return
+    ------
+    list of the written paths.
+    """
+    paths = []
+    if "csv" in formats:
+        frame.to_csv(path + ".csv", index=False)
+        paths.append(path + ".csv")
+    if "parquet" in formats:
+        frame.to_parquet(path + ".parquet", index=False)
+        paths.append(path + ".parquet")
+    return paths
+
+def export_region(region, jobs, output_dir, formats=("csv",), html=True):
+    """ Make the reports of the jobs of one region, in a worker process
+        of run_export.
+
+    notes
+    -----
+    The incidents of the region, and its number of incidents per vak for
+    every set of types, are computed once for all its jobs. The time 
+    series are computed from all incidents, filtered on the vakken of the
+    region like the dashboard does, so that they are averaged over the 
+    same time span as in the dashboard.
+
+    return
+    ------
+    list of dicts describing the reports (see run_export).
+    """
+    data = _EXPORT_DATA
+    dfregion = filter_region(data["dfincident"], region)
+    region_vakken = None if region is None else list(dfregion["hub_vak_bk"].unique())
+    vakken = {}
+    records = []
+    for job in jobs:
+        start = time.time()
+        name = get_report_name(job)
+        base = os.path.join(output_dir, name)
+        if not os.path.isdir(os.path.dirname(base)):
+            os.makedirs(os.path.dirname(base))
+        types = data["incident_types"] if job["types"] is None else job["types"]
+        title = "{} - {}, {} by {}, grouped by {}".format(
+            "all" if region is None else "{} {}".format(*region),
+            "all types" if job["types"] is None else ", ".join(types),
+            job["pattern"], job["agg"], job["group"])
+
+        # the number of incidents per vak only depends on the types
+        key = None if job["types"] is None else frozenset(types)
+        if key not in vakken:
+            dftypes = dfregion[dfregion["dim_incident_incident_type"].isin(types)]
+            locdata = prepare_data_for_geoplot(dftypes, data["gdflocations"])
+            vakken[key] = (locdata[["location_id", "incident_rate"]], locdata["location_id"])
+        vak_counts, locations = vakken[key]
+
+        x, y, labels = aggregate_data_for_time_series(data["dfincident"], job["agg"],
+                                                      job["pattern"], job["group"],
+                                                      types, region_vakken)
+        paths = write_table(time_series_to_frame(x, y, labels, job["group"]),
+                            base + "_time_series", formats)
+        paths += write_table(vak_counts, base + "_vakken", formats)
+
+        if html:
+            ts_figure, _ = create_time_series_figure(x, y, labels, job["group"],
+                                                     width=700, height=400, title=title)
+            source = ColumnDataSource({"xs": [data["map_xs"][vak] for vak in locations],
+                                       "ys": [data["map_ys"][vak] for vak in locations],
+                                       "location_id": vak_counts["location_id"].values,
+                                       "incident_rate": vak_counts["incident_rate"].values
+                                                        .astype(float)})
+            map_figure, _ = create_static_map(source, width=500, height=500)
+            with open(base + ".html", "w") as f:
+                f.write(file_html(row(map_figure, ts_figure), CDN, title))
+            paths.append(base + ".html")
+
+        records.append(OrderedDict([("name", name), ("title", title),
+                                    ("incidents", len(dfregion)),
+                                    ("seconds", time.time() - start),
+                                    ("files", " ".join(os.path.relpath(p, output_dir)
+                                                       for p in paths))]))
+    return records
+
+def run_export(jobs, output_dir, incident_path, geo_path, processes=None,
+               formats=("csv",), html=True):
+    """ Make reports of aggregated incident data without a Bokeh server.
+
+    params
+    ------
+    jobs: list of dicts with keys "region" (None for all incidents, or a
+          tuple of a column like 'kazerne_groep' and its value), "types"
+          (None for all types, or a list of incident types), "pattern",
+          "agg" and "group" (see aggregate_data_for_time_series).
+    output_dir: the directory to write the reports to.
+    incident_path, geo_path: the paths of the incident file and geodata.
+    processes: the number of worker processes, defaults to the number of
+               cores.
+    formats: the table formats to write, 'csv' and/or 'parquet'.
+    html: whether to also write every report as standalone html, with a
+          map and a time series plot.
+
+    notes
+    -----
+    Every report consists of a table of the time series and a table of
+    the number of incidents per vak (and the html). The jobs are grouped
+    by region, and the regions are divided over the processes. An index
+    of all reports is written to index.csv in output_dir.
+
+    return
+    ------
+    DataFrame with a row per report (see index.csv).
+    """
+    global _EXPORT_DATA
+    start = time.time()
+    # loaded before the pool is created, so that forked workers inherit it
+    if _EXPORT_DATA is None:
+        _EXPORT_DATA = load_export_data(incident_path, geo_path)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    regions = OrderedDict()
+    for job in jobs:
+        regions.setdefault(job["region"], []).append(job)
+
+    records = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_export_worker,
+                             initargs=(incident_path, geo_path)) as pool:
+        futures = {pool.submit(export_region, region, region_jobs, output_dir,
+                               formats, html): region
+                   for region, region_jobs in regions.items()}
+        for future in as_completed(futures):
+            try:
+                records += future.result()
+            except Exception as e:
+                print("Could not export region {}: {}".format(futures[future], e))
+
+    index = pd.DataFrame(records).sort_values("name") if records else pd.DataFrame()
+    index.to_csv(os.path.join(output_dir, "index.csv"), index=False)
+    print("Wrote {} of {} reports to {} in {:.1f} seconds.".format(
+        len(records), len(jobs), output_dir, time.time() - start))
+    return index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export aggregated incident data "
+                                                 "for reporting, without a server.")
+    parser.add_argument("output_dir", help="the directory to write the reports to")
+    parser.add_argument("--jobs", help="json file with the jobs (see read_jobs), "
+                                       "defaults to all views of every region")
+    parser.add_argument("--data-dir", default=DATA_DIR,
+                        help="the data directory of the dashboard")
+    parser.add_argument("--region-columns", nargs="+", default=EXPORT_REGION_COLUMNS,
+                        help="the columns to make reports per value of (without --jobs)")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--format", nargs="+", default=["csv"], choices=["csv", "parquet"])
+    parser.add_argument("--no-html", action="store_true", help="do not write html reports")
+    args = parser.parse_args()
+
+    incident_path = os.path.join(args.data_dir, INCIDENT_FILE)
+    geo_path = os.path.join(args.data_dir, GEO_FILE)
+    if args.jobs:
+        jobs = read_jobs(args.jobs)
+    else:
+        _EXPORT_DATA = load_export_data(incident_path, geo_path)
+        jobs = default_jobs(_EXPORT_DATA["dfincident"], args.region_columns)
+    run_export(jobs, args.output_dir, incident_path, geo_path, processes=args.processes,
+               formats=args.format, html=not args.no_html)
@@ -1,28 +1,184 @@
+import os
+import io
+import sys
+import json
+import hashlib
+import glob
+import shutil
+import multiprocessing
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from pyproj import Proj, transform
-from shapely.geometry import Polygon
+import shapely
+from pyproj import Transformer
 from bokeh.palettes import brewer
-from itertools import product
+
+# version of the preprocessing in load_and_preprocess_incidents, part of the
+# cache key: increase it whenever the preprocessing changes.
+PREPROCESSING_VERSION = 4
+# same for the geodata in load_and_preprocess_geodata
+GEO_PREPROCESSING_VERSION = 1
+
+# the combinations of pattern, aggregation and grouping that the time series
+# can show (agg and group options per pattern)
+feasible_combos = {"Daily": {"agg": ["Hour"],
+                             "group": ["Type", "Day of Week", "Year", "None"]},
+                   "Weekly": {"agg": ["Hour", "Day"],
+                             "group": ["Type", "Year", "None"]},
+                   "Yearly": {"agg": ["Hour", "Day", "Week", "Month"],
+                              "group": ["Type", "Year", "None"]}}
+
+# the columns of the incident file that are used, and how to parse them
+INCIDENT_COLUMNS = ['dim_incident_id','dim_incident_incident_type', 'dim_datum_datum', 
+    'dim_datum_jaar', 'dim_datum_maand_nr', 'dim_datum_maand_dag_nr', 
+    'dim_datum_week_nr', 'dim_datum_dag_naam_nl','dim_prioriteit_prio', 'dim_tijd_uur',
+    'hub_vak_bk', 'hub_vak_id', 'st_x', 'st_y','cluster_naam', 'kazerne_groep']
+INCIDENT_DTYPES = {"dim_tijd_uur": int, "dim_incident_incident_type": "category",
+                   "dim_datum_datum": "category", "dim_datum_dag_naam_nl": "category",
+                   "cluster_naam": "category", "kazerne_groep": "category"}
+# the unordered categorical columns of the preprocessed incidents
+INCIDENT_CATEGORICALS = ["dim_incident_incident_type", "dim_datum_datum",
+                         "dim_datum_dag_naam_nl", "cluster_naam", "kazerne_groep"]
+# spare room for new incidents (as a fraction of the incidents, at least 1024)
+# that the columns of the incidents are allocated with when they are ingested,
+# see allocate_incident_buffers
+INCIDENT_SPARE_CAPACITY = 0.1
+# number of processes that parse the incident file, and the number of bytes
+# each of them parses at a time (see read_and_preprocess_incidents)
+LOAD_PROCESSES = int(os.environ.get("IDASHBOARD_LOAD_PROCESSES", os.cpu_count() or 1))
+LOAD_CHUNK_BYTES = int(os.environ.get("IDASHBOARD_LOAD_CHUNK_MB", 64)) * 2**20
+# number of bytes at the start of a file that are compared to tell an
+# appended file from a rewritten one, see check_incident_file
+HEAD_CHECK_BYTES = 2**16
+
+# simplification tolerances (in meters) of the map polygons at the zoom
+# levels of the map, see build_map_levels
+MAP_SIMPLIFICATION_LEVELS = [0, 2, 8, 32, 128]
+
+# sizes (in meters) of the cells of the incident density grids, each a
+# multiple of the first (see build_density_grids), and the minimum width
+# of a cell on the map in pixels (see select_density_level)
+DENSITY_CELL_SIZES = [50, 100, 200, 400, 800, 1600, 3200]
+DENSITY_MIN_CELL_PIXELS = 6
+
+# RD New (Dutch national grid) to WGS84 transformer, see _get_transformer
+_RD_TO_WGS84 = None
+
+# memory budget (in bytes) of the cache of aggregate_data_for_time_series
+AGGREGATION_CACHE_BUDGET = int(os.environ.get("IDASHBOARD_AGGREGATION_CACHE_MB", 64)) * 2**20
+
+def get_cache_path(path, extension, version, cache_dir=None, stat=None,
+                   dependencies=()):
+    """ Get the path of the on-disk cache of a preprocessed source file.
+
+    params
+    ------
+    path: the path to the source file.
+    extension: the file extension of the cache file, e.g., 'feather'.
+    version: the version of the preprocessing applied to the source file.
+    cache_dir: the directory to store the cache in. Defaults to a 'cache'
+        directory next to the source file.
+    stat: the os.stat() result of the source file to use, defaults to
+        the current one.
+    dependencies: paths of other files that the preprocessing uses, e.g.,
+        the geodata.
+
+    notes
+    -----
+    The file name contains a hash of the absolute path, size and
+    modification time of the source file (and its dependencies) and the
+    preprocessing version, so that the cache goes stale as soon as any of
+    these change.
+
+    return
+    ------
+    The path to the cache file (which may not exist yet).
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), "cache")
+
+    if stat is None:
+        stat = os.stat(path)
+    key = "|".join([os.path.abspath(path), str(stat.st_size),
+                    repr(stat.st_mtime), str(version)])
+    for dependency in dependencies:
+        dependency_stat = os.stat(dependency)
+        key += "|" + "|".join([os.path.abspath(dependency), str(dependency_stat.st_size),
+                               repr(dependency_stat.st_mtime)])
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[0:16]
+    name = os.path.basename(path)
+    return os.path.join(cache_dir, "{}.{}.{}".format(name, digest, extension))
+
+def _write_cache(df, cache_path, writer):
+    """ Write a DataFrame to the cache and remove stale versions of it.
+
+    params
+    ------
+    df: the DataFrame to cache.
+    cache_path: the path obtained from get_cache_path.
+    writer: function (df, path) that writes df to path.
+
+    notes
+    -----
+    The file is written under a temporary name first and then moved in
+    place, so that a crash or a concurrent reader never sees half a file.
+    Failing to write the cache is not fatal: it is reported and ignored.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    name, digest, extension = os.path.basename(cache_path).rsplit(".", 2)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        writer(df, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except (ImportError, IOError, OSError) as e:
+        print("Could not write cache {}: {}".format(cache_path, e))
+        return
+
+    for stale in glob.glob(os.path.join(cache_dir, "{}.*.{}".format(name, extension))):
+        if stale != cache_path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+def _get_transformer():
+    """ Get the (process-wide) transformer from RD New (EPSG:28992) to
+        WGS84 (EPSG:4326) coordinates.
+
+    notes
+    -----
+    Creating a transformer is expensive, so it is created once and reused.
+    The transformer takes and returns coordinates in (x, y) / (lon, lat)
+    order.
+
+    return
+    ------
+    a pyproj.Transformer object.
+    """
+    global _RD_TO_WGS84
+    if _RD_TO_WGS84 is None:
+        _RD_TO_WGS84 = Transformer.from_crs("EPSG:28992", "EPSG:4326", always_xy=True)
+    return _RD_TO_WGS84
 
 def xy_to_lonlat(x, y):
     """ Transform x, y coordinates to longitude, latitude.
 
     params
     ------
-    x: x coordinate
-    y: y coordinate
+    x: x coordinate, or array of x coordinates
+    y: y coordinate, or array of y coordinates
 
     return
     ------
     tuple of (longitude, latitude)
     """
-
-    outProj = Proj("+init=EPSG:4326")
-    inProj = Proj("+init=EPSG:28992")
-    lon, lat = transform(inProj, outProj, x, y)
-    return lon, lat
+    return _get_transformer().transform(x, y)
 
 def convert_polygons_from_xy_to_lonlat(polygons):
     """ Convert an array of shapely.geometry.multipolygon.MultiPolygon objects
@@ -31,21 +187,33 @@ def convert_polygons_from_xy_to_lonlat(polygons):
     params
     ------
     polygons: array or pd.Series of MultiPolygon objects with x, y coordinates.
+
+    notes
+    -----
+    The coordinates of all polygons (all parts, including holes) are
+    transformed in one batch.
     
     return
     -------
-    array of MultiPolygon objects specified in lon and lat coordinates.
+    GeoSeries of MultiPolygon objects specified in lon and lat coordinates.
     """
     polygons = pd.Series(polygons)
-    return polygons.apply(lambda poly: \
-        Polygon([xy_to_lonlat(x, y) for x, y in list(poly[0].exterior.coords)]))
 
-def load_and_preprocess_geodata(path):
+    def transform_coords(coords):
+        lon, lat = xy_to_lonlat(coords[:, 0], coords[:, 1])
+        return np.column_stack([lon, lat])
+
+    converted = shapely.transform(np.asarray(polygons, dtype=object), transform_coords)
+    return gpd.GeoSeries(converted, index=polygons.index, crs="EPSG:4326")
+
+def load_and_preprocess_geodata(path, use_cache=True):
     """ Loads geojson and performs simple preprocessing steps.
 
     params
     ------
     path: the path to the file to load.
+    use_cache (bool): whether to read from and write to the on-disk
+        (Geo)Parquet cache of the preprocessed data (see get_cache_path).
 
     notes
     -----
@@ -57,50 +225,231 @@ def load_and_preprocess_geodata(path):
     ------ 
     A GeoPandas DataFrame with the loaded and preprocessed data.
     """
+    if use_cache:
+        cache_path = get_cache_path(path, "parquet", GEO_PREPROCESSING_VERSION)
+        if os.path.exists(cache_path):
+            try:
+                return gpd.read_parquet(cache_path)
+            except (ImportError, IOError, OSError) as e:
+                print("Could not read cache {}: {}".format(cache_path, e))
+
     gdflocations = gpd.read_file(path)
     gdflocations["vak"] = gdflocations["vak"].astype(int)
     gdflocations["geometry_lonlat"] = convert_polygons_from_xy_to_lonlat(gdflocations["geometry"])
+
+    if use_cache:
+        _write_cache(gdflocations, cache_path, lambda df, p: df.to_parquet(p))
+
     return gdflocations
 
+def assign_vakken(x, y, vakken):
+    """ Find the polygon (vak) that contains each of a set of points.
+
+    params
+    ------
+    x, y: arrays with the RD New coordinates of the points, NaN if unknown.
+    vakken: GeoDataFrame with the polygons in column 'geometry' (in RD New,
+            see load_and_preprocess_geodata) and their ids in column 'vak'.
+
+    notes
+    -----
+    The points are joined to the polygons in bulk through a spatial index
+    (an STRtree) of the polygons. A point on the border of two vakken is
+    assigned to the first of them.
+
+    return
+    ------
+    np.ndarray with the vak id of each point (as float), NaN for points 
+    that are not in any vak.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    result = np.full(len(x), np.nan)
+    known = np.nonzero(~(np.isnan(x) | np.isnan(y)))[0]
+    if (len(known) == 0) or (len(vakken) == 0):
+        return result
+
+    tree = shapely.STRtree(np.asarray(vakken["geometry"].values, dtype=object))
+    point_idx, vak_idx = tree.query(shapely.points(x[known], y[known]),
+                                    predicate="intersects")
+    order = np.lexsort((vak_idx, point_idx))
+    point_idx, vak_idx = point_idx[order], vak_idx[order]
+    first = np.concatenate([[True], point_idx[1:] != point_idx[:-1]])
+    result[known[point_idx[first]]] = vakken["vak"].values[vak_idx[first]]
+    return result
+
+def get_incident_file_state(path):
+    """ Get the state of an incident file that is needed to read only the
+        rows that are appended to it later.
+
+    params
+    ------
+    path: path to the csv file with incident data.
+
+    notes
+    -----
+    A writer may be halfway a row, so only the complete lines (up to 
+    "end") are considered part of the file.
+
+    return
+    ------
+    dict with keys "stat" (the os.stat() result), "end" (the position 
+    after the last complete line) and "head" (a hash of the first 
+    HEAD_CHECK_BYTES bytes, or less if the file is shorter).
+    """
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        # go back block by block until a line ending is found
+        end = stat.st_size
+        while end > 0:
+            start = max(0, end - 2**16)
+            f.seek(start)
+            block = f.read(end - start)
+            newline = block.rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+
+        f.seek(0)
+        head = f.read(min(end, HEAD_CHECK_BYTES))
+
+    return {"stat": stat, "end": end,
+            "head": (len(head), hashlib.sha1(head).hexdigest())}
+
+def check_incident_file(path, state):
+    """ Check whether rows were appended to an incident file.
 
-def load_and_preprocess_incidents(path):
+    params
+    ------
+    path: path to the csv file with incident data.
+    state: the state of the file when it was read 
+           (see get_incident_file_state).
+
+    notes
+    -----
+    The file counts as rewritten, rather than appended to, if it got
+    shorter or if its first bytes changed.
+
+    return
+    ------
+    tuple of (one of {'unchanged', 'appended', 'rewritten'}, the current
+    state of the file).
+    """
+    new_state = get_incident_file_state(path)
+    if new_state["end"] < state["end"]:
+        return "rewritten", new_state
+
+    length, digest = state["head"]
+    with open(path, "rb") as f:
+        head = f.read(length)
+    if hashlib.sha1(head).hexdigest() != digest:
+        return "rewritten", new_state
+    elif new_state["end"] == state["end"]:
+        return "unchanged", new_state
+    else:
+        return "appended", new_state
+
+class _FileRange(io.RawIOBase):
+    """ Read-only file object for a range of bytes of a file. """
+    def __init__(self, f, start, end):
+        self._file = f
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(min(len(buffer), self._remaining))
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+def read_incidents(path, start=0, end=None):
+    """ Read (part of) a csv file with incident data.
+
+    params
+    ------
+    path: path to the csv file with incident data.
+    start: the position to start reading at, which should be the start
+           of a line. If it is not the start of the file, the header is
+           read separately from the first line.
+    end: the position to stop reading at, which should be the end of a
+         line, or None to read until the end of the file.
+
+    return
+    ------
+    DataFrame with the INCIDENT_COLUMNS of the rows in the range.
+    """
+    with open(path, "rb") as f:
+        if start > 0:
+            names = f.readline().decode("utf-8").rstrip("\r\n").split(";")
+        else:
+            names = None
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+
+        source = io.BufferedReader(_FileRange(f, start, end))
+        return pd.read_csv(source, sep=";", decimal=".", header=None if names else "infer",
+                           names=names, usecols=INCIDENT_COLUMNS, dtype=INCIDENT_DTYPES)
+
+def preprocess_incidents(incidents, vakken=None):
     """ Perform preprocessing of datetimes of incidents for convenience
         of plotting.
 
     params
     ------
-    path (str): Path to csv file with incident data.
+    incidents: DataFrame of incidents as read by read_incidents.
+    vakken: optional GeoDataFrame of polygons (see assign_vakken) to
+            assign incidents without a vak ID to by their location.
 
     notes
     -----
     Performs the following steps:
-        1. remove incidents without a polygon (vak) ID
+        0. assign incidents without a polygon (vak) ID to the polygon
+           that contains their location, if vakken are given
+        1. remove incidents that still have no polygon ID
         2. remove incidents outsides the FDAA's service area 
            (since these are not in the geo data)
         3. create ordered pd.Categorical columns for day and 
            month names.
+        4. store the time units (hour, day_nr, week_nr, ...) as small
+           integers and the other string columns as categoricals.
+        5. add the (datetime64) timestamp of the hour of the incident
+           and sort the incidents by it, so that a range of time is a
+           range of rows (see get_time_range_rows).
 
     return
     ------
     DataFrame of incidents with added and adjusted columns
     """
-
-    # load from given path
-    incidents = pd.read_csv(path, sep=";", decimal=".",
-        usecols=['dim_incident_id','dim_incident_incident_type', 'dim_datum_datum', 
-        'dim_datum_jaar', 'dim_datum_maand_nr', 'dim_datum_maand_dag_nr', 
-        'dim_datum_week_nr', 'dim_datum_dag_naam_nl','dim_prioriteit_prio', 'dim_tijd_uur',
-        'hub_vak_bk', 'hub_vak_id', 'st_x', 'st_y','cluster_naam', 'kazerne_groep'],
-        dtype={"dim_tijd_uur": int})
-
-    incidents = incidents[~incidents["hub_vak_bk"].isnull()].copy()
-    incidents["hub_vak_bk"] = incidents["hub_vak_bk"].astype(int)
-    incidents = incidents[incidents["hub_vak_bk"].astype(str).str[0:2]=="13"]
-
-    # add leading zeros to allow proper sorting
-    incidents["hour"] = incidents["dim_tijd_uur"].astype(str).str.zfill(2)
-    incidents["day_nr"] = incidents["dim_datum_maand_dag_nr"].astype(str).str.zfill(2)
-    incidents["week_nr"] = incidents["dim_datum_week_nr"].astype(str).str.zfill(2)
+    if vakken is not None:
+        missing = incidents["hub_vak_bk"].isnull().values
+        if missing.any():
+            incidents.loc[missing, "hub_vak_bk"] = assign_vakken(
+                incidents["st_x"].values[missing], incidents["st_y"].values[missing], vakken)
+
+    incidents = incidents[~incidents["hub_vak_bk"].isnull()]
+    # check the region on the unique polygon ids instead of on every incident
+    vakken = incidents["hub_vak_bk"].unique()
+    vakken = vakken[pd.Series(vakken.astype(int)).astype(str).str[0:2]=="13"]
+    incidents = incidents[incidents["hub_vak_bk"].isin(vakken)]
+
+    # store the time units as small integers, labels are made when plotting
+    incidents = incidents.astype({"hub_vak_bk": int,
+                                  "dim_tijd_uur": np.uint8, "dim_datum_jaar": np.uint16,
+                                  "dim_datum_maand_nr": np.uint8,
+                                  "dim_datum_maand_dag_nr": np.uint8,
+                                  "dim_datum_week_nr": np.uint8})
+    incidents["hour"] = incidents["dim_tijd_uur"]
+    incidents["day_nr"] = incidents["dim_datum_maand_dag_nr"]
+    incidents["week_nr"] = incidents["dim_datum_week_nr"]
+
+    # fix the order of the categories of the other categorical columns
+    for col in INCIDENT_CATEGORICALS:
+        categories = incidents[col].cat.remove_unused_categories().cat.categories
+        incidents[col] = incidents[col].cat.set_categories(sorted(categories))
 
     # map weekday names to shorts and order them
     incidents["day_name"] = incidents["dim_datum_dag_naam_nl"].map(
@@ -108,16 +457,452 @@ def load_and_preprocess_incidents(path):
         "Donderdag" : "Thu", "Vrijdag" : "Fri", "Zaterdag" : "Sat", "Zondag" : "Sun"})
     incidents["day_name"] = pd.Categorical(incidents["day_name"], ordered=True,
         categories=["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"])
-    # same for months
-    incidents["month"] = incidents["dim_datum_maand_nr"].astype(int).map(
-        {1: "Jan", 2: "Feb", 3: "Mar", 4: "Apr", 5: "May", 6: "Jun",
-         7: "Jul", 8: "Aug", 9: "Sep", 10: "Oct", 11: "Nov", 12: "Dec"})
-    incidents["month"] = pd.Categorical(incidents["month"], ordered=True,
+    # same for months, whose numbers directly give the codes
+    incidents["month"] = pd.Categorical.from_codes(
+        incidents["dim_datum_maand_nr"].values.astype(np.int8) - 1, ordered=True,
         categories=["Jan", "Feb", "Mar", "Apr", "May", "Jun", 
         "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])
 
+    # parse every date once, incidents without a date get NaT (code -1)
+    dates = np.append(pd.to_datetime(incidents["dim_datum_datum"].cat.categories).values,
+                      np.datetime64("NaT", "ns"))
+    incidents["timestamp"] = dates[incidents["dim_datum_datum"].cat.codes.values] + \
+                             incidents["dim_tijd_uur"].values.astype("timedelta64[h]")
+    incidents = incidents.take(np.argsort(incidents["timestamp"].values, kind="stable"))
+
+    return incidents.reset_index(drop=True)
+
+def split_incident_file(path, end=None, chunk_bytes=LOAD_CHUNK_BYTES):
+    """ Split a csv file into byte ranges of whole lines.
+
+    params
+    ------
+    path: path to the csv file.
+    end: the position to split the file up to, which should be the end of
+         a line, or None to split the whole file.
+    chunk_bytes: the approximate size of the ranges.
+
+    return
+    ------
+    list of (start, end) tuples, see read_incidents. The first range
+    starts at the header.
+    """
+    with open(path, "rb") as f:
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        ranges, start = [], 0
+        while start < end:
+            # extend the range to the end of the line it stops in
+            f.seek(min(start + chunk_bytes, end))
+            f.readline()
+            stop = min(f.tell(), end)
+            ranges.append((start, stop))
+            start = stop
+    return ranges
+
+def _read_and_preprocess_range(path, start, end, vakken=None):
+    """ Read and preprocess a byte range of an incident file, see
+        read_and_preprocess_incidents. """
+    return preprocess_incidents(read_incidents(path, start, end), vakken)
+
+def concat_incidents(chunks):
+    """ Concatenate preprocessed incidents column by column.
+
+    params
+    ------
+    chunks: list of DataFrames of incidents (see preprocess_incidents).
+            The list is emptied, so that the chunks can be released as 
+            they are concatenated.
+
+    notes
+    -----
+    The categories of unordered categorical columns become the sorted 
+    union of those of the chunks, and the rows are sorted by timestamp,
+    so that the result is the same as when all incidents were 
+    preprocessed at once. Every column of the chunks is released as soon
+    as it is concatenated, so the memory use stays close to the size of
+    the result.
+
+    return
+    ------
+    DataFrame with the incidents of all chunks.
+    """
+    names = list(chunks[0].columns)
+    # copy the columns out of the (2D) blocks of the frames, which could
+    # otherwise only be released together
+    for i in range(len(chunks)):
+        chunks[i] = [chunks[i][col].values.copy() for col in names]
+
+    # the chunks are sorted, so the order only changes where they overlap
+    times = np.concatenate([chunk[names.index("timestamp")] for chunk in chunks])
+    order = None if np.all(times[1:] >= times[:-1]) else np.argsort(times, kind="stable")
+    del times
+
+    columns = OrderedDict()
+    for j, col in enumerate(names):
+        parts = [chunk[j] for chunk in chunks]
+        for chunk in chunks:
+            chunk[j] = None
+        if isinstance(parts[0], pd.Categorical):
+            columns[col] = pd.api.types.union_categoricals(
+                parts, sort_categories=not parts[0].ordered)
+        else:
+            columns[col] = np.concatenate(parts)
+        if order is not None:
+            columns[col] = columns[col].take(order)
+        del parts
+    del chunks[:]
+    return pd.DataFrame(columns, copy=False)
+
+def read_and_preprocess_incidents(path, end=None, processes=LOAD_PROCESSES,
+                                  chunk_bytes=LOAD_CHUNK_BYTES, vakken=None):
+    """ Read and preprocess an incident file in chunks, in parallel.
+
+    params
+    ------
+    path: path to the csv file with incident data.
+    end: the position to read up to, see read_incidents.
+    processes: the number of worker processes, 1 to read the chunks one
+               by one in this process.
+    chunk_bytes: the approximate number of bytes of every chunk.
+    vakken: optional GeoDataFrame of polygons, see preprocess_incidents.
+
+    notes
+    -----
+    Every chunk is parsed, filtered and preprocessed on its own, so only
+    the compact (preprocessed) chunks are ever held at once, rather than 
+    the raw parse of the whole file. The result equals
+    preprocess_incidents(read_incidents(path, end=end), vakken).
+    The workers are spawned rather than forked, since this also runs in
+    the server, whose other threads a forked child would inherit mid-way
+    (see idatastore.warm_up_aggregation_cache).
+
+    return
+    ------
+    DataFrame of incidents, see preprocess_incidents.
+    """
+    ranges = split_incident_file(path, end, chunk_bytes)
+    if len(ranges) <= 1:
+        return preprocess_incidents(read_incidents(path, end=end), vakken)
+    elif processes > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, len(ranges)),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            starts, stops = zip(*ranges)
+            chunks = list(pool.map(_read_and_preprocess_range, [path] * len(ranges),
+                                   starts, stops, [vakken] * len(ranges)))
+    else:
+        chunks = [_read_and_preprocess_range(path, start, stop, vakken)
+                  for start, stop in ranges]
+    return concat_incidents(chunks)
+
+def load_and_preprocess_incidents(path, use_cache=True, state=None,
+                                  processes=LOAD_PROCESSES, geo_path=None):
+    """ Load and preprocess the incident data (see preprocess_incidents).
+
+    params
+    ------
+    path (str): Path to csv file with incident data.
+    use_cache (bool): whether to read from and write to the on-disk
+        Feather cache of the preprocessed data (see get_cache_path).
+    state (dict): the state of the file to load (see 
+        get_incident_file_state), defaults to its current state. Only
+        the lines up to state["end"] are loaded, so that rows appended
+        later can be added with append_incidents.
+    processes (int): the number of processes to parse the file with
+        (see read_and_preprocess_incidents).
+    geo_path (str): optional path to the geojson file with the polygons
+        (vakken) to assign incidents without a vak ID to by their 
+        location (see assign_vakken).
+
+    notes
+    -----
+    The result is cached in a columnar (Feather) file, so that next
+    calls on an unchanged file skip parsing and preprocessing. The cache
+    also depends on the geodata, if given.
+
+    return
+    ------
+    DataFrame of incidents with added and adjusted columns
+    """
+    if state is None:
+        state = get_incident_file_state(path)
+
+    if use_cache:
+        cache_path = get_cache_path(path, "feather", PREPROCESSING_VERSION,
+                                    stat=state["stat"],
+                                    dependencies=[geo_path] if geo_path else [])
+        if os.path.exists(cache_path):
+            try:
+                return pd.read_feather(cache_path)
+            except (ImportError, IOError, OSError) as e:
+                print("Could not read cache {}: {}".format(cache_path, e))
+
+    vakken = None
+    if geo_path is not None:
+        vakken = load_and_preprocess_geodata(geo_path, use_cache=use_cache)[["vak", "geometry"]]
+    incidents = read_and_preprocess_incidents(path, end=state["end"], processes=processes,
+                                              vakken=vakken)
+    if use_cache:
+        _write_cache(incidents, cache_path, lambda df, p: df.to_feather(p))
+
     return incidents
 
+def append_incidents(incidents, new_incidents):
+    """ Append preprocessed incidents to the other preprocessed incidents.
+
+    params
+    ------
+    incidents: DataFrame of incidents (see preprocess_incidents).
+    new_incidents: DataFrame of incidents to append to it.
+
+    notes
+    -----
+    The categories of the result are the (sorted) union of those of both 
+    frames. When the new categories sort after the existing ones, which
+    is the common case for the dates of new incidents, the codes of the
+    existing incidents do not change. Likewise, the existing incidents
+    keep their rows unless a new incident is older than the last of
+    them (see incidents_in_order), in which case all incidents are 
+    sorted by timestamp again.
+
+    return
+    ------
+    a new DataFrame with the incidents of both frames.
+    """
+    incidents = incidents.copy(deep=False)
+    new_incidents = new_incidents.copy(deep=False)
+    for col in INCIDENT_CATEGORICALS:
+        categories = incidents[col].cat.categories
+        added = new_incidents[col].cat.categories.difference(categories)
+        if len(added) > 0:
+            if (len(categories) > 0) and (sorted(added)[0] < categories[-1]):
+                incidents[col] = incidents[col].cat.set_categories(
+                    sorted(categories.append(added)))
+            else:
+                incidents[col] = incidents[col].cat.add_categories(sorted(added))
+        new_incidents[col] = new_incidents[col].cat.set_categories(
+            incidents[col].cat.categories)
+
+    in_order = incidents_in_order(incidents, new_incidents)
+    incidents = pd.concat([incidents, new_incidents], ignore_index=True)
+    if not in_order:
+        incidents = incidents.take(np.argsort(incidents["timestamp"].values, kind="stable")) \
+                             .reset_index(drop=True)
+    return incidents
+
+def incidents_in_order(incidents, new_incidents):
+    """ Check whether appending new_incidents to incidents keeps them
+        sorted by timestamp, see append_incidents. """
+    if (len(incidents) == 0) or (len(new_incidents) == 0):
+        return True
+    return new_incidents["timestamp"].values[0] >= incidents["timestamp"].values[-1]
+
+def _buffer_capacity(n_rows):
+    return n_rows + max(int(n_rows * INCIDENT_SPARE_CAPACITY), 1024)
+
+def _codes_dtype(dtype):
+    """ Get the integer type of the codes of a categorical dtype. """
+    return pd.Categorical.from_codes([], dtype=dtype).codes.dtype
+
+def allocate_incident_buffers(incidents):
+    """ Copy the columns of preprocessed incidents into arrays with spare
+        room (see INCIDENT_SPARE_CAPACITY) to append new incidents to
+        without copying the others (see append_to_incident_buffers).
+
+    return
+    ------
+    dict with keys "n_rows" (the number of incidents), "columns" (the 
+    arrays by column, the codes for categorical columns) and "dtypes"
+    (the dtypes of the categorical columns).
+    """
+    n_rows = len(incidents)
+    columns, dtypes = OrderedDict(), {}
+    for col in incidents.columns:
+        values = incidents[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            dtypes[col] = values.dtype
+            values = values.cat.codes
+        columns[col] = np.empty(_buffer_capacity(n_rows), dtype=values.dtype)
+        columns[col][:n_rows] = values.values
+    return {"n_rows": n_rows, "columns": columns, "dtypes": dtypes}
+
+def incidents_from_buffers(buffers):
+    """ Get the incidents in buffers (see allocate_incident_buffers) as a
+        DataFrame whose columns are views of the buffers, not copies. """
+    n_rows = buffers["n_rows"]
+    columns = OrderedDict()
+    for col, values in buffers["columns"].items():
+        columns[col] = values[:n_rows]
+        if col in buffers["dtypes"]:
+            columns[col] = pd.Categorical.from_codes(columns[col], dtype=buffers["dtypes"][col])
+    return pd.DataFrame(columns, copy=False)
+
+def append_to_incident_buffers(buffers, new_incidents):
+    """ Append preprocessed incidents to the incidents in buffers, like
+        append_incidents does for DataFrames.
+
+    params
+    ------
+    buffers: the dict returned by allocate_incident_buffers.
+    new_incidents: DataFrame of incidents to append, which are not older
+                   than the last incident in buffers (see incidents_in_order).
+
+    notes
+    -----
+    The new incidents are written after the others, which DataFrames 
+    from incidents_from_buffers do not see, so frames of the previous
+    buffers stay valid. A column is only copied to a new array when it
+    has no room left (with new spare room), when its codes change because
+    new categories sort before the others, or when the codes no longer
+    fit their integer type. buffers itself is not modified, but should
+    not be appended to again.
+
+    return
+    ------
+    a new dict like buffers, with the arrays of buffers where possible.
+    """
+    n_rows, n_new = buffers["n_rows"], len(new_incidents)
+    columns, dtypes = OrderedDict(), dict(buffers["dtypes"])
+    for col, values in buffers["columns"].items():
+        old_values, new_values = values[:n_rows], new_incidents[col]
+        if col in dtypes:
+            categories = dtypes[col].categories
+            added = new_values.cat.categories.difference(categories)
+            if (len(added) > 0) and (len(categories) > 0) and (sorted(added)[0] < categories[-1]):
+                old_values = pd.Categorical.from_codes(old_values, dtype=dtypes[col]) \
+                               .set_categories(sorted(categories.append(added)))
+                dtypes[col], old_values = old_values.dtype, old_values.codes
+            elif len(added) > 0:
+                dtypes[col] = pd.CategoricalDtype(categories.append(pd.Index(sorted(added))))
+            new_values = new_values.cat.set_categories(dtypes[col].categories).cat.codes
+            dtype = _codes_dtype(dtypes[col])
+        else:
+            dtype = values.dtype
+
+        if (n_rows + n_new > len(values)) or (dtype != values.dtype) or \
+           not np.shares_memory(old_values, values):
+            values = np.empty(_buffer_capacity(n_rows + n_new), dtype=dtype)
+            values[:n_rows] = old_values
+        values[n_rows:n_rows + n_new] = new_values.values
+        columns[col] = values
+    return {"n_rows": n_rows + n_new, "columns": columns, "dtypes": dtypes}
+
+def get_date_span(times):
+    """ Get the dates of the first and the last incident from their sorted
+        timestamps (see get_time_range_rows), or None if there are none. """
+    # incidents without a date (NaT) come last
+    end = np.searchsorted(times, np.datetime64("NaT"))
+    if end == 0:
+        return None
+    return pd.Timestamp(times[0]).date(), pd.Timestamp(times[end - 1]).date()
+
+def get_time_range_rows(times, start=None, end=None):
+    """ Get the rows of the incidents in a range of time by binary search.
+
+    params
+    ------
+    times: the sorted timestamps of the incidents, i.e., their 
+           "timestamp" column (see preprocess_incidents).
+    start: the first time to include, or None to start at the first incident.
+    end: the time to stop before, or None to include the last incident.
+
+    return
+    ------
+    slice of the rows of the incidents with start <= timestamp < end, 
+    which selects them without copying, e.g., incidents.iloc[rows].
+    """
+    first = 0 if start is None else \
+        int(np.searchsorted(times, np.datetime64(start, "ns"), side="left"))
+    stop = len(times) if end is None else \
+        int(np.searchsorted(times, np.datetime64(end, "ns"), side="left"))
+    return slice(first, max(first, stop))
+
+
+def export_shared_data(directory, frame, arrays):
+    """ Export a DataFrame and numpy arrays to memory-mappable files, so
+        that several processes can use them without each holding a copy.
+
+    params
+    ------
+    directory: the directory to export to. It should not exist yet.
+    frame: DataFrame to export. Object columns are exported as 
+           categoricals, since Python objects cannot be shared.
+    arrays: dict of name -> np.ndarray (numeric or fixed-width string
+            dtype) with other arrays to export.
+
+    notes
+    -----
+    Every column (or its categorical codes) is written to an .npy file.
+    The files are written to a temporary directory that is renamed to
+    `directory` when complete, so that other processes never attach to
+    partial data. If another process exported to `directory` in the 
+    meantime, its export is kept. Put `directory` on a RAM-backed file 
+    system, e.g., /dev/shm, to use POSIX shared memory.
+    """
+    tmp_directory = "{}.{}.tmp".format(directory, os.getpid())
+    os.makedirs(tmp_directory)
+
+    columns = []
+    for i, col in enumerate(frame.columns):
+        values = frame[col]
+        column = {"name": col, "file": "column_{}.npy".format(i)}
+        if values.dtype == object:
+            values = values.astype("category")
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            column["categories"] = values.cat.categories.tolist()
+            column["ordered"] = bool(values.cat.ordered)
+            values = values.cat.codes
+        np.save(os.path.join(tmp_directory, column["file"]), values.values)
+        columns.append(column)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_directory, "array_{}.npy".format(name)), array)
+
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+        json.dump({"columns": columns, "arrays": list(arrays.keys())}, f)
+
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+def attach_shared_data(directory):
+    """ Attach to data exported with export_shared_data without copying it.
+
+    params
+    ------
+    directory: the directory the data was exported to.
+
+    notes
+    -----
+    The columns and arrays are read-only memory maps of the exported
+    files, so the operating system keeps a single copy of the data in
+    memory, no matter how many processes attach to it.
+
+    return
+    ------
+    tuple of (DataFrame, dict of name -> np.ndarray).
+    """
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+
+    columns = {}
+    for column in meta["columns"]:
+        values = np.load(os.path.join(directory, column["file"]), mmap_mode="r")
+        if "categories" in column:
+            values = pd.Categorical.from_codes(values, categories=column["categories"],
+                                               ordered=column["ordered"])
+        columns[column["name"]] = values
+    frame = pd.DataFrame(columns, copy=False)
+
+    arrays = {name: np.load(os.path.join(directory, "array_{}.npy".format(name)),
+                            mmap_mode="r")
+              for name in meta["arrays"]}
+
+    return frame, arrays
+
 
 def prepare_data_for_geoplot(incidents, vakken):
     """ Preprocess the incident data and geodata for plotting.
@@ -157,8 +942,775 @@ def prepare_data_for_geoplot(incidents, vakken):
     return vakdata
 
 
+def geometry_to_multi_polygons(geometries):
+    """ Convert (Multi)Polygons to the nested coordinate lists used by
+        Bokeh's multi_polygons glyph.
+
+    params
+    ------
+    geometries: array or pd.Series of Polygon or MultiPolygon objects.
+
+    return
+    ------
+    tuple of (xs, ys), where xs[i][j][k] is the list of x coordinates of
+    ring k (the exterior followed by the holes) of part j of geometry i.
+    """
+    xs, ys = [], []
+    for geometry in geometries:
+        parts = getattr(geometry, "geoms", [geometry])
+        rings = [[part.exterior] + list(part.interiors) for part in parts]
+        xs.append([[list(ring.xy[0]) for ring in part] for part in rings])
+        ys.append([[list(ring.xy[1]) for ring in part] for part in rings])
+    return xs, ys
+
+def build_polygon_topology(geometries):
+    """ Split the rings of (Multi)Polygons into arcs that are shared by
+        neighbouring polygons, like TopoJSON does.
+
+    params
+    ------
+    geometries: array or pd.Series of Polygon or MultiPolygon objects.
+
+    notes
+    -----
+    Rings are cut at junctions: vertices with more than two distinct
+    neighbouring vertices over all rings, e.g., where three polygons
+    meet. An edge shared by two polygons then becomes a single arc, 
+    which both rings refer to (one of them in reverse). Rings without
+    junctions become a single closed arc. Arcs get a canonical start and
+    direction, so that equal arcs are stored once.
+
+    return
+    ------
+    dict with keys:
+        "points": np.ndarray of shape (n_points, 2) with the distinct
+                  vertices,
+        "arcs": list of np.ndarrays of point ids,
+        "geometries": nested lists, where geometries[i][j][k] is a list of
+                      (arc id, reversed) tuples that make up ring k (the 
+                      exterior followed by the holes) of part j of 
+                      geometry i.
+    """
+    structure, rings = [], []
+    for geometry in geometries:
+        parts = getattr(geometry, "geoms", [geometry])
+        structure.append([1 + len(part.interiors) for part in parts])
+        for part in parts:
+            for ring in [part.exterior] + list(part.interiors):
+                rings.append(np.asarray(ring.coords)[:-1, 0:2])
+
+    # identify equal vertices by id
+    lengths = [len(ring) for ring in rings]
+    coords = np.concatenate(rings) if rings else np.zeros((0, 2))
+    points, ids = np.unique(np.round(coords, 9), axis=0, return_inverse=True)
+    ring_ids = []
+    for ring in np.split(ids.ravel(), np.cumsum(lengths)[:-1]):
+        ring = ring[np.concatenate([[True], ring[1:] != ring[:-1]])]
+        if (len(ring) > 1) and (ring[0] == ring[-1]):
+            ring = ring[:-1]
+        ring_ids.append(ring)
+
+    # junctions have more than two distinct neighbours
+    neighbours = np.concatenate([np.column_stack([ring, np.roll(ring, shift)])
+                                 for ring in ring_ids for shift in [1, -1]]
+                                or [np.zeros((0, 2), dtype=int)])
+    neighbours = np.unique(neighbours, axis=0)
+    junction = np.bincount(neighbours[:, 0], minlength=len(points)) > 2
+
+    arcs, arc_ids = [], {}
+    def add_arc(arc):
+        forward, backward = tuple(arc), tuple(arc[::-1])
+        key = min(forward, backward)
+        if key not in arc_ids:
+            arc_ids[key] = len(arcs)
+            arcs.append(np.array(key))
+        return (arc_ids[key], key != forward)
+
+    ring_arcs = []
+    for ring in ring_ids:
+        cuts = np.nonzero(junction[ring])[0]
+        if len(cuts) == 0:
+            # closed arc, starting at its smallest point id
+            ring = np.roll(ring, -int(np.argmin(ring)))
+            ring_arcs.append([add_arc(np.append(ring, ring[0]))])
+        else:
+            ring = np.roll(ring, -int(cuts[0]))
+            ring = np.append(ring, ring[0])
+            cuts = np.append(cuts - cuts[0], len(ring) - 1)
+            ring_arcs.append([add_arc(ring[start:end + 1])
+                              for start, end in zip(cuts[:-1], cuts[1:])])
+
+    nested, position = [], 0
+    for part_sizes in structure:
+        parts = []
+        for n_rings in part_sizes:
+            parts.append(ring_arcs[position:position + n_rings])
+            position += n_rings
+        nested.append(parts)
+
+    return {"points": points, "arcs": arcs, "geometries": nested}
+
+def _assemble_ring(arcs, ring):
+    """ Join the coordinates of the arcs of a ring (see build_polygon_topology). """
+    coords = [arcs[arc][::-1] if reverse else arcs[arc] for arc, reverse in ring]
+    # consecutive arcs share their end and start point
+    return np.concatenate([coords[0]] + [c[1:] for c in coords[1:]])
+
+def _topology_polygon(arcs, geometry):
+    """ Build the (Multi)Polygon of a geometry of a topology from its arcs
+        (see build_polygon_topology). """
+    parts = []
+    for part in geometry:
+        rings = [_assemble_ring(arcs, ring) for ring in part]
+        parts.append(shapely.Polygon(rings[0], rings[1:]))
+    return parts[0] if len(parts) == 1 else shapely.MultiPolygon(parts)
+
+def simplify_topology(topology, tolerance, decimals):
+    """ Simplify the polygons of a topology and round their coordinates,
+        such that neighbouring polygons keep sharing their edges.
+
+    params
+    ------
+    topology: the dict returned by build_polygon_topology, with lon/lat
+              coordinates.
+    tolerance: the maximum distance (in meters) between the original
+               and the simplified arcs, 0 to not simplify.
+    decimals: the number of decimals to round the coordinates to.
+
+    notes
+    -----
+    Every arc is simplified once, with the Douglas-Peucker algorithm, 
+    which keeps its end points and does not let the arc cross itself. 
+    Since the junctions of the polygons are the end points of the arcs,
+    shared edges stay shared. Arcs are simplified independently, so the
+    arcs of a polygon may still cross each other: the arcs of polygons 
+    that are not valid after simplifying are reverted to the original 
+    (rounded) arcs, until all polygons are valid or use their original
+    arcs.
+
+    return
+    ------
+    tuple of (xs, ys) in the format of geometry_to_multi_polygons.
+    """
+    points = topology["points"]
+    # simplify in (approximately) meters
+    lat = points[:, 1].mean() if len(points) > 0 else 0
+    scale = np.array([111320 * np.cos(np.radians(lat)), 111320])
+    lines = [shapely.linestrings(points[arc] * scale) for arc in topology["arcs"]]
+    if tolerance > 0:
+        lines = shapely.simplify(lines, tolerance, preserve_topology=True)
+
+    def round_arc(coords):
+        coords = np.round(coords, decimals)
+        # drop points that are equal to the next one, keeping the end point
+        return coords[np.append(np.any(coords[:-1] != coords[1:], axis=1), True)]
+
+    arcs = [round_arc(shapely.get_coordinates(line) / scale) for line in lines]
+    original = np.zeros(len(arcs), dtype=bool)
+
+    def revert(geometry):
+        for part in geometry:
+            for ring in part:
+                for arc, _ in ring:
+                    arcs[arc] = round_arc(points[topology["arcs"][arc]])
+                    original[arc] = True
+
+    # reverting the arcs of a polygon changes its neighbours as well
+    changed = True
+    while changed:
+        changed = False
+        for geometry in topology["geometries"]:
+            ids = [arc for part in geometry for ring in part for arc, _ in ring]
+            if original[ids].all():
+                continue
+            rings = [_assemble_ring(arcs, ring) for part in geometry for ring in part]
+            if (any(len(np.unique(ring, axis=0)) < 3 for ring in rings) 
+                    or not _topology_polygon(arcs, geometry).is_valid):
+                revert(geometry)
+                changed = True
+
+    xs, ys = [], []
+    for geometry in topology["geometries"]:
+        coords = [[_assemble_ring(arcs, ring) for ring in part] for part in geometry]
+        xs.append([[ring[:, 0].tolist() for ring in part] for part in coords])
+        ys.append([[ring[:, 1].tolist() for ring in part] for part in coords])
+    return xs, ys
+
+def build_map_levels(geometries, tolerances=MAP_SIMPLIFICATION_LEVELS):
+    """ Precompute simplified versions of polygons for several zoom levels.
+
+    params
+    ------
+    geometries: array or pd.Series of Polygon or MultiPolygon objects in
+                lon/lat coordinates.
+    tolerances: the simplification tolerance of every level, in meters.
+
+    notes
+    -----
+    The coordinates of a level are rounded to the decimals that keep the
+    rounding error below half its tolerance (but to at least 0.1 m).
+
+    return
+    ------
+    list of dicts, with keys "tolerance", "xs" and "ys" (see 
+    simplify_topology), in the order of tolerances.
+    """
+    topology = build_polygon_topology(geometries)
+    levels = []
+    for tolerance in tolerances:
+        decimals = int(np.ceil(-np.log10(max(tolerance, 0.2) / 2.0 / 111320)))
+        xs, ys = simplify_topology(topology, tolerance, decimals)
+        levels.append({"tolerance": tolerance, "xs": xs, "ys": ys})
+    return levels
+
+def select_map_level(levels, meters_per_pixel):
+    """ Select the coarsest level (see build_map_levels) whose tolerance 
+        does not exceed one pixel.
+
+    return
+    ------
+    the index of the level in levels.
+    """
+    fitting = [i for i, level in enumerate(levels) 
+               if level["tolerance"] <= meters_per_pixel]
+    if not fitting:
+        return int(np.argmin([level["tolerance"] for level in levels]))
+    return max(fitting, key=lambda i: levels[i]["tolerance"])
+
+def get_meters_per_pixel(x_start, x_end, width, lat):
+    """ Get the number of meters per pixel of a map that shows x_start to
+        x_end (Web Mercator, like the ranges of a Bokeh GMapPlot) over width
+        pixels, around latitude lat. """
+    return abs(x_end - x_start) * np.cos(np.radians(lat)) / float(width)
+
+def get_gmap_meters_per_pixel(zoom, lat):
+    """ Get the number of meters per pixel of a Google map at a zoom level
+        around latitude lat. """
+    return 156543.03392 * np.cos(np.radians(lat)) / 2.0**zoom
+
+def mercator_to_lonlat(x, y):
+    """ Transform Web Mercator coordinates (like the ranges of a Bokeh
+        GMapPlot) to longitude, latitude. """
+    lon = np.degrees(np.asarray(x, dtype=float) / 6378137.0)
+    lat = np.degrees(2 * np.arctan(np.exp(np.asarray(y, dtype=float) / 6378137.0)) - np.pi / 2)
+    return lon, lat
+
+def _unique_cells(ix, iy):
+    """ Find the distinct cells of arrays of columns and rows.
+
+    return
+    ------
+    tuple of (columns, rows, inverse), where inverse gives the position of
+    every input cell in the distinct cells.
+    """
+    if len(ix) == 0:
+        return ix, iy, np.zeros(0, dtype=np.int64)
+    # a single integer key per cell is much faster to sort than pairs
+    x0, y0 = ix.min(), iy.min()
+    height = iy.max() - y0 + 1
+    keys, inverse = np.unique((ix - x0) * height + (iy - y0), return_inverse=True)
+    return keys // height + x0, keys % height + y0, inverse
+
+def _sum_density_cells(ix, iy, counts):
+    """ Sum the counts of equal cells.
+
+    params
+    ------
+    ix, iy: arrays with the column and row of each cell.
+    counts: array of shape (len(ix), n_types) with the counts per cell.
+
+    return
+    ------
+    tuple of (ix, iy, counts) with every cell once.
+    """
+    ix, iy, inverse = _unique_cells(ix, iy)
+    summed = np.zeros((len(ix), counts.shape[1]), dtype=counts.dtype)
+    np.add.at(summed, inverse, counts)
+    return ix, iy, summed
+
+def _density_level(ix, iy, counts, cell_size):
+    """ Create a level of build_density_grids from the counts per cell. """
+    left, bottom = xy_to_lonlat(ix * float(cell_size), iy * float(cell_size))
+    right, top = xy_to_lonlat((ix + 1) * float(cell_size), (iy + 1) * float(cell_size))
+    return {"cell_size": cell_size, "ix": ix, "iy": iy, "counts": counts,
+            "left": np.asarray(left), "right": np.asarray(right),
+            "bottom": np.asarray(bottom), "top": np.asarray(top)}
+
+def _bin_incidents(incidents, types, cell_size):
+    """ Count incidents per type in square cells of cell_size meters.
+
+    return
+    ------
+    tuple of (ix, iy, counts), see _sum_density_cells.
+    """
+    x = incidents["st_x"].values.astype(float)
+    y = incidents["st_y"].values.astype(float)
+    # map the categories rather than every incident to the types
+    incident_types = incidents["dim_incident_incident_type"].astype("category").cat
+    category_idx = np.append(pd.Index(types).get_indexer(
+        incident_types.categories.astype(str)), -1)
+    type_idx = category_idx[incident_types.codes.values]
+    keep = ~(np.isnan(x) | np.isnan(y)) & (type_idx >= 0)
+
+    ix, iy, inverse = _unique_cells(np.floor(x[keep] / cell_size).astype(np.int64),
+                                    np.floor(y[keep] / cell_size).astype(np.int64))
+    counts = np.bincount(inverse * len(types) + type_idx[keep],
+                         minlength=len(ix) * len(types))
+    return ix, iy, counts.reshape(len(ix), len(types)).astype(np.int32)
+
+def build_density_grids(incidents, types, cell_sizes=DENSITY_CELL_SIZES):
+    """ Count the incidents per incident type on grids of square cells of
+        several sizes, from their coordinates (st_x, st_y).
+
+    params
+    ------
+    incidents: DataFrame of incidents.
+    types: the incident types to count, in the order of the counts.
+    cell_sizes: increasing sizes (meters) of the cells, each a multiple of
+                the first one.
+
+    notes
+    -----
+    The cells are aligned to the origin of RD New, so every cell of a
+    coarser grid consists of whole cells of the finest grid. Only the
+    finest grid is binned from the incidents, the others are summed from
+    it, and only non-empty cells are stored. The bounds of the cells are
+    in lon/lat, for the map.
+
+    return
+    ------
+    list of dicts (one per cell size), with keys "cell_size", "ix" and
+    "iy" (the column and row of each cell), "counts" (array of shape 
+    (n_cells, len(types))) and "left", "right", "bottom" and "top".
+    """
+    ix, iy, counts = _bin_incidents(incidents, types, cell_sizes[0])
+    return _build_density_levels(ix, iy, counts, cell_sizes)
+
+def _build_density_levels(ix, iy, counts, cell_sizes):
+    """ Create the levels of build_density_grids from the counts of the
+        finest grid. """
+    grids = []
+    for cell_size in cell_sizes:
+        factor = cell_size // cell_sizes[0]
+        if factor > 1:
+            level_ix, level_iy, level_counts = _sum_density_cells(ix // factor, iy // factor,
+                                                                  counts)
+        else:
+            level_ix, level_iy, level_counts = ix, iy, counts
+        grids.append(_density_level(level_ix, level_iy, level_counts, cell_size))
+    return grids
+
+def update_density_grids(grids, new_incidents, types):
+    """ Add incidents to the grids of build_density_grids.
+
+    params
+    ------
+    grids: the list returned by build_density_grids.
+    new_incidents: DataFrame of the incidents to add.
+    types: the incident types to count, which starts with the types of
+           grids (new types are added at the end).
+
+    return
+    ------
+    a new list of grids; the given grids are not modified.
+    """
+    cell_sizes = [grid["cell_size"] for grid in grids]
+    finest = grids[0]
+    counts = np.zeros((len(finest["ix"]), len(types)), dtype=np.int32)
+    counts[:, 0:finest["counts"].shape[1]] = finest["counts"]
+    new_ix, new_iy, new_counts = _bin_incidents(new_incidents, types, cell_sizes[0])
+    ix, iy, counts = _sum_density_cells(np.concatenate([finest["ix"], new_ix]),
+                                        np.concatenate([finest["iy"], new_iy]),
+                                        np.concatenate([counts, new_counts]))
+    return _build_density_levels(ix, iy, counts, cell_sizes)
+
+def select_density_level(grids, meters_per_pixel, min_pixels=DENSITY_MIN_CELL_PIXELS):
+    """ Select the finest grid (see build_density_grids) whose cells are at
+        least min_pixels wide on the map, or the coarsest grid.
+
+    return
+    ------
+    the index of the grid in grids.
+    """
+    for i, grid in enumerate(grids):
+        if grid["cell_size"] >= min_pixels * meters_per_pixel:
+            return i
+    return len(grids) - 1
+
+def density_grid_data(grid, all_types, types, bounds=None):
+    """ Get the cells of a density grid to show on the map.
+
+    params
+    ------
+    grid: a grid of build_density_grids.
+    all_types: the incident types that the grid counts, in order.
+    types: the incident types to include.
+    bounds: optional (lon_start, lon_end, lat_start, lat_end) of the part
+            of the map to get the cells of.
+
+    return
+    ------
+    dict of np.ndarrays with keys "left", "right", "bottom", "top" and
+    "count" of the non-empty cells.
+    """
+    type_idx = pd.Index(all_types).get_indexer(types)
+    count = grid["counts"][:, type_idx[type_idx >= 0]].sum(axis=1)
+    keep = count > 0
+    if bounds is not None:
+        lon_start, lon_end, lat_start, lat_end = bounds
+        keep &= (grid["right"] >= lon_start) & (grid["left"] <= lon_end) & \
+                (grid["top"] >= lat_start) & (grid["bottom"] <= lat_end)
+    data = {key: grid[key][keep] for key in ["left", "right", "bottom", "top"]}
+    data["count"] = count[keep].astype(float)
+    return data
+
+def build_incident_count_cube(incidents, locations, types):
+    """ Count the incidents per location, incident type, hour of day,
+        day of week and month, so that the incident rates for the map can
+        be obtained without going over the incidents again.
+
+    params
+    ------
+    incidents: DataFrame of incidents, as returned by 
+               load_and_preprocess_incidents.
+    locations: array of location ids (hub_vak_bk) that make up the first
+               axis of the cube. Incidents at other locations are ignored.
+    types: array of incident types that make up the second axis of 
+           the cube. Incidents of other types are ignored.
+
+    notes
+    -----
+    The counts are stored in the smallest unsigned integer type that fits
+    the largest count.
+
+    return
+    ------
+    dict with keys:
+        "counts": np.ndarray of shape (n_locations, n_types, 24, 7, 12),
+        "totals": the counts summed over the time axes, shape 
+                  (n_locations, n_types),
+        "marginals": dict with, for every time unit in {'hour', 'day',
+                     'month'}, the counts summed over the other time axes,
+                     e.g., shape (n_locations, n_types, 24) for 'hour',
+        "locations": the location ids along the first axis,
+        "types": the incident types along the second axis.
+    """
+    shape = (len(locations), len(types), 24, 7, 12)
+
+    loc_idx = pd.Index(locations).get_indexer(incidents["hub_vak_bk"])
+    type_idx = pd.Index(types).get_indexer(incidents["dim_incident_incident_type"])
+    hour = incidents["dim_tijd_uur"].values
+    weekday = incidents["day_name"].cat.codes.values
+    month = incidents["month"].cat.codes.values
+    keep = (loc_idx >= 0) & (type_idx >= 0) & (weekday >= 0) & (month >= 0)
+
+    flat = np.ravel_multi_index((loc_idx[keep], type_idx[keep], hour[keep],
+                                 weekday[keep], month[keep]), shape)
+    cells, cell_counts = np.unique(flat, return_counts=True)
+
+    max_count = cell_counts.max() if len(cell_counts) > 0 else 0
+    counts = np.zeros(np.prod(shape), dtype=np.min_scalar_type(max_count))
+    counts[cells] = cell_counts
+    return _cube_from_counts(counts.reshape(shape), locations, types)
+
+def _cube_from_counts(counts, locations, types):
+    """ Create the count cube (see build_incident_count_cube) from its counts. """
+    return {"counts": counts,
+            "totals": counts.sum(axis=(2, 3, 4), dtype=np.int64),
+            "marginals": {"hour": counts.sum(axis=(3, 4), dtype=np.int64),
+                          "day": counts.sum(axis=(2, 4), dtype=np.int64),
+                          "month": counts.sum(axis=(2, 3), dtype=np.int64)},
+            "locations": np.asarray(locations),
+            "types": np.asarray(types)}
+
+def update_incident_count_cube(cube, new_incidents, locations=None, types=None,
+                               in_place=False):
+    """ Add incidents to a count cube.
+
+    params
+    ------
+    cube: the dict returned by build_incident_count_cube.
+    new_incidents: DataFrame of the incidents to add.
+    locations: the location ids along the first axis of the new cube, 
+               defaults to those of cube. Locations that are not in cube
+               start at zero.
+    types: the incident types along the second axis of the new cube,
+           defaults to those of cube. Types that are not in cube start 
+           at zero.
+    in_place: whether to add the incidents to the arrays of cube, rather
+              than to copies of them, so that users of cube see them too.
+              The arrays must be writeable, and must not be read while
+              they are updated, since they are updated one by one.
+
+    notes
+    -----
+    The counts are stored in a larger integer type if they no longer fit.
+    Then, and if the locations or types change, a new cube is returned
+    even if in_place is set.
+
+    return
+    ------
+    a new count cube (see build_incident_count_cube).
+    """
+    locations = cube["locations"] if locations is None else np.asarray(locations)
+    types = cube["types"] if types is None else np.asarray(types)
+    added = build_incident_count_cube(new_incidents, locations, types)["counts"]
+
+    max_count = cube["counts"].max() if cube["counts"].size > 0 else 0
+    dtype = np.promote_types(cube["counts"].dtype,
+                             np.min_scalar_type(int(max_count) + int(added.max(initial=0))))
+    same_axes = (len(locations) == len(cube["locations"])) and \
+                np.all(locations == cube["locations"]) and \
+                (len(types) == len(cube["types"])) and np.all(types == cube["types"])
+    if same_axes and in_place and (dtype == cube["counts"].dtype):
+        updates = [(cube["counts"], added),
+                   (cube["totals"], added.sum(axis=(2, 3, 4), dtype=np.int64))]
+        updates += [(cube["marginals"][unit], added.sum(axis=axes, dtype=np.int64))
+                    for unit, axes in [("hour", (3, 4)), ("day", (2, 4)), ("month", (2, 3))]]
+        for array, counts in updates:
+            array += counts
+        return cube
+    if same_axes:
+        counts = cube["counts"].astype(dtype)
+    else:
+        counts = np.zeros(added.shape, dtype=dtype)
+        loc_idx = pd.Index(locations).get_indexer(cube["locations"])
+        type_idx = pd.Index(types).get_indexer(cube["types"])
+        old_locs, old_types = np.nonzero(loc_idx >= 0)[0], np.nonzero(type_idx >= 0)[0]
+        counts[np.ix_(loc_idx[old_locs], type_idx[old_types])] = \
+            cube["counts"][np.ix_(old_locs, old_types)]
+
+    counts += added
+    return _cube_from_counts(counts, locations, types)
+
+def cube_incident_rates(cube, types, time_unit=None, value=None):
+    """ Get the number of incidents per location from the count cube.
+
+    params
+    ------
+    cube: the dict returned by build_incident_count_cube.
+    types: the incident types that should be included.
+    time_unit: the time unit to filter on, one of {'hour', 'day', 'month'},
+               or None to include all incidents.
+    value: the value of the time_unit that should be kept, with the same
+           meaning as in filter_on_slider_value.
+
+    return
+    ------
+    np.ndarray with the number of incidents per location, in the order
+    of cube["locations"].
+    """
+    type_idx = pd.Index(cube["types"]).get_indexer(types)
+    type_idx = type_idx[type_idx >= 0]
+
+    if time_unit is None:
+        return cube["totals"][:, type_idx].sum(axis=1)
+    elif time_unit == "hour":
+        counts = cube["counts"][:, :, value, :, :]
+    elif time_unit == "day":
+        counts = cube["counts"][:, :, :, value - 1, :]
+    elif time_unit == "month":
+        counts = cube["counts"][:, :, :, :, value - 1]
+    else:
+        raise ValueError("Invalid time_unit: must be one of {'hour', 'day', 'month'}")
+
+    # select the types only after slicing the time axis to keep the copy small
+    return counts[:, type_idx].sum(axis=(1, 2, 3), dtype=np.int64)
+
+def cube_animation_frames(cube, types, time_unit):
+    """ Get the number of incidents per location for every value of 
+        a time unit at once, i.e., all frames of the map animation.
+
+    params
+    ------
+    cube: the dict returned by build_incident_count_cube.
+    types: the incident types that should be included.
+    time_unit: the time unit to animate, one of {'hour', 'day', 'month'}.
+
+    return
+    ------
+    np.ndarray of shape (n_frames, n_locations), where row i holds the 
+    incident rates for the i'th value of time_unit (i.e., hour i, or 
+    day/month number i+1), in the order of cube["locations"].
+    """
+    if time_unit not in cube["marginals"]:
+        raise ValueError("Invalid time_unit: must be one of {'hour', 'day', 'month'}")
+
+    type_idx = pd.Index(cube["types"]).get_indexer(types)
+    type_idx = type_idx[type_idx >= 0]
+    return cube["marginals"][time_unit][:, type_idx, :].sum(axis=1).T
+
+
+def _build_row_index(values):
+    """ Build lists of the rows that hold each distinct value.
+
+    params
+    ------
+    values: pd.Series to index.
+
+    return
+    ------
+    dict with keys "values" (the sorted distinct values), "rows" and 
+    "offsets", such that rows[offsets[i]:offsets[i+1]] are the (sorted)
+    positions of the rows holding values[i].
+    """
+    codes, uniques = pd.factorize(values, sort=True)
+    rows = np.argsort(codes, kind="stable")
+    # missing values have code -1 and come first
+    rows = rows[np.sum(codes < 0):]
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    dtype = np.int32 if len(values) < np.iinfo(np.int32).max else np.int64
+    return {"values": np.asarray(uniques),
+            "rows": rows.astype(dtype),
+            "offsets": np.concatenate([[0], np.cumsum(counts)])}
+
+def build_incident_index(incidents):
+    """ Build an index of the incidents per incident type and per location,
+        to filter on types and locations without scanning the incidents.
+
+    params
+    ------
+    incidents: DataFrame of incidents, as returned by 
+               load_and_preprocess_incidents.
+
+    return
+    ------
+    dict with keys "type" and "location" holding the row index (see
+    _build_row_index) of the incident types and the location ids 
+    (hub_vak_bk), and "n_rows", the number of incidents.
+    """
+    return {"type": _build_row_index(incidents["dim_incident_incident_type"]),
+            "location": _build_row_index(incidents["hub_vak_bk"]),
+            "n_rows": len(incidents)}
+
+def _merge_row_indexes(row_index, new_row_index, offset):
+    """ Merge the row index of appended rows into that of the rows 
+        before them, see update_incident_index. """
+    values = pd.Index(row_index["values"]).union(pd.Index(new_row_index["values"]))
+    counts = np.zeros(len(values), dtype=np.int64)
+    new_counts = np.zeros(len(values), dtype=np.int64)
+    old_pos = values.get_indexer(row_index["values"])
+    new_pos = values.get_indexer(new_row_index["values"])
+    counts[old_pos] = np.diff(row_index["offsets"])
+    new_counts[new_pos] = np.diff(new_row_index["offsets"])
+
+    offsets = np.concatenate([[0], np.cumsum(counts + new_counts)])
+    n_rows = offset + len(new_row_index["rows"])
+    dtype = np.int32 if n_rows < np.iinfo(np.int32).max else np.int64
+    rows = np.empty(offsets[-1], dtype=dtype)
+    # the rows of every value: first those before the new rows, then the new ones
+    for i, pos in enumerate(old_pos):
+        rows[offsets[pos]:offsets[pos] + counts[pos]] = \
+            row_index["rows"][row_index["offsets"][i]:row_index["offsets"][i + 1]]
+    for i, pos in enumerate(new_pos):
+        start = offsets[pos] + counts[pos]
+        rows[start:start + new_counts[pos]] = offset + \
+            new_row_index["rows"][new_row_index["offsets"][i]:new_row_index["offsets"][i + 1]]
+
+    return {"values": np.asarray(values), "rows": rows, "offsets": offsets}
+
+def update_incident_index(index, new_incidents):
+    """ Add incidents that are appended to the indexed incidents 
+        (see append_incidents) to the index.
+
+    params
+    ------
+    index: the dict returned by build_incident_index.
+    new_incidents: DataFrame of the appended incidents.
+
+    notes
+    -----
+    The rows of the existing index are copied rather than sorted again. 
+    The index is not modified, since it may be in use.
+
+    return
+    ------
+    a new index (see build_incident_index) of all incidents.
+    """
+    new_index = build_incident_index(new_incidents)
+    return {"type": _merge_row_indexes(index["type"], new_index["type"], index["n_rows"]),
+            "location": _merge_row_indexes(index["location"], new_index["location"],
+                                           index["n_rows"]),
+            "n_rows": index["n_rows"] + new_index["n_rows"]}
+
+def select_incident_rows(index, types=None, locations=None, time_range=None):
+    """ Get the positions of the incidents of the given types at the
+        given locations from the index.
+
+    params
+    ------
+    index: the dict returned by build_incident_index.
+    types: the incident types to select, or None to select all types.
+    locations: the location ids to select, or None to select all locations.
+    time_range: slice of the rows to select from (see 
+                get_time_range_rows), or None to select from all rows.
+
+    notes
+    -----
+    The rows of the selected values of a column are OR-ed; if both types
+    and locations are given, the results are AND-ed by looking up the
+    rows of the (usually much smaller) location selection in a bitmap of
+    the selected types. Since the rows are sorted, those in time_range
+    are found by binary search.
+
+    return
+    ------
+    sorted np.ndarray of row positions, or None if all rows (in 
+    time_range) are selected.
+    """
+    rows = None
+    for key, values in (("location", locations), ("type", types)):
+        if values is None:
+            continue
+
+        row_index = index[key]
+        positions = np.unique(pd.Index(row_index["values"]).get_indexer(values))
+        positions = positions[positions >= 0]
+        if len(positions) == len(row_index["values"]):
+            continue # selects every row
+
+        selected = [row_index["rows"][row_index["offsets"][i]:row_index["offsets"][i + 1]]
+                    for i in positions]
+        if len(selected) == 0:
+            return np.array([], dtype=np.int64)
+        elif rows is None:
+            rows = np.sort(np.concatenate(selected))
+            if time_range is not None:
+                rows = rows[np.searchsorted(rows, time_range.start):
+                            np.searchsorted(rows, time_range.stop)]
+        else:
+            bitmap = np.zeros(index["n_rows"], dtype=bool)
+            for selected_rows in selected:
+                bitmap[selected_rows] = True
+            rows = rows[bitmap[rows]]
+
+    return rows
+
+def _filter_incidents(dfi, types, locations, index=None, time_range=None):
+    """ Filter incidents on time, types and locations, see 
+        aggregate_data_for_time_series.
+
+    return
+    ------
+    tuple of (the incidents in time_range, which is a view of dfi, and 
+    those of them with the given types and locations).
+    """
+    if time_range is not None:
+        dfi = dfi.iloc[time_range]
+    if index is not None:
+        rows = select_incident_rows(index, types, locations, time_range)
+        if rows is None:
+            return dfi, dfi
+        # the positions of the rows within the time range
+        return dfi, dfi.take(rows if time_range is None else rows - time_range.start)
+
+    dfi_filtered = dfi[dfi["dim_incident_incident_type"].isin(types)]
+    if locations is not None:
+        dfi_filtered = dfi_filtered[dfi_filtered["hub_vak_bk"].isin(locations)]
+    return dfi, dfi_filtered
+
 def aggregate_data_for_time_series(dfi, agg, pattern, 
-                                   group, types, locations):
+                                   group, types, locations, index=None, time_range=None):
     """ Aggregate incident data to show the desired pattern.
 
     Params
@@ -169,6 +1721,13 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
                  length to be investigated / plotted.
     groupby_col: column to group (color) by.
     types: the incident types that should be included in the plot.
+    locations: the location ids that should be included in the plot,
+               or None to include all locations.
+    index: optional index of dfi (see build_incident_index) to select
+           the types and locations with.
+    time_range: slice of the rows of dfi to include (see 
+                get_time_range_rows), or None to include all rows. The
+                time units are averaged over the range only.
 
     Return
     ------
@@ -197,8 +1756,14 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
         in df['x'] is a tuple of (df[i, xcols[0]], df[i, xcols[1]], ...).
         """ 
 
+        # zero-padded labels for the integer time units
+        for col in xcols:
+            if col in ("hour", "day_nr", "week_nr"):
+                df[col] = df[col].astype(str).str.zfill(2)
+
         if len(xcols)>1:
-            df['x'] = df.apply(lambda x: tuple(x[col] for col in xcols), axis=1)
+            # build the tuples column-wise rather than row by row
+            df['x'] = list(zip(*[df[col].tolist() for col in xcols]))
         else:
             df['x'] = df[xcols[0]]
 
@@ -223,10 +1788,7 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
     agg_cols = agg_mapping[agg]
     groupby_col = group_mapping[group]
 
-    # filter on types and locations
-    dfi_filtered = dfi[np.isin(dfi["dim_incident_incident_type"],types)]
-    if locations is not None:
-        dfi_filtered = dfi_filtered[np.isin(dfi_filtered["hub_vak_bk"], locations)]
+    dfi, dfi_filtered = _filter_incidents(dfi, types, locations, index, time_range)
     
     # adjust columns if difference in unit is bigger than one
     if (agg == "Hour") & (pattern == "Weekly"):
@@ -243,7 +1805,7 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
     # wrangle data
     if groupby_col:
         if np.isin(groupby_col, agg_cols+pattern_cols):
-            new_index = dfi.groupby(pattern_cols+agg_cols)["dim_incident_id"].count().index
+            new_index = create_time_index(dfi, pattern_cols+agg_cols)
             cols_first_grouping = new_index.names
         else:
             new_index = create_complete_index(dfi, 
@@ -254,14 +1816,14 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
             new_index.names = cols_first_grouping
 
         grouped = dfi_filtered \
-                    .groupby(cols_first_grouping) \
+                    .groupby(cols_first_grouping, observed=True) \
                     ["dim_incident_id"] \
                     .count() \
                     .reindex(new_index, fill_value=0) \
                     .reset_index()
 
         grouped = grouped \
-                    .groupby(agg_cols + groupby_col) \
+                    .groupby(agg_cols + groupby_col, observed=True) \
                     ["dim_incident_id"] \
                     .mean() \
                     .reset_index()
@@ -270,7 +1832,7 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
         grouped = add_x_column(grouped, agg_cols)
 
         grouped = grouped \
-                    .groupby(groupby_col) \
+                    .groupby(groupby_col, observed=True) \
                     .apply(lambda x: (x["x"].tolist(), 
                                       x["dim_incident_id"].tolist(),
                                       x.name)) \
@@ -281,21 +1843,17 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
         labels = grouped["labels"].tolist()
 
     else:
-        new_index = dfi \
-                        .groupby(pattern_cols+agg_cols) \
-                        ["dim_incident_id"] \
-                        .count() \
-                        .index
+        new_index = create_time_index(dfi, pattern_cols+agg_cols)
 
         grouped = dfi_filtered \
-                    .groupby(pattern_cols+agg_cols) \
+                    .groupby(pattern_cols+agg_cols, observed=True) \
                     ["dim_incident_id"] \
                     .count() \
                     .reindex(new_index, fill_value=0) \
                     .reset_index()
 
         grouped = grouped \
-                    .groupby(agg_cols) \
+                    .groupby(agg_cols, observed=True) \
                     ["dim_incident_id"] \
                     .mean() \
                     .reset_index()
@@ -312,6 +1870,343 @@ def aggregate_data_for_time_series(dfi, agg, pattern,
 
     return x, y, labels
 
+def get_time_series_lines(x, y, labels, group_by):
+    """ Get the lines that the time series plot shows of a result of
+        aggregate_data_for_time_series.
+
+    notes
+    -----
+    At most 11 groups are shown (see get_colors). The lines of all groups
+    are aligned to the x values of the first one, which are the factors of
+    the plot, and are NaN where a group has no value.
+
+    return
+    ------
+    tuple of (factors, 2D np.ndarray with the y values of every line at
+    the factors, colors of the lines, labels of the lines).
+    """
+    if group_by == "None":
+        return list(x), np.asarray(y, dtype=float).reshape(1, -1), ["green"], \
+               ["avg incident count"]
+
+    colors, ngroups = get_colors(len(labels))
+    factors = list(x[0]) if ngroups > 0 else []
+    ys = np.full((ngroups, len(factors)), np.nan)
+    positions = None
+    for i in range(ngroups):
+        if list(x[i]) == factors:
+            ys[i] = y[i]
+            continue
+        if positions is None:
+            positions = {factor: j for j, factor in enumerate(factors)}
+        for factor, value in zip(x[i], y[i]):
+            if factor in positions:
+                ys[i, positions[factor]] = value
+    return factors, ys, list(colors), list(labels[0:ngroups])
+
+def downsample_min_max(ys, n_buckets):
+    """ Downsample lines with shared x values for plotting, by keeping the 
+        minimum and maximum of every line in each of n_buckets buckets of
+        consecutive x values, in the order in which they occur.
+
+    params
+    ------
+    ys: 2D np.ndarray with the y values of every line (see 
+        get_time_series_lines), NaN for missing values.
+    n_buckets: the number of buckets, e.g., half the width of the plot in 
+               pixels, so that the downsampled lines look the same.
+
+    notes
+    -----
+    The values are shown at the first and last x value of their bucket, 
+    so that all lines share 2 * n_buckets x values. Lines with at most
+    that many values are not downsampled.
+
+    return
+    ------
+    tuple of (the positions of the x values that are shown, 2D np.ndarray
+    with the y values of every line at those positions).
+    """
+    ys = np.asarray(ys, dtype=float)
+    n_lines, n = ys.shape
+    if n <= 2 * n_buckets:
+        return np.arange(n), ys
+
+    bounds = np.linspace(0, n, n_buckets + 1).astype(np.int64)
+    positions = np.empty(2 * n_buckets, dtype=np.int64)
+    positions[0::2], positions[1::2] = bounds[:-1], bounds[1:] - 1
+
+    # missing values are neither the minimum nor the maximum, unless all are
+    low = np.where(np.isnan(ys), np.inf, ys)
+    high = np.where(np.isnan(ys), -np.inf, ys)
+    lines = np.arange(n_lines)
+    values = np.empty((n_lines, 2 * n_buckets))
+    for i in range(n_buckets):
+        start, stop = bounds[i], bounds[i + 1]
+        lowest = start + low[:, start:stop].argmin(axis=1)
+        highest = start + high[:, start:stop].argmax(axis=1)
+        values[:, 2 * i] = ys[lines, np.minimum(lowest, highest)]
+        values[:, 2 * i + 1] = ys[lines, np.maximum(lowest, highest)]
+    return positions, values
+
+def get_time_series_window(positions, window, n_factors, first, last):
+    """ Get the window (start, stop) of the full time series from the first
+        to the last shown factor, which may lie outside the shown ones after
+        zooming out or panning.
+
+    params
+    ------
+    positions: the positions in the full time series of the shown factors
+               (see downsample_min_max), offset by the start of window.
+    window: the (start, stop) of the full time series that is shown.
+    n_factors: the number of factors of the full time series.
+    first, last: the first and last shown factor, as positions along the
+                 x-axis, which counts the shown factors.
+
+    return
+    ------
+    tuple of (start, stop), at least one factor wide.
+    """
+    start, stop = window
+    n_shown = len(positions)
+    # beyond the shown factors, they are as far apart as the shown ones on average
+    spacing = (stop - start) / n_shown
+
+    def get_position(i):
+        if i < 0:
+            return start + i * spacing
+        if i >= n_shown:
+            return stop - 1 + (i - n_shown + 1) * spacing
+        return positions[i]
+
+    window_start = min(max(int(np.floor(get_position(first))), 0), n_factors - 1)
+    window_stop = min(max(int(np.floor(get_position(last))) + 1, window_start + 1), n_factors)
+    return window_start, window_stop
+
+def _smallest_uint(max_value):
+    """ Get the smallest unsigned integer type (of at least 8 bits) that
+        holds max_value, which Bokeh sends to the browser as a typed array. """
+    return np.promote_types(np.uint8, np.min_scalar_type(max_value))
+
+def build_client_cube(dfi, types, locations, index=None, time_range=None):
+    """ Count the selected incidents per date, hour and incident type, so
+        that the browser can compute the time series of every feasible 
+        combination of pattern, aggregation and grouping itself (see 
+        iplotcreators.CLIENT_CUBE_JS).
+
+    params
+    ------
+    dfi, types, locations, index, time_range: the incidents and the 
+        selection, like for aggregate_data_for_time_series.
+
+    notes
+    -----
+    The counts are averaged over periods (e.g., dates) in which any 
+    incident occurred, regardless of the selection, which is why the cube
+    also holds the hours with incidents of every date. The columns are
+    small unsigned integers, which Bokeh sends as typed arrays.
+
+    return
+    ------
+    dict with keys:
+        "periods": dict of arrays with an element per date with incidents
+                   in time_range: "year", "week" (number), "month" (0 
+                   for January), "day" (of the month), "weekday" (0 for
+                   Monday) and "hours", a bitmask of the hours with 
+                   incidents (bit 0 for hour 0),
+        "cells": dict of arrays with an element per combination of date 
+                 (position in periods), "hour" and "type" (position in 
+                 types) with selected incidents, and their "count",
+        "types": the selected incident types that occur, sorted.
+    """
+    dfi, dfi_filtered = _filter_incidents(dfi, types, locations, index, time_range)
+
+    # the hours with any incident per date, and a row of every date
+    n_dates = len(dfi["dim_datum_datum"].cat.categories)
+    dates = dfi["dim_datum_datum"].cat.codes.values.astype(np.int64)
+    hours = dfi["hour"].values.astype(np.int64)
+    known = dates >= 0
+    observed = np.bincount(dates[known] * 24 + hours[known],
+                           minlength=n_dates * 24).reshape(n_dates, 24) > 0
+    hour_masks = (observed * (np.uint32(1) << np.arange(24, dtype=np.uint32))).sum(
+        axis=1, dtype=np.uint32)
+    used = np.flatnonzero(hour_masks)
+    rows = np.zeros(n_dates, dtype=np.int64)
+    rows[dates[known]] = np.flatnonzero(known)
+    rows = rows[used]
+    periods = {"year": dfi["dim_datum_jaar"].values[rows].astype(np.uint16),
+               "week": dfi["week_nr"].values[rows].astype(np.uint8),
+               "month": dfi["month"].cat.codes.values[rows].astype(np.uint8),
+               "day": dfi["day_nr"].values[rows].astype(np.uint8),
+               "weekday": dfi["day_name"].cat.codes.values[rows].astype(np.uint8),
+               "hours": hour_masks[used]}
+
+    # count the selected incidents per date, hour and (occurring) type
+    dates = dfi_filtered["dim_datum_datum"].cat.codes.values.astype(np.int64)
+    known = dates >= 0
+    type_codes = dfi_filtered["dim_incident_incident_type"].cat.codes.values[known]
+    occurring = np.flatnonzero(np.bincount(
+        type_codes, minlength=len(dfi_filtered["dim_incident_incident_type"].cat.categories)))
+    type_positions = np.zeros(len(dfi_filtered["dim_incident_incident_type"].cat.categories),
+                              dtype=np.int64)
+    type_positions[occurring] = np.arange(len(occurring))
+    date_positions = np.cumsum(hour_masks > 0) - 1
+    n_types = max(len(occurring), 1)
+    keys = (date_positions[dates[known]] * 24 + 
+            dfi_filtered["hour"].values[known].astype(np.int64)) * n_types + \
+           type_positions[type_codes]
+    keys, counts = np.unique(keys, return_counts=True)
+    cells = {"date": (keys // (24 * n_types)).astype(_smallest_uint(len(used))),
+             "hour": (keys // n_types % 24).astype(np.uint8),
+             "type": (keys % n_types).astype(_smallest_uint(n_types)),
+             "count": counts.astype(_smallest_uint(counts.max(initial=0)))}
+
+    return {"periods": periods, "cells": cells,
+            "types": np.asarray(dfi_filtered["dim_incident_incident_type"]
+                                .cat.categories[occurring]).astype(str)}
+
+def create_lru_cache(max_bytes):
+    """ Create a thread-safe, least-recently-used cache with a memory budget.
+
+    params
+    ------
+    max_bytes: the maximum (estimated) size of the cached values in bytes.
+
+    notes
+    -----
+    Use lru_cache_get and lru_cache_put to read and write the cache, and
+    lru_cache_stats to monitor it.
+
+    return
+    ------
+    dict holding the state of the cache.
+    """
+    return {"entries": OrderedDict(), "nbytes": 0, "max_bytes": max_bytes,
+            "hits": 0, "misses": 0, "evictions": 0, "lock": Lock()}
+
+def _estimate_size(value):
+    """ Estimate the memory used by a (nested) list or tuple of values. """
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(_estimate_size(item) for item in value)
+    return size
+
+def lru_cache_get(cache, key):
+    """ Get a value from an LRU cache and mark it as most recently used.
+
+    params
+    ------
+    cache: the dict returned by create_lru_cache.
+    key: hashable key of the value.
+
+    return
+    ------
+    the cached value, or None if key is not in the cache.
+    """
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+            return cache["entries"][key][0]
+        else:
+            cache["misses"] += 1
+            return None
+
+def lru_cache_put(cache, key, value, evict=True):
+    """ Put a value in an LRU cache, evicting the least recently used
+        values until the cache fits its memory budget again.
+
+    params
+    ------
+    cache: the dict returned by create_lru_cache.
+    key: hashable key of the value.
+    value: the value to cache, it should not be modified afterwards.
+    evict: if False, the value is only put in the cache if it fits in
+           the memory budget without evicting other values.
+
+    return
+    ------
+    True if the value was put in the cache, False otherwise.
+    """
+    nbytes = _estimate_size(value)
+    if nbytes > cache["max_bytes"]:
+        return False # would evict everything else
+
+    with cache["lock"]:
+        replaced = cache["entries"][key][1] if key in cache["entries"] else 0
+        if not evict and (cache["nbytes"] - replaced + nbytes > cache["max_bytes"]):
+            return False
+        if key in cache["entries"]:
+            cache["nbytes"] -= cache["entries"].pop(key)[1]
+        cache["entries"][key] = (value, nbytes)
+        cache["nbytes"] += nbytes
+        while cache["nbytes"] > cache["max_bytes"]:
+            _, (_, evicted_nbytes) = cache["entries"].popitem(last=False)
+            cache["nbytes"] -= evicted_nbytes
+            cache["evictions"] += 1
+    return True
+
+def lru_cache_stats(cache):
+    """ Get the statistics of an LRU cache.
+
+    params
+    ------
+    cache: the dict returned by create_lru_cache.
+
+    return
+    ------
+    dict with the number of hits, misses, evictions and entries and the
+    (estimated) size and memory budget of the cache in bytes.
+    """
+    with cache["lock"]:
+        return {"hits": cache["hits"], "misses": cache["misses"],
+                "evictions": cache["evictions"], "entries": len(cache["entries"]),
+                "nbytes": cache["nbytes"], "max_bytes": cache["max_bytes"]}
+
+# results of aggregate_data_for_time_series, shared by all sessions in the process
+AGGREGATION_CACHE = create_lru_cache(AGGREGATION_CACHE_BUDGET)
+
+def aggregation_cache_key(agg, pattern, group, types, locations, data_version=None,
+                          time_range=None):
+    """ Get the key of a result of aggregate_data_for_time_series in the
+        aggregation cache (see cached_aggregate_data_for_time_series). """
+    return (agg, pattern, group, frozenset(types),
+            None if locations is None else frozenset(locations), data_version,
+            None if time_range is None else (time_range.start, time_range.stop))
+
+def cached_aggregate_data_for_time_series(dfi, agg, pattern, group, types,
+                                          locations, index=None, data_version=None,
+                                          time_range=None, cache=AGGREGATION_CACHE):
+    """ Cached version of aggregate_data_for_time_series.
+
+    params
+    ------
+    See aggregate_data_for_time_series. 
+    data_version: identifies the version of dfi, so that results for older
+                  versions of the data (e.g., before new incidents were
+                  appended) are not used.
+    cache: the LRU cache to use (see create_lru_cache).
+
+    notes
+    -----
+    The results are cached on (agg, pattern, group, types, locations, 
+    data_version, time_range), regardless of the order of types and 
+    locations. They are shared, so the returned lists must not be modified.
+
+    return
+    ------
+    See aggregate_data_for_time_series.
+    """
+    key = aggregation_cache_key(agg, pattern, group, types, locations, data_version,
+                                time_range)
+    result = lru_cache_get(cache, key)
+    if result is None:
+        result = aggregate_data_for_time_series(dfi, agg, pattern, group, types,
+                                                locations, index=index,
+                                                time_range=time_range)
+        lru_cache_put(cache, key, result)
+    return result
+
 def get_colors(n):
     """ Get list of $n$ distinct color codes.
     
@@ -332,6 +2227,35 @@ def get_colors(n):
         cap = np.min([11, n])
         return brewer["Spectral"][cap], cap
 
+def create_time_index(data, cols):
+    """ Create the MultiIndex of time units that incident counts are
+        averaged over.
+
+    params
+    ------
+    data: DataFrame to create the index from.
+    cols: list of column names to include in the index.
+
+    notes
+    -----
+    If cols include the day or month names, the index is the product of
+    all days or months and the observed values of the other columns (which
+    is how pandas groups by ordered categoricals). Otherwise it contains 
+    the observed combinations only. This does not depend on how the other
+    columns are encoded, e.g., as strings or as categoricals.
+
+    return
+    ------
+    a pd.MultiIndex object named after cols.
+    """
+    if ("day_name" in cols) or ("month" in cols):
+        levels = [data[col].cat.categories if col in ("day_name", "month")
+                  else data[col].drop_duplicates().sort_values()
+                  for col in cols]
+        return pd.MultiIndex.from_product(levels, names=cols)
+    else:
+        return data.groupby(cols, observed=True).size().index
+
 def create_complete_index(data, cols, count_col, factors):
     """ Create MultiIndex from the product of every observed 
         combination of data[cols] with factors.
@@ -348,11 +2272,16 @@ def create_complete_index(data, cols, count_col, factors):
     a pd.MultiIndex object with all combinations of the *observed*
     tuples (cols[1], cols[2], ...) and all factors.
     """
-    new_index = data.groupby(cols)[count_col].count().index
-    return pd.MultiIndex.from_tuples(
-        [tuple(unit for unit in time)+(type_,)
-         for time, type_ in product(*[list(new_index), factors])]
-    )
+    new_index = create_time_index(data, cols)
+    if not isinstance(new_index, pd.MultiIndex):
+        new_index = pd.MultiIndex.from_arrays([new_index])
+    # every time tuple is repeated for each factor, in the same order as
+    # a cartesian product of new_index and factors would give
+    n_factors = len(factors)
+    codes = [np.repeat(level_codes, n_factors) for level_codes in new_index.codes]
+    codes.append(np.tile(np.arange(n_factors), len(new_index)))
+    levels = list(new_index.levels) + [pd.Index(factors)]
+    return pd.MultiIndex(levels=levels, codes=codes, verify_integrity=False)
 
 def order_categoricals(df):
     """ Create categoricals and order them logically for 
@@ -395,13 +2324,13 @@ def filter_on_slider_value(data, time_unit, value):
     the filtered DataFrame.
     """
     if time_unit=="hour":
-        return data[data["hour"]==str(value).zfill(2)]
+        return data[data["hour"]==value]
     elif time_unit=="day":
-        mapping = {1:"Mon", 2:"Tue", 3:"Wed", 4:"Thu", 5:"Fri", 6:"Sat", 7:"Sun"}
-        return data[data["day_name"]==mapping[value]]
+        # codes of the ordered categorical: 0 is Monday
+        return data[data["day_name"].cat.codes==value-1]
     elif time_unit=="week":
-        return data[data["week_nr"]==str(value).zfill(2)]
+        return data[data["week_nr"]==value]
     elif time_unit=="month":
-        return data[data["month"]==str(value).zfill(2)]
+        return data[data["dim_datum_maand_nr"]==value]
     else:
-        ValueError("Invalid time_unit: must be one of {'hour', 'day', 'week', 'month'}")
+        raise ValueError("Invalid time_unit: must be one of {'hour', 'day', 'week', 'month'}")
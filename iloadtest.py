@@ -0,0 +1,476 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from ibenchmark import get_data_set, get_version_label
+from isynthetic import parse_size
+
+# the changes that the simulated users make, and their relative frequencies
+LOADTEST_ACTIONS = OrderedDict([("types", 0.3), ("slider", 0.3),
+                                ("selection", 0.2), ("pattern", 0.2)])
+# the models of the dashboard that the sessions use, by name (see main.py)
+LOADTEST_MODELS = ["type_filter", "time_slider", "slider_active_toggle",
+                   "pattern_select", "geo_source", "status"]
+# seconds to wait for the server to respond to a change, after which the session stops
+LOADTEST_TIMEOUT = 60
+# seconds to wait for the server to start, which includes loading the data
+LOADTEST_START_TIMEOUT = 600
+
+def _resolve_buffers(content, buffers):
+    """ Replace the references to binary buffers in the content of a message
+        by the base64 encoded arrays that Document.apply_json_patch reads. """
+    if isinstance(content, dict):
+        if "__buffer__" in content:
+            from bokeh.util.serialization import encode_base64_dict
+            array = np.frombuffer(buffers[content["__buffer__"]], dtype=content["dtype"])
+            return encode_base64_dict(array.reshape(content["shape"]))
+        return {key: _resolve_buffers(value, buffers) for key, value in content.items()}
+    if isinstance(content, list):
+        return [_resolve_buffers(value, buffers) for value in content]
+    return content
+
+def install_client_patches():
+    """ Let bokeh.client apply the changes that the server sends like the
+        browser does.
+
+    notes
+    -----
+    The client of Bokeh 1.x fails on changes with binary buffers, i.e.,
+    numpy arrays, like every update of the map, and on changes of models
+    that it does not have, like the sources that only the callbacks in the
+    browser use, which are skipped. It also replaces the data of a source
+    by the changed columns only, where the browser keeps the other columns.
+    """
+    try:
+        from bokeh.protocol.messages.patch_doc import patch_doc_1
+    except ImportError:
+        return
+
+    def apply_to_document(self, doc, setter=None):
+        buffers = {}
+        for header, payload in self.buffers:
+            header = json.loads(header) if isinstance(header, str) else header
+            buffers[header["id"]] = payload
+        content = _resolve_buffers(self.content, buffers)
+        events = []
+        for event in content["events"]:
+            model = event.get("model", event.get("column_source"))
+            if (event["kind"] != "RootAdded") and (model is not None) and \
+               (doc.get_model_by_id(model["id"]) is None):
+                continue
+            if event["kind"] == "ColumnDataChanged":
+                event["new"] = dict(doc.get_model_by_id(model["id"]).data, **event["new"])
+            events.append(event)
+        content["events"] = events
+        doc.apply_json_patch(content, setter)
+    patch_doc_1.apply_to_document = apply_to_document
+
+def run_session(url, n_actions, seed=0, think_time=0.5, timeout=LOADTEST_TIMEOUT):
+    """ Open a session of the dashboard and change its widgets like a user
+        would, timing how long the server takes to respond to each change.
+
+    params
+    ------
+    url: the url of the dashboard, e.g., 'http://localhost:5006/main'.
+    n_actions: the number of changes to make (see LOADTEST_ACTIONS).
+    seed: the random seed of the changes.
+    think_time: seconds between the response to a change and the next change.
+    timeout: seconds to wait for a response, after which the session stops.
+
+    notes
+    -----
+    A change of the types, the selected polygons or the pattern counts as
+    done when the status shows that the time series is up to date again,
+    which includes the debounce (see main.TIME_SERIES_DEBOUNCE). A tick of
+    the time slider is done when the map has been updated. The first tick
+    activates the slider.
+
+    return
+    ------
+    list of (action, seconds) tuples, starting with ("open", seconds to get
+    the document), where seconds is None if there was no response.
+    """
+    from bokeh.client import pull_session
+    install_client_patches()
+    random = np.random.RandomState(seed)
+    actions = list(LOADTEST_ACTIONS.keys())
+    weights = np.array(list(LOADTEST_ACTIONS.values()))
+
+    start = time.perf_counter()
+    session = pull_session(url=url)
+    results = [("open", time.perf_counter() - start)]
+    doc = session.document
+    models = {name: doc.get_model_by_name(name) for name in LOADTEST_MODELS}
+    if None in models.values():
+        session.close()
+        raise RuntimeError("The dashboard has no models named {}, see the output of "
+                           "the server".format([name for name, model in models.items()
+                                                if model is None]))
+    state = {"action": None, "done": None, "start": None, "timeout": None, "count": 0}
+
+    def time_series_done(event):
+        return (getattr(event, "model", None) is models["status"]) and \
+               (event.attr == "text") and ("calculating" not in event.new)
+
+    def map_done(event):
+        return models["geo_source"] in (getattr(event, "model", None),
+                                        getattr(event, "column_source", None))
+
+    def start_action():
+        action = actions[random.choice(len(actions), p=weights / weights.sum())]
+        state.update(action=action, start=time.perf_counter(), count=state["count"] + 1,
+                     done=map_done if action == "slider" else time_series_done,
+                     timeout=doc.add_timeout_callback(stop_action, timeout * 1000))
+        if action == "types":
+            options = [value for value, _ in models["type_filter"].options]
+            current = set(models["type_filter"].value)
+            new = current
+            while new == current:
+                new = set(random.choice(options, random.randint(1, len(options) + 1),
+                                        replace=False))
+            models["type_filter"].value = sorted(new)
+        elif action == "slider" and not models["slider_active_toggle"].active:
+            models["slider_active_toggle"].active = True
+        elif action == "slider":
+            slider = models["time_slider"]
+            values = [v for v in np.arange(slider.start, slider.end + 1, slider.step)
+                      if v != slider.value]
+            slider.value = int(random.choice(values))
+        elif action == "selection":
+            n_locations = len(models["geo_source"].data["location_id"])
+            models["geo_source"].selected.indices = sorted(
+                int(i) for i in random.choice(n_locations, random.randint(1, 11),
+                                              replace=False))
+        else:
+            select = models["pattern_select"]
+            select.active = int(random.choice([i for i in range(len(select.labels))
+                                               if i != select.active]))
+
+    def stop_action(seconds=None):
+        results.append((state["action"], seconds))
+        state["action"] = None
+        if (seconds is None) or (state["count"] >= n_actions):
+            session.close()
+        else:
+            doc.add_timeout_callback(start_action, think_time * 1000)
+
+    def on_change(event):
+        # only changes from the server have a setter (the session)
+        if (state["action"] is None) or (event.setter is None) or \
+           (not state["done"](event)):
+            return
+        doc.remove_timeout_callback(state["timeout"])
+        stop_action(time.perf_counter() - state["start"])
+
+    doc.on_change(on_change)
+    doc.add_timeout_callback(start_action, think_time * 1000)
+    session.loop_until_closed()
+    return results
+
+def _run_session_in_worker(args):
+    """ Run a session in a worker process of run_level. """
+    url = args[0]
+    try:
+        return run_session(*args)
+    except Exception as e:
+        print("Session of {} failed: {}".format(url, e))
+        return [("open", None)]
+
+def start_resource_monitor(pid, interval=0.5):
+    """ Sample the CPU time and memory use of a process and its children in
+        a background thread, until stop_resource_monitor is called.
+
+    return
+    ------
+    dict holding the state of the monitor, or None if psutil is not installed.
+    """
+    if psutil is None:
+        return None
+    monitor = {"stop": threading.Event(), "cpu": {}, "rss": [],
+               "start": time.perf_counter()}
+
+    def sample():
+        try:
+            parent = psutil.Process(pid)
+            processes = [parent] + parent.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        for process in processes:
+            try:
+                cpu_times = process.cpu_times()
+                rss += process.memory_info().rss
+            except psutil.Error:
+                continue
+            monitor["cpu"].setdefault(process.pid, [cpu_times.user + cpu_times.system])
+            monitor["cpu"][process.pid].append(cpu_times.user + cpu_times.system)
+        monitor["rss"].append(rss)
+
+    def run():
+        while not monitor["stop"].is_set():
+            sample()
+            monitor["stop"].wait(interval)
+        sample()
+
+    sample()
+    monitor["thread"] = threading.Thread(target=run, name="resource-monitor")
+    monitor["thread"].daemon = True
+    monitor["thread"].start()
+    return monitor
+
+def stop_resource_monitor(monitor):
+    """ Stop a resource monitor (see start_resource_monitor).
+
+    return
+    ------
+    dict with the average CPU use (percent of one core) and the mean and
+    maximum resident memory (bytes) of the processes, empty if the monitor
+    is None.
+    """
+    if monitor is None:
+        return OrderedDict()
+    monitor["stop"].set()
+    monitor["thread"].join()
+    seconds = time.perf_counter() - monitor["start"]
+    cpu_seconds = sum(times[-1] - times[0] for times in monitor["cpu"].values())
+    return OrderedDict([("cpu_percent", 100 * cpu_seconds / seconds),
+                        ("rss_mean", float(np.mean(monitor["rss"]))),
+                        ("rss_max", int(np.max(monitor["rss"])))])
+
+def summarize_latencies(results, percentiles=(50, 95, 99)):
+    """ Summarize the latencies of the sessions of a level (see run_level).
+
+    return
+    ------
+    OrderedDict with, for "all" changes (not opening the session) and for
+    every action, the count, the number of timeouts and the percentiles
+    of the latencies in seconds.
+    """
+    by_action = OrderedDict([("all", [])])
+    for action in ["open"] + list(LOADTEST_ACTIONS.keys()):
+        by_action[action] = []
+    for session in results:
+        for action, seconds in session:
+            by_action[action].append(seconds)
+            if action != "open":
+                by_action["all"].append(seconds)
+
+    summary = OrderedDict()
+    for action, latencies in by_action.items():
+        times = [seconds for seconds in latencies if seconds is not None]
+        summary[action] = OrderedDict([("count", len(latencies)),
+                                       ("timeouts", len(latencies) - len(times))])
+        for p in percentiles:
+            summary[action]["p{}".format(p)] = float(np.percentile(times, p)) \
+                                               if times else None
+    return summary
+
+def run_level(url, n_sessions, n_actions, seed=0, think_time=0.5,
+              timeout=LOADTEST_TIMEOUT, server_pid=None):
+    """ Run n_sessions sessions (see run_session) at the same time, each in
+        its own process so that the clients do not slow each other down.
+
+    return
+    ------
+    OrderedDict with the latencies (see summarize_latencies), the wall time
+    and the resource use of the server process (see stop_resource_monitor)
+    if its pid is given.
+    """
+    monitor = start_resource_monitor(server_pid) if server_pid else None
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(n_sessions)
+    try:
+        results = pool.map(_run_session_in_worker,
+                           [(url, n_actions, seed * 100003 + i, think_time, timeout)
+                            for i in range(n_sessions)])
+    finally:
+        pool.close()
+        pool.join()
+    record = OrderedDict([("sessions", n_sessions), ("seconds", time.perf_counter() - start),
+                          ("latency", summarize_latencies(results))])
+    record["server"] = stop_resource_monitor(monitor)
+    return record
+
+def start_server(app_dir, data_dir, port, num_procs=1, log_path=os.devnull, env=None):
+    """ Start a Bokeh server with the dashboard on localhost.
+
+    params
+    ------
+    app_dir: the directory of the dashboard (with main.py).
+    data_dir: the data directory (see idatastore.DATA_DIR).
+    port: the port to serve on.
+    num_procs: the number of server processes.
+    log_path: the file to write the output of the server to.
+    env: optional environment variables, e.g., IDASHBOARD_SHARED_DIR.
+
+    notes
+    -----
+    The server does not check for new incidents, and forgets closed sessions
+    after a second, so that they do not count towards the next level.
+
+    return
+    ------
+    the subprocess.Popen of the server.
+    """
+    server_env = dict(os.environ)
+    server_env.update({"IDASHBOARD_DATA_DIR": os.path.abspath(data_dir),
+                       "IDASHBOARD_INGEST_INTERVAL": "0"})
+    server_env.update(env or {})
+    command = [sys.executable, "-m", "bokeh", "serve", os.path.abspath(app_dir),
+               "--port", str(port), "--num-procs", str(num_procs),
+               "--check-unused-sessions", "1000", "--unused-session-lifetime", "1000"]
+    with open(log_path, "a") as log:
+        return subprocess.Popen(command, env=server_env, stdout=log,
+                                stderr=subprocess.STDOUT)
+
+def wait_for_server(url, process=None, timeout=LOADTEST_START_TIMEOUT):
+    """ Wait until the dashboard can be opened at url.
+
+    notes
+    -----
+    Raises a RuntimeError if the server process exits or does not serve
+    the dashboard within timeout seconds.
+    """
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        from urllib2 import urlopen
+
+    start = time.time()
+    while time.time() - start < timeout:
+        if (process is not None) and (process.poll() is not None):
+            raise RuntimeError("The server exited with code {}".format(process.returncode))
+        try:
+            urlopen(url, timeout=timeout).read()
+            return
+        except (IOError, OSError):
+            time.sleep(1)
+    raise RuntimeError("The server did not serve {} within {} seconds".format(url, timeout))
+
+def stop_server(process):
+    """ Stop a server that was started with start_server. """
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def format_level(record):
+    """ Format the results of a level (see run_level) as a table. """
+    lines = ["{} sessions in {:.1f} seconds".format(record["sessions"], record["seconds"]),
+             "{:<12} {:>6} {:>8} {:>9} {:>9} {:>9}".format(
+                 "action", "count", "timeouts", "p50 ms", "p95 ms", "p99 ms")]
+    for action, summary in record["latency"].items():
+        lines.append("{:<12} {:>6} {:>8} {:>9} {:>9} {:>9}".format(
+            action, summary["count"], summary["timeouts"],
+            *["-" if summary[p] is None else "{:.0f}".format(1000 * summary[p])
+              for p in ["p50", "p95", "p99"]]))
+    if record["server"]:
+        lines.append("server cpu {:.0f}%, rss mean {:.0f} MB, max {:.0f} MB".format(
+            record["server"]["cpu_percent"], record["server"]["rss_mean"] / 2**20,
+            record["server"]["rss_max"] / 2**20))
+    return "\n".join(lines)
+
+def run_load_test(levels, url, n_actions, output, label=None, seed=0, think_time=0.5,
+                  timeout=LOADTEST_TIMEOUT, server_pid=None, context=None):
+    """ Run the sessions for every concurrency level and append the results
+        to a file.
+
+    params
+    ------
+    levels: list of the numbers of sessions to run at the same time.
+    url: the url of the dashboard.
+    n_actions: the number of changes every session makes.
+    output: path of the results file, which gets one json object per level.
+    label: the version label to record, defaults to get_version_label().
+    seed, think_time, timeout: see run_session.
+    server_pid: the pid of the server, to record its resource use.
+    context: optional dict to record with the results, e.g., the data size.
+
+    return
+    ------
+    list of the records written to output.
+    """
+    label = label or get_version_label()
+    records = []
+    for i, n_sessions in enumerate(levels):
+        record = OrderedDict([("label", label),
+                              ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                              ("host", platform.node()),
+                              ("actions", n_actions),
+                              ("think_time", think_time)])
+        record.update(context or {})
+        record.update(run_level(url, n_sessions, n_actions, seed=seed + i,
+                                think_time=think_time, timeout=timeout,
+                                server_pid=server_pid))
+        print(format_level(record))
+        records.append(record)
+        with open(output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        # let the server discard the closed sessions
+        time.sleep(3)
+    return records
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the dashboard with "
+                                                 "concurrent simulated sessions.")
+    parser.add_argument("--levels", nargs="+", type=int, default=[1, 5, 10, 20],
+                        help="the numbers of sessions to run at the same time")
+    parser.add_argument("--actions", type=int, default=20,
+                        help="the number of changes every session makes")
+    parser.add_argument("--think-time", type=float, default=0.5,
+                        help="seconds between a response and the next change")
+    parser.add_argument("--timeout", type=float, default=LOADTEST_TIMEOUT)
+    parser.add_argument("--rows", default="100k",
+                        help="the number of synthetic incidents, e.g., 100k or 5M")
+    parser.add_argument("--data-dir", default="benchmark_data",
+                        help="where to keep the synthetic data sets")
+    parser.add_argument("--port", type=int, default=5006)
+    parser.add_argument("--num-procs", type=int, default=1,
+                        help="the number of server processes")
+    parser.add_argument("--url", help="load test a running server instead, e.g., "
+                                      "http://localhost:5006/main")
+    parser.add_argument("--server-log", default="loadtest_server.log")
+    parser.add_argument("--output", default="loadtest_results.jsonl",
+                        help="the file to append the results to")
+    parser.add_argument("--label", help="version label, defaults to git describe")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if psutil is None:
+        print("Install psutil to record the CPU and memory use of the server.")
+    if args.url:
+        run_load_test(args.levels, args.url, args.actions, args.output, label=args.label,
+                      seed=args.seed, think_time=args.think_time, timeout=args.timeout,
+                      context={"url": args.url})
+    else:
+        n_rows = parse_size(args.rows)
+        incident_path, _ = get_data_set(args.data_dir, n_rows, args.seed)
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+        url = "http://localhost:{}/{}".format(args.port, os.path.basename(app_dir))
+        server = start_server(app_dir, os.path.dirname(incident_path), args.port,
+                              num_procs=args.num_procs, log_path=args.server_log)
+        try:
+            print("Waiting for the server at {}".format(url))
+            wait_for_server(url, server)
+            run_load_test(args.levels, url, args.actions, args.output, label=args.label,
+                          seed=args.seed, think_time=args.think_time, timeout=args.timeout,
+                          server_pid=server.pid,
+                          context={"n_rows": n_rows, "num_procs": args.num_procs})
+        finally:
+            stop_server(server)
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import threading
+from functools import wraps
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+# set IDASHBOARD_METRICS=0 to disable the instrumentation of the callbacks
+METRICS_ENABLED = os.environ.get("IDASHBOARD_METRICS", "1") != "0"
+# set IDASHBOARD_TRACK_PAYLOAD=1 to also count the bytes that callbacks send to
+# the browser, which serializes every update once more (see track_payload)
+TRACK_PAYLOAD = os.environ.get("IDASHBOARD_TRACK_PAYLOAD", "0") == "1"
+# file to append every callback's timings to (one json object per line)
+METRICS_LOG = os.environ.get("IDASHBOARD_METRICS_LOG")
+# port on localhost to serve the histograms on (see start_metrics_server)
+METRICS_PORT = os.environ.get("IDASHBOARD_METRICS_PORT")
+
+# upper bounds of the histogram buckets of durations (seconds) and payloads (bytes)
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1, 2, 5, 10, np.inf]
+PAYLOAD_BUCKETS = [2**10, 2**12, 2**14, 2**16, 2**18, 2**20, 2**22, 2**24, np.inf]
+
+# the histograms of this process, see record_value
+_HISTOGRAMS = OrderedDict()
+_HISTOGRAMS_LOCK = threading.Lock()
+_LOG_LOCK = threading.Lock()
+# the traces of the callbacks that are running on a thread, see timed_callback
+_ACTIVE = threading.local()
+
+def create_histogram(bounds):
+    """ Create a histogram with fixed buckets.
+
+    params
+    ------
+    bounds: increasing upper bounds of the buckets, the last one should be
+            np.inf so that every value fits in a bucket.
+
+    return
+    ------
+    dict holding the state of the histogram.
+    """
+    return {"bounds": list(bounds), "counts": [0] * len(bounds),
+            "count": 0, "sum": 0.0, "max": 0.0}
+
+def histogram_add(histogram, value):
+    """ Add a value to a histogram (see create_histogram). """
+    histogram["counts"][int(np.searchsorted(histogram["bounds"], value))] += 1
+    histogram["count"] += 1
+    histogram["sum"] += value
+    histogram["max"] = max(histogram["max"], value)
+
+def histogram_summary(histogram, percentiles=(50, 95, 99)):
+    """ Summarize a histogram.
+
+    notes
+    -----
+    Percentiles are given as the upper bound of the bucket they fall in
+    (or the maximum, for the last bucket), so they overestimate by at most
+    one bucket.
+
+    return
+    ------
+    dict with the count, mean, maximum, percentiles and the non-empty buckets.
+    """
+    count = histogram["count"]
+    summary = OrderedDict([("count", count),
+                           ("mean", histogram["sum"] / count if count else None),
+                           ("max", histogram["max"])])
+    cumulative = np.cumsum(histogram["counts"])
+    for p in percentiles:
+        if count:
+            bucket = int(np.searchsorted(cumulative, count * p / 100.0))
+            summary["p{}".format(p)] = min(histogram["bounds"][bucket], histogram["max"])
+        else:
+            summary["p{}".format(p)] = None
+    summary["buckets"] = [[bound if np.isfinite(bound) else "inf", n]
+                          for bound, n in zip(histogram["bounds"], histogram["counts"]) if n]
+    return summary
+
+def record_value(name, value, bounds=LATENCY_BUCKETS):
+    """ Add a value to the process-wide histogram with the given name,
+        creating it with the given bucket bounds on first use. """
+    with _HISTOGRAMS_LOCK:
+        if name not in _HISTOGRAMS:
+            _HISTOGRAMS[name] = create_histogram(bounds)
+        histogram_add(_HISTOGRAMS[name], value)
+
+def get_metrics():
+    """ Get the summaries (see histogram_summary) of all histograms of this
+        process, by name. """
+    with _HISTOGRAMS_LOCK:
+        return OrderedDict((name, histogram_summary(histogram))
+                           for name, histogram in _HISTOGRAMS.items())
+
+def _active_traces():
+    if not hasattr(_ACTIVE, "traces"):
+        _ACTIVE.traces = []
+    return _ACTIVE.traces
+
+def _add_to_trace(name, seconds):
+    """ Add the duration of a stage to the innermost running trace, if any. """
+    traces = _active_traces()
+    if traces:
+        stages = traces[-1]["stages"]
+        stages[name] = stages.get(name, 0) + seconds
+
+def add_stage(name, seconds):
+    """ Record the duration of a stage of the callback that is running on
+        this thread, e.g., a stage that ran in another thread. """
+    record_value("stage.{}.seconds".format(name), seconds)
+    _add_to_trace(name, seconds)
+
+@contextmanager
+def timed_stage(name):
+    """ Context manager that records the wall time of a stage of the
+        callback that is running on this thread (see timed_callback). """
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage(name, time.perf_counter() - start)
+
+def _write_log(record):
+    """ Append a record to METRICS_LOG. """
+    try:
+        with _LOG_LOCK, open(METRICS_LOG, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except (IOError, OSError) as e:
+        print("Could not write to metrics log {}: {}".format(METRICS_LOG, e))
+
+def timed_callback(name=None, on_finish=None):
+    """ Decorator that records the wall time of a callback and the size
+        of the changes it sends to the browser.
+
+    params
+    ------
+    name: the name to record the callback under, defaults to the
+          name of the function.
+    on_finish: optional function that is called with the trace of the
+               callback when it has finished (see notes).
+
+    notes
+    -----
+    A callback that is called from another timed callback is recorded
+    as a stage of that callback as well. The trace of a callback is a
+    dict with keys "callback", "seconds", "stages" (seconds by stage,
+    see timed_stage), and "payload_bytes", which is only counted if
+    TRACK_PAYLOAD is set, for documents that have been passed to
+    track_payload.
+
+    Traces are added to the histograms "callback.<name>.seconds" and
+    (if TRACK_PAYLOAD) "callback.<name>.bytes", and appended to
+    METRICS_LOG if it is set.
+    """
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        callback_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            traces = _active_traces()
+            trace = {"callback": callback_name, "stages": OrderedDict(),
+                     "payload_bytes": 0}
+            traces.append(trace)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace["seconds"] = time.perf_counter() - start
+                traces.pop()
+                record_value("callback.{}.seconds".format(callback_name), trace["seconds"])
+                if traces:
+                    # nested: part of the outer callback
+                    _add_to_trace(callback_name, trace["seconds"])
+                    traces[-1]["payload_bytes"] += trace["payload_bytes"]
+                else:
+                    if TRACK_PAYLOAD:
+                        record_value("callback.{}.bytes".format(callback_name),
+                                     trace["payload_bytes"], PAYLOAD_BUCKETS)
+                    if METRICS_LOG:
+                        record = OrderedDict([("time", time.time())])
+                        record.update(trace)
+                        _write_log(record)
+                    if on_finish is not None:
+                        on_finish(trace)
+        return wrapper
+    return decorator
+
+def track_payload(doc):
+    """ Count the size of the changes that callbacks make to a document,
+        as it is serialized to be sent to the browser.
+
+    notes
+    -----
+    The changes are serialized once more to count them, so this roughly
+    doubles the serialization cost of every update, and is only done if
+    TRACK_PAYLOAD is set. Changes made by the browser itself, which are
+    not sent back, are not counted.
+    """
+    if not (METRICS_ENABLED and TRACK_PAYLOAD):
+        return
+    try:
+        from bokeh.document.events import DocumentPatchedEvent
+        from bokeh.protocol.messages.patch_doc import process_document_events
+    except ImportError as e:
+        print("Cannot count the payload of updates: {}".format(e))
+        return
+
+    def count_payload(event):
+        traces = _active_traces()
+        # only changes of the models are sent, not, e.g., added callbacks
+        if (not traces) or (not isinstance(event, DocumentPatchedEvent)) or \
+           (event.setter is not None):
+            return
+        patch, buffers = process_document_events([event], use_buffers=True)
+        traces[-1]["payload_bytes"] += len(patch) + \
+                                       sum(len(payload) for _, payload in buffers)
+    doc.on_change(count_payload)
+
+def format_trace(trace):
+    """ Format the latency breakdown of a trace as a short text, e.g.,
+        'update_map: 12 ms (map_rates 3 ms, send_map 8 ms), 1.2 kB',
+        where the payload is only shown if TRACK_PAYLOAD is set. """
+    stages = ", ".join("{} {:.0f} ms".format(stage, 1000 * seconds)
+                       for stage, seconds in trace["stages"].items())
+    return "{}: {:.0f} ms{}{}".format(
+        trace["callback"], 1000 * trace["seconds"],
+        " ({})".format(stages) if stages else "",
+        ", {:.1f} kB".format(trace["payload_bytes"] / 1024.0) if TRACK_PAYLOAD else "")
+
+def start_metrics_server(port):
+    """ Serve the histograms of this process (see get_metrics) as json on
+        http://localhost:<port>/ from a background thread.
+
+    return
+    ------
+    the HTTPServer, or None if the port is not available, e.g., because
+    another server process uses it.
+    """
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(OrderedDict([("pid", os.getpid()),
+                                           ("metrics", get_metrics())]), indent=1)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = HTTPServer(("127.0.0.1", int(port)), MetricsHandler)
+    except (IOError, OSError) as e:
+        print("Could not serve metrics on port {}: {}".format(port, e))
+        return None
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    return server
+
+def run_timed(func, *args, **kwargs):
+    """ Call func with the given arguments and time it, e.g., to time work
+        that runs in another thread than the callback it belongs to.
+
+    return
+    ------
+    tuple of (the result of func, the time.perf_counter() value when it 
+    started, its duration in seconds).
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, start, time.perf_counter() - start
+
+def log_metrics():
+    """ Append the summaries of all histograms of this process to METRICS_LOG. """
+    if METRICS_LOG:
+        _write_log(OrderedDict([("time", time.time()), ("pid", os.getpid()),
+                                ("metrics", get_metrics())]))
@@ -1,24 +1,267 @@
+import os
+
 import numpy as np
 import pandas as pd
 
 from bokeh.models import GeoJSONDataSource, ColumnDataSource, HoverTool, \
                          LogColorMapper, FuncTickFormatter, BasicTickFormatter, \
                          GMapOptions
-from bokeh.models.widgets import RadioButtonGroup, Div, CheckboxGroup, Slider
+from bokeh.models.widgets import RadioButtonGroup, Div, CheckboxGroup, Slider, \
+                                  DateRangeSlider
 from bokeh.models.ranges import FactorRange, DataRange1d, Range1d
 from bokeh.layouts import widgetbox
 from bokeh.plotting import figure, gmap
 from bokeh.palettes import gray
 from bokeh.tile_providers import CARTODBPOSITRON, STAMEN_TERRAIN
 
-from ihelpers import aggregate_data_for_time_series, get_colors
+from idatastore import DATA_DIR
+from ihelpers import cached_aggregate_data_for_time_series, \
+                     get_time_series_lines, downsample_min_max
+
+# the file in the data directory (see idatastore.DATA_DIR) with the Google Maps API key
+MAPS_KEY_FILE = "googlemapskey.txt"
+# colors of the incident rates on the map, from low to high
+MAP_COLORS = ['#f2f2f2', '#fee5d9', '#fcbba1', '#fc9272', '#fb6a4a', '#de2d26']
+
+# computes the time series of a view in the browser from the cube of
+# ihelpers.build_client_cube, with the same result as 
+# ihelpers.aggregate_data_for_time_series (x, y and labels)
+CLIENT_CUBE_JS = """
+function aggregate_cube(cube, pattern, agg, group) {
+    var DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"];
+    var MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                  "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"];
+    var periods = cube.periods, cells = cube.cells;
+    var n_dates = periods.hours.length;
+
+    // the columns of the pattern and aggregation, like on the server
+    var pattern_cols = {"Daily": ["date"], "Weekly": ["year", "week"],
+                        "Yearly": ["year"]}[pattern];
+    var agg_cols = {"Hour": ["hour"], "Day": ["weekday"], "Week": ["week"],
+                    "Month": ["month"]}[agg];
+    var group_col = {"None": null, "Type": "type", "Day of Week": "weekday",
+                     "Year": "year"}[group];
+    if ((agg == "Hour") && (pattern == "Weekly")) {
+        agg_cols = ["weekday", "hour"];
+    } else if ((agg == "Hour") && (pattern == "Yearly")) {
+        agg_cols = ["month", "day", "hour"];
+    } else if ((agg == "Day") && (pattern == "Yearly")) {
+        agg_cols = ["month", "day"];
+    }
+    var cols = pattern_cols.concat(agg_cols);
+    // the result is averaged per aggregation (and group, if that is one
+    // of the columns), other groupings are factors of the incidents
+    var out_cols = agg_cols.slice();
+    var factor = null;
+    if (group_col !== null) {
+        if (cols.indexOf(group_col) >= 0) {
+            out_cols.push(group_col);
+        } else {
+            factor = group_col;
+        }
+    }
+
+    // every value is coded as a small integer, so that a combination of
+    // columns is a (mixed-radix) integer that orders like the values
+    var min_year = Infinity, max_year = -Infinity;
+    for (var i = 0; i < n_dates; i++) {
+        min_year = Math.min(min_year, periods.year[i]);
+        max_year = Math.max(max_year, periods.year[i]);
+    }
+    var sizes = {"date": n_dates, "year": Math.max(max_year - min_year + 1, 1),
+                 "week": 54, "month": 12, "day": 32, "weekday": 7, "hour": 24,
+                 "type": cube.types.length};
+    function code(col, date, hour) {
+        if (col == "date") {
+            return date;
+        } else if (col == "hour") {
+            return hour;
+        } else if (col == "year") {
+            return periods.year[date] - min_year;
+        }
+        return periods[col][date];
+    }
+    function strides(columns) {
+        var result = [], stride = 1;
+        for (var j = columns.length - 1; j >= 0; j--) {
+            result[j] = stride;
+            stride *= sizes[columns[j]];
+        }
+        return result;
+    }
+    function size(columns) {
+        return columns.reduce(function(n, col) { return n * sizes[col]; }, 1);
+    }
+    var col_strides = strides(cols), out_strides = strides(out_cols);
+    var hour_position = cols.indexOf("hour");
+
+    // the combinations of the columns and the values of every column in
+    // which any incident occurred
+    var observed = new Uint8Array(size(cols));
+    var levels = cols.map(function(col) { return new Uint8Array(sizes[col]); });
+    for (var date = 0; date < n_dates; date++) {
+        var mask = periods.hours[date];
+        var key = 0;
+        for (var j = 0; j < cols.length; j++) {
+            if (j != hour_position) {
+                var c = code(cols[j], date, 0);
+                key += c * col_strides[j];
+                levels[j][c] = 1;
+            }
+        }
+        if (hour_position < 0) {
+            observed[key] = 1;
+            continue;
+        }
+        for (var hour = 0; hour < 24; hour++) {
+            if ((mask & (1 << hour)) != 0) {
+                observed[key + hour * col_strides[hour_position]] = 1;
+                levels[hour_position][hour] = 1;
+            }
+        }
+    }
 
-def _create_choropleth_map(source, width=600, height=1000):
+    // the number of periods that every combination of the output columns
+    // is averaged over (see create_time_index): the observed combinations,
+    // or the product of all days or months and the observed other values
+    var counts = new Float64Array(size(out_cols));
+    if ((cols.indexOf("weekday") >= 0) || (cols.indexOf("month") >= 0)) {
+        levels = levels.map(function(level, j) {
+            var all = (cols[j] == "weekday") || (cols[j] == "month");
+            var values = [];
+            for (var v = 0; v < level.length; v++) {
+                if (all || level[v]) {
+                    values.push(v);
+                }
+            }
+            return values;
+        });
+        var n_periods = 1, keys = [0];
+        cols.forEach(function(col, j) {
+            var k = out_cols.indexOf(col);
+            if (k < 0) {
+                n_periods *= levels[j].length;
+                return;
+            }
+            var next = [];
+            keys.forEach(function(key) {
+                levels[j].forEach(function(v) { next.push(key + v * out_strides[k]); });
+            });
+            keys = next;
+        });
+        keys.forEach(function(key) { counts[key] = n_periods; });
+    } else {
+        var out_positions = out_cols.map(function(col) { return cols.indexOf(col); });
+        for (var key = 0; key < observed.length; key++) {
+            if (observed[key]) {
+                var out_key = 0;
+                for (var k = 0; k < out_cols.length; k++) {
+                    var j = out_positions[k];
+                    out_key += (Math.floor(key / col_strides[j]) % sizes[cols[j]]) *
+                               out_strides[k];
+                }
+                counts[out_key] += 1;
+            }
+        }
+    }
+
+    // sum the counts of the selected incidents per combination (and factor)
+    var sums = {};
+    for (var i = 0; i < cells.count.length; i++) {
+        var out_key = 0;
+        for (var k = 0; k < out_cols.length; k++) {
+            out_key += code(out_cols[k], cells.date[i], cells.hour[i]) * out_strides[k];
+        }
+        if (counts[out_key] == 0) {
+            continue;
+        }
+        var f = 0;
+        if (factor == "type") {
+            f = cells.type[i];
+        } else if (factor !== null) {
+            f = code(factor, cells.date[i], cells.hour[i]);
+        }
+        if (!(f in sums)) {
+            sums[f] = new Float64Array(counts.length);
+        }
+        sums[f][out_key] += cells.count[i];
+    }
+
+    function label(col, c) {
+        if (col == "weekday") {
+            return DAYS[c];
+        } else if (col == "month") {
+            return MONTHS[c];
+        } else if (col == "type") {
+            return cube.types[c];
+        } else if (col == "year") {
+            return c + min_year;
+        }
+        return (c < 10 ? "0" : "") + c; // zero-padded hour, day or week
+    }
+    function x_value(out_key) {
+        var x = agg_cols.map(function(col, k) {
+            return label(col, Math.floor(out_key / out_strides[k]) % sizes[col]);
+        });
+        return x.length == 1 ? x[0] : x;
+    }
+    // the combinations in order of their values, per group
+    function line(group_code, f) {
+        var x = [], y = [];
+        var last = out_cols.length - 1;
+        for (var out_key = 0; out_key < counts.length; out_key++) {
+            if ((counts[out_key] > 0) && ((group_code === null) ||
+                    (out_key % sizes[out_cols[last]] == group_code))) {
+                x.push(x_value(out_key));
+                y.push(f in sums ? sums[f][out_key] / counts[out_key] : 0);
+            }
+        }
+        return {"x": x, "y": y};
+    }
+
+    if (group_col === null) {
+        var result = line(null, 0);
+        result.labels = [];
+        return result;
+    }
+    var groups = [];
+    if (factor === null) {
+        var group_size = sizes[group_col];
+        var present = new Uint8Array(group_size);
+        for (var out_key = 0; out_key < counts.length; out_key++) {
+            if (counts[out_key] > 0) {
+                present[out_key % group_size] = 1;
+            }
+        }
+        for (var g = 0; g < group_size; g++) {
+            if (present[g]) {
+                groups.push(g);
+            }
+        }
+    } else {
+        groups = Object.keys(sums).map(Number).sort(function(a, b) { return a - b; });
+    }
+    var result = {"x": [], "y": [], "labels": []};
+    groups.forEach(function(g) {
+        var group_line = factor === null ? line(g, 0) : line(null, g);
+        result.x.push(group_line.x);
+        result.y.push(group_line.y);
+        result.labels.push(label(group_col, g));
+    });
+    return result;
+}
+"""
+
+def _create_choropleth_map(source, width=600, height=1000, center=(52.35, 4.9), zoom=11):
     """ Create a choropleth map with of incidents in Amsterdam-Amstelland.
     
     params
     ------
-    source: a Bokeh GeoJSONDataSource object containing the data
+    source: a Bokeh ColumnDataSource object with the polygons in columns
+            'xs' and 'ys' (see ihelpers.simplify_topology) and 
+            the columns 'incident_rate' and 'location_id'.
+    center: the initial (latitude, longitude) of the center of the map.
+    zoom: the initial zoom level of the map.
 
     return
     ------
@@ -26,20 +269,24 @@ def _create_choropleth_map(source, width=600, height=1000):
     in over the region
     """
 
-    map_colors = ['#f2f2f2', '#fee5d9', '#fcbba1', '#fc9272', '#fb6a4a', '#de2d26']
-    color_mapper = LogColorMapper(palette=map_colors)
-    nonselection_color_mapper = LogColorMapper(palette=gray(6)[::-1])
+    # locations without incidents have a rate of zero, which has no logarithm
+    color_mapper = LogColorMapper(palette=MAP_COLORS, low=1)
+    nonselection_color_mapper = LogColorMapper(palette=gray(6)[::-1], low=1)
     tooltip_info = [("index", "$index"),
                     ("(x,y)", "($x, $y)"),
                     ("#incidents", "@incident_rate"),
                     ("location id", "@location_id")]
     map_tools = "pan,wheel_zoom,tap,hover,reset"
 
-    # get google maps API key
-    with open("./Data/googlemapskey.txt") as f:
-        maps_api_key = f.readline()
+    # get google maps API key, without it the map has no background
+    try:
+        with open(os.path.join(DATA_DIR, MAPS_KEY_FILE)) as f:
+            maps_api_key = f.readline()
+    except (IOError, OSError) as e:
+        print("Could not read the Google Maps API key: {}".format(e))
+        maps_api_key = ""
 
-    map_options = GMapOptions(lat=52.35, lng=4.9, map_type="roadmap", zoom=11)
+    map_options = GMapOptions(lat=center[0], lng=center[1], map_type="roadmap", zoom=zoom)
     p = gmap(maps_api_key, map_options,tools=map_tools, plot_width=width,
              plot_height=height, x_axis_location=None, y_axis_location=None)
     p.xaxis.visible=False
@@ -53,7 +300,7 @@ def _create_choropleth_map(source, width=600, height=1000):
     # p.grid.grid_line_color = None
     # p.add_tile(CARTODBPOSITRON)
 
-    patches = p.patches('xs', 'ys', source=source,
+    patches = p.multi_polygons('xs', 'ys', source=source,
                         fill_color={'field': 'incident_rate', 'transform': color_mapper},
                         fill_alpha=0.5, line_color="black", line_width=0.3,
                         nonselection_fill_color={'field': 'incident_rate',
@@ -62,8 +309,57 @@ def _create_choropleth_map(source, width=600, height=1000):
 
     return p, patches
 
+def add_density_layer(p, source):
+    """ Add a (hidden) layer with the density of incidents to a map.
+
+    params
+    ------
+    p: the map figure (see _create_choropleth_map).
+    source: a Bokeh ColumnDataSource object with the bounds of grid cells
+            in columns 'left', 'right', 'bottom' and 'top' and their 
+            number of incidents in column 'count' (see
+            ihelpers.density_grid_data).
+
+    return
+    ------
+    the glyph renderer of the layer, which can be shown by setting its
+    'visible' property.
+    """
+    color_mapper = LogColorMapper(palette=MAP_COLORS[1:], low=1)
+    renderer = p.quad(left='left', right='right', bottom='bottom', top='top',
+                      source=source, fill_alpha=0.6, line_color=None,
+                      fill_color={'field': 'count', 'transform': color_mapper})
+    renderer.visible = False
+    return renderer
+
+def create_static_map(source, width=600, height=600, title=None):
+    """ Create a choropleth map of incidents that does not depend on Google
+        Maps, e.g., for standalone reports.
+
+    params
+    ------
+    source: a Bokeh ColumnDataSource object, like for _create_choropleth_map.
+    width, height: the size of the plot in pixels.
+    title: optional title of the plot.
+
+    return
+    ------
+    tuple of (Bokeh figure, glyph).
+    """
+    color_mapper = LogColorMapper(palette=MAP_COLORS, low=1)
+    tooltip_info = [("#incidents", "@incident_rate"),
+                    ("location id", "@location_id")]
+    p = figure(title=title, tools="pan,wheel_zoom,hover,reset,save",
+               x_axis_location=None, y_axis_location=None, width=width,
+               height=height, tooltips=tooltip_info, match_aspect=True)
+    p.grid.grid_line_color = None
+    patches = p.multi_polygons('xs', 'ys', source=source,
+                        fill_color={'field': 'incident_rate', 'transform': color_mapper},
+                        fill_alpha=0.8, line_color="black", line_width=0.3)
+    return p, patches
+
 def _create_time_series(dfincident, agg_by, pattern, group_by,
-                        types, width=500, height=350):
+                        types, width=500, height=350, index=None, data_version=None):
     """ Create a time series plot of the incident rate. 
 
     params
@@ -72,6 +368,34 @@ def _create_time_series(dfincident, agg_by, pattern, group_by,
     pattern_field: the column name that represents the pattern length to
                  be investigated / plotted.
     incident_types: array, the incident types to be included in the plot.
+    index: optional index of dfincident to filter with
+           (see ihelpers.build_incident_index).
+    data_version: the version of dfincident, used to cache the data
+                  (see ihelpers.cached_aggregate_data_for_time_series).
+
+    return
+    ------
+    tuple of (Bokeh figure, glyph) showing the incident rate over time.
+    """
+    x, y, labels = cached_aggregate_data_for_time_series(dfincident, agg_by, 
+                                                         pattern, group_by,
+                                                         types, None, index=index,
+                                                         data_version=data_version)
+    return create_time_series_figure(x, y, labels, group_by, width=width, height=height,
+                                     n_buckets=width // 2)
+
+def create_time_series_figure(x, y, labels, group_by, width=500, height=350,
+                              title=None, n_buckets=None):
+    """ Create a time series plot of aggregated incident rates.
+
+    params
+    ------
+    x, y, labels: the result of ihelpers.aggregate_data_for_time_series.
+    group_by: the grouping that the data was aggregated with.
+    width, height: the size of the plot in pixels.
+    title: optional title of the plot.
+    n_buckets: optional number of buckets to downsample the lines to
+               (see ihelpers.downsample_min_max), e.g., half the width.
 
     return
     ------
@@ -85,26 +409,19 @@ def _create_time_series(dfincident, agg_by, pattern, group_by,
         else:
             return ""
 
-    x, y, labels = aggregate_data_for_time_series(dfincident, agg_by, 
-                                                  pattern, group_by,
-                                                  types, None)
-
-    if group_by != "None":
-        colors, ngroups = get_colors(len(labels))
-        source = ColumnDataSource({"xs": x[0:ngroups],
-                                   "ys": y[0:ngroups],
-                                   "cs": colors,
-                                   "label": labels[0:ngroups]})
-    else:
-        source = ColumnDataSource({"xs": [x],
-                                   "ys": [y],
-                                   "cs": ["green"],
-                                   "label": ["avg incidents count"]})
+    factors, ys, colors, labels = get_time_series_lines(x, y, labels, group_by)
+    if n_buckets is not None:
+        positions, ys = downsample_min_max(ys, n_buckets)
+        factors = [factors[i] for i in positions]
+    source = ColumnDataSource({"xs": [factors] * len(ys),
+                               "ys": list(ys),
+                               "cs": colors,
+                               "label": labels})
 
     # create plot
     timeseries_tools = "pan,wheel_zoom,reset,xbox_select,hover,save"
     p = figure(tools=timeseries_tools, width=width, height=height,
-               x_range=FactorRange(*x))
+               x_range=FactorRange(*factors), title=title)
 
     glyph = p.multi_line(xs="xs", ys="ys", legend="label", line_color="cs", 
                  source=source, line_width=3)
@@ -169,6 +486,14 @@ def create_slider(time_unit="hour"):
     start, end, value, step, title = _get_slider_params(time_unit)
     return Slider(start=start, end=end, value=value, step=step, title=title)
 
+def create_date_range_slider(start, end, width=600):
+    """ Create a slider to select a range of whole days from start to end
+        (dates) with. Its value_throttled only changes when the handle is
+        released, so that callbacks on it do not run while dragging. """
+    return DateRangeSlider(start=start, end=end, value=(start, end),
+                           value_throttled=(start, end), step=24 * 60 * 60 * 1000,
+                           callback_policy="mouseup", title="Dates", width=width)
+
 """ Replaced by _create_radio_button_group for now
 def _create_pattern_selection_widget():
     options = ["Daily", "Weekly", "Yearly"]
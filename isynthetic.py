@@ -0,0 +1,207 @@
+import os
+import json
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from idatastore import INCIDENT_FILE, GEO_FILE
+
+# incident types and their relative frequencies
+SYNTHETIC_TYPES = {"Brand": 0.25,
+                   "Hulpverlening": 0.20,
+                   "OMS / automatische melding": 0.30,
+                   "Dienstverlening": 0.10,
+                   "Assistentie Ambulance": 0.08,
+                   "Ongeval": 0.05,
+                   "Waarschuwing": 0.02}
+
+# relative number of incidents per hour of the day
+SYNTHETIC_HOUR_PROFILE = [4, 3, 3, 2, 2, 2, 3, 4, 6, 7, 7, 8,
+                          8, 8, 8, 8, 9, 10, 10, 9, 8, 7, 6, 5]
+
+SYNTHETIC_START = datetime.date(2008, 1, 1)
+SYNTHETIC_END = datetime.date(2017, 12, 31)
+
+# the lower left corner (RD New coordinates) and size (meters) of the grid of vakken
+SYNTHETIC_ORIGIN = (110000, 475000)
+SYNTHETIC_CELL_SIZE = 500
+
+# fractions of incidents without a vak and outside the service area
+SYNTHETIC_MISSING_VAK = 0.02
+SYNTHETIC_OUTSIDE_AREA = 0.01
+
+_DUTCH_DAY_NAMES = ["Maandag", "Dinsdag", "Woensdag", "Donderdag",
+                    "Vrijdag", "Zaterdag", "Zondag"]
+
+def parse_size(size):
+    """ Parse a number of rows like '10k', '2.5M' or '1000' to an integer. """
+    multipliers = {"k": 10**3, "m": 10**6}
+    size = str(size).strip().lower()
+    if size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+def synthetic_vak_ids(grid_size):
+    """ Get the ids of the vakken in a synthetic grid, row by row.
+
+    params
+    ------
+    grid_size: the number of vakken along each side of the grid.
+
+    return
+    ------
+    numpy array of grid_size**2 integer ids, which start with '13' like
+    the ids in the service area of the FDAA.
+    """
+    gx, gy = np.meshgrid(np.arange(grid_size), np.arange(grid_size), indexing="ij")
+    return 1300000 + gx.ravel() * 1000 + gy.ravel()
+
+def generate_vakken(path, grid_size=20):
+    """ Write a geojson file with a square grid of synthetic vakken.
+
+    params
+    ------
+    path: the path of the geojson file to write.
+    grid_size: the number of vakken along each side of the grid.
+
+    notes
+    -----
+    The polygons are MultiPolygons in RD New coordinates with the vak id
+    as (string) property 'vak', like the geodata that
+    load_and_preprocess_geodata expects.
+    """
+    features = []
+    for i, vak in enumerate(synthetic_vak_ids(grid_size)):
+        x0 = SYNTHETIC_ORIGIN[0] + (i // grid_size) * SYNTHETIC_CELL_SIZE
+        y0 = SYNTHETIC_ORIGIN[1] + (i % grid_size) * SYNTHETIC_CELL_SIZE
+        x1, y1 = x0 + SYNTHETIC_CELL_SIZE, y0 + SYNTHETIC_CELL_SIZE
+        ring = [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+        features.append({"type": "Feature",
+                         "properties": {"vak": str(vak)},
+                         "geometry": {"type": "MultiPolygon", "coordinates": [[ring]]}})
+
+    collection = {"type": "FeatureCollection",
+                  "crs": {"type": "name",
+                          "properties": {"name": "urn:ogc:def:crs:EPSG::28992"}},
+                  "features": features}
+    with open(path, "w") as f:
+        json.dump(collection, f)
+
+def _date_table():
+    """ Get the date columns of every day between SYNTHETIC_START and
+        SYNTHETIC_END as a DataFrame. """
+    n_days = (SYNTHETIC_END - SYNTHETIC_START).days + 1
+    dates = [SYNTHETIC_START + datetime.timedelta(days=i) for i in range(n_days)]
+    return pd.DataFrame({"dim_datum_datum": [d.isoformat() for d in dates],
+                         "dim_datum_jaar": [d.year for d in dates],
+                         "dim_datum_maand_nr": [d.month for d in dates],
+                         "dim_datum_maand_dag_nr": [d.day for d in dates],
+                         "dim_datum_week_nr": [d.isocalendar()[1] for d in dates],
+                         "dim_datum_dag_naam_nl": [_DUTCH_DAY_NAMES[d.weekday()]
+                                                   for d in dates]})
+
+def _generate_chunk(random, first_id, n_rows, dates, vak_ids, vak_weights, grid_size):
+    """ Generate n_rows synthetic incidents, see generate_incidents. """
+    types = np.array(list(SYNTHETIC_TYPES.keys()))
+    type_weights = np.array(list(SYNTHETIC_TYPES.values()))
+    hour_weights = np.array(SYNTHETIC_HOUR_PROFILE, dtype=float)
+
+    chunk = dates.iloc[random.randint(0, len(dates), n_rows)].reset_index(drop=True)
+    chunk.insert(0, "dim_incident_id", np.arange(first_id, first_id + n_rows))
+    chunk.insert(1, "dim_incident_incident_type",
+                 types[random.choice(len(types), n_rows, p=type_weights / type_weights.sum())])
+    chunk["dim_prioriteit_prio"] = random.choice([1, 2, 3], n_rows, p=[0.5, 0.3, 0.2])
+    chunk["dim_tijd_uur"] = random.choice(24, n_rows, p=hour_weights / hour_weights.sum())
+
+    # locations: a vak and a point within it
+    vak = random.choice(len(vak_ids), n_rows, p=vak_weights)
+    chunk["hub_vak_bk"] = vak_ids[vak].astype(float)
+    chunk["hub_vak_id"] = vak + 1
+    chunk["st_x"] = np.round(SYNTHETIC_ORIGIN[0] + (vak // grid_size +
+                             random.rand(n_rows)) * SYNTHETIC_CELL_SIZE, 1)
+    chunk["st_y"] = np.round(SYNTHETIC_ORIGIN[1] + (vak % grid_size +
+                             random.rand(n_rows)) * SYNTHETIC_CELL_SIZE, 1)
+    chunk["cluster_naam"] = np.array(["Zuidwest", "Noordwest", "Zuidoost", "Noordoost"])[
+        (vak // grid_size) * 2 // grid_size * 2 + (vak % grid_size) * 2 // grid_size]
+    chunk["kazerne_groep"] = np.array(["Groep {}".format(i) for i in range(1, 11)])[
+        vak % 10]
+
+    # incidents that the preprocessing should remove
+    outside = random.rand(n_rows)
+    chunk.loc[outside < SYNTHETIC_OUTSIDE_AREA, "hub_vak_bk"] = 1400001
+    chunk.loc[outside > 1 - SYNTHETIC_MISSING_VAK, "hub_vak_bk"] = np.nan
+    return chunk
+
+def generate_incidents(path, n_rows, seed=0, grid_size=20, chunk_size=10**6):
+    """ Write a csv file with synthetic incidents.
+
+    params
+    ------
+    path: the path of the csv file to write.
+    n_rows: the number of incidents to generate.
+    seed: the random seed.
+    grid_size: the number of vakken along each side of the grid of
+               vakken (see generate_vakken) to place the incidents in.
+    chunk_size: the number of incidents to generate and write at once.
+
+    notes
+    -----
+    The file has the columns and separator that load_and_preprocess_incidents
+    expects. Types and hours follow SYNTHETIC_TYPES and SYNTHETIC_HOUR_PROFILE,
+    the number of incidents per vak is skewed (like in the real data) and a
+    small fraction of the incidents has no vak or lies outside the service
+    area. The output only depends on the arguments, so the same file can be
+    generated on any machine. Memory use is bounded by chunk_size, not n_rows.
+    """
+    dates = _date_table()
+    vak_ids = synthetic_vak_ids(grid_size)
+    vak_weights = np.random.RandomState(seed).gamma(0.5, size=len(vak_ids))
+    vak_weights = vak_weights / vak_weights.sum()
+
+    for i, first_id in enumerate(range(0, n_rows, chunk_size)):
+        random = np.random.RandomState([seed, i + 1])
+        chunk = _generate_chunk(random, first_id, min(chunk_size, n_rows - first_id),
+                                dates, vak_ids, vak_weights, grid_size)
+        chunk.to_csv(path, sep=";", index=False, mode="w" if i == 0 else "a",
+                     header=(i == 0))
+
+def generate_dataset(directory, n_rows, seed=0, grid_size=20, chunk_size=10**6):
+    """ Write a synthetic incident file and matching geodata to directory,
+        in the layout that the dashboard expects of its data directory
+        (see idatastore.DATA_DIR).
+
+    params
+    ------
+    directory: the directory to write the data to.
+    n_rows, seed, grid_size, chunk_size: see generate_incidents.
+
+    return
+    ------
+    tuple of the paths of the incident file and the geodata.
+    """
+    incident_path = os.path.join(directory, INCIDENT_FILE)
+    geo_path = os.path.join(directory, GEO_FILE)
+    for path in [incident_path, geo_path]:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    generate_vakken(geo_path, grid_size=grid_size)
+    generate_incidents(incident_path, n_rows, seed=seed, grid_size=grid_size,
+                       chunk_size=chunk_size)
+    return incident_path, geo_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic dashboard data.")
+    parser.add_argument("directory", help="the data directory to write to")
+    parser.add_argument("rows", help="the number of incidents, e.g., 10k or 50M")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--grid-size", type=int, default=20,
+                        help="the number of vakken along each side of the grid")
+    parser.add_argument("--chunk-size", type=int, default=10**6)
+    args = parser.parse_args()
+
+    paths = generate_dataset(args.directory, parse_size(args.rows), seed=args.seed,
+                             grid_size=args.grid_size, chunk_size=args.chunk_size)
+    print("Wrote {} and {}".format(*paths))
@@ -1,14 +1,21 @@
 import os
-os.chdir(b"C:\Users\s100385\Documents\JADS Working Files\Final Project")
+# the data paths are relative to the project directory (see idatastore.DATA_DIR),
+# elsewhere the server is started from the directory that holds the data
+if os.path.isdir(b"C:\Users\s100385\Documents\JADS Working Files\Final Project"):
+    os.chdir(b"C:\Users\s100385\Documents\JADS Working Files\Final Project")
 
+import time
+import datetime
 from threading import Timer
+from functools import partial
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 
 from bokeh.io import output_file, show
-from bokeh.models import GeoJSONDataSource, ColumnDataSource, HoverTool, LogColorMapper
+from bokeh.events import Reset
+from bokeh.models import ColumnDataSource, HoverTool, LogColorMapper
 from bokeh.models.ranges import FactorRange, DataRange1d, Range1d
 from bokeh.models.widgets import Div, MultiSelect, Button, Toggle
 from bokeh.models.callbacks import CustomJS
@@ -16,45 +23,80 @@ from bokeh.plotting import figure, curdoc
 from bokeh.palettes import Reds6 as palette
 from bokeh.layouts import layout, column, row, widgetbox, gridplot
 
-from ihelpers import prepare_data_for_geoplot, load_and_preprocess_incidents, \
-                     aggregate_data_for_time_series, get_colors, load_and_preprocess_geodata, \
-                     filter_on_slider_value
-from iplotcreators import _create_choropleth_map, _create_time_series, \
+from ihelpers import cached_aggregate_data_for_time_series, get_colors, \
+                     cube_incident_rates, cube_animation_frames, feasible_combos, \
+                     select_map_level, get_meters_per_pixel, get_gmap_meters_per_pixel, \
+                     select_density_level, density_grid_data, mercator_to_lonlat, \
+                     build_incident_count_cube, get_date_span, get_time_range_rows, \
+                     build_client_cube, get_time_series_lines, downsample_min_max, \
+                     get_time_series_window
+from idatastore import get_data_store, get_worker_pool
+from imetrics import timed_callback, timed_stage, add_stage, run_timed, \
+                     track_payload, format_trace, record_value
+from iplotcreators import _create_choropleth_map, _create_time_series, add_density_layer, \
                           _create_type_filter, _create_radio_button_group, create_slider, \
-                          _get_slider_params
+                          _get_slider_params, create_date_range_slider, CLIENT_CUBE_JS
 #from icallbacks import callback_update_time_series
 
 ## GLOBAL: LAYOUT AND STYLING ##
 LEFT_COLUMN_WIDTH = 700
 RIGHT_COLUMN_WIDTH = 700
 COLUMN_HEIGHT = 1000
-
-# load and prepare data
-gdflocations = load_and_preprocess_geodata("./Data/geoData/vakken_dag_ts.geojson")
-dfincident = load_and_preprocess_incidents(".\Data\incidenten_2008-heden.csv")
-locdata = prepare_data_for_geoplot(dfincident, gdflocations)
-geo_source = GeoJSONDataSource(geojson=locdata.to_json())
-
-feasible_combos = {"Daily": {"agg": ["Hour"],
-                             "group": ["Type", "Day of Week", "Year", "None"]},
-                   "Weekly": {"agg": ["Hour", "Day"],
-                             "group": ["Type", "Year", "None"]},
-                   "Yearly": {"agg": ["Day", "Week", "Month"],
-                              "group": ["Type", "Year", "None"]}}
+# initial (latitude, longitude) of the center and zoom level of the map
+MAP_CENTER = (52.35, 4.9)
+MAP_ZOOM = 11
+# milliseconds between two frames of the map animation
+ANIMATION_FRAME_INTERVAL = 1000
+# milliseconds without widget changes before the time series is updated
+TIME_SERIES_DEBOUNCE = 300
+# milliseconds without changes of the map view before the density layer is updated
+DENSITY_DEBOUNCE = 200
+# milliseconds without zooming or panning before the time series is resampled
+TIME_SERIES_ZOOM_DEBOUNCE = 200
+# milliseconds between two checks whether the data has been refreshed
+DATA_CHECK_INTERVAL = 1000
+# show the latency breakdown of the last update below the status
+SHOW_LATENCY = os.environ.get("IDASHBOARD_SHOW_LATENCY", "0") == "1"
+
+# get the data, which is loaded once per server process and shared by all sessions
+data_store = get_data_store()
+gdflocations = data_store["gdflocations"]
+dfincident = data_store["dfincident"]
+locdata = data_store["locdata"]
+incident_types = data_store["incident_types"]
+incident_cube = data_store["incident_cube"]
+incident_index = data_store["incident_index"]
+
+# the geometry is sent to the browser once per level of detail (see
+# callback_map_range), updates only change 'incident_rate'
+map_level = select_map_level(data_store["map_levels"],
+                             get_gmap_meters_per_pixel(MAP_ZOOM, MAP_CENTER[0]))
+geo_source = ColumnDataSource({"xs": data_store["map_levels"][map_level]["xs"],
+                               "ys": data_store["map_levels"][map_level]["ys"],
+                               "location_id": locdata["location_id"].values,
+                               "incident_rate": locdata["incident_rate"].values.astype(float)})
 
 slider_time_unit_mapping = {0: "hour",
                             1: "day",
                             2: "month"}
 # create plots
 map_figure, map_glyph = _create_choropleth_map(geo_source, width=LEFT_COLUMN_WIDTH,
-                                               height=700)
+                                               height=700, center=MAP_CENTER,
+                                               zoom=MAP_ZOOM)
+# the density layer only gets the cells in view, at the resolution of the zoom level
+density_source = ColumnDataSource({"left": [], "right": [], "bottom": [], "top": [],
+                                   "count": []})
+density_glyph = add_density_layer(map_figure, density_source)
 
 ts_figure, ts_glyph = _create_time_series(\
                         dfincident, "Hour", "Daily", "None",
                         dfincident["dim_incident_incident_type"].unique(),
-                        width=600, height=350)
+                        width=600, height=350, index=incident_index,
+                        data_version=data_store["version"])
 
 # create widgets
+date_range_slider = create_date_range_slider(*get_date_span(data_store["incident_times"]),
+                                             width=RIGHT_COLUMN_WIDTH - 100)
 slider_time_unit = "hour"
 time_slider = create_slider(slider_time_unit)
 slider_active_toggle = Toggle(label="slider not active", active=False,
@@ -62,22 +104,54 @@ slider_active_toggle = Toggle(label="slider not active", active=False,
 pattern_select = _create_radio_button_group(["Daily", "Weekly", "Yearly"])
 aggregate_select = _create_radio_button_group(["Hour", "Day", "Week", "Month"])
 groupby_select = _create_radio_button_group(["None", "Type", "Day of Week", "Year"])
-incident_types = dfincident["dim_incident_incident_type"].astype(str).unique()
 #type_filter = _create_type_filter(incident_types)
 type_filter = MultiSelect(title="Incident Types:", value=list(incident_types),
                           options=[(t, t) for t in incident_types],
                           size=10)
 select_all_types_button = Button(label="Select all", button_type="primary",
                                  width=150)
+density_toggle = Toggle(label="show density", active=False, button_type="default",
+                        width=150)
+client_cube_toggle = Toggle(label="views in browser", active=False, button_type="default",
+                            width=150)
+# the counts of the selected incidents that the browser computes the views of
+# the time series from (see ihelpers.build_client_cube), empty unless active
+cube_periods = ColumnDataSource({})
+cube_types = ColumnDataSource({})
+cube_cells = ColumnDataSource({})
 
 ## add callbacks
+doc = curdoc()
+# state of the asynchronous time series update of this session: the pending
+# (debounced) start, the running aggregation and the number of the latest update
+time_series_update = {"timeout": None, "future": None, "generation": 0}
+# the pending (debounced) update of the density layer
+density_update = {"timeout": None}
+# the full lines of the time series, of which the plot shows the factors from
+# window[0] to window[1] at the positions (see show_time_series_window), and
+# the pending (debounced) update after zooming
+ts_view = {"factors": [], "ys": None, "colors": [], "labels": [], "window": (0, 0),
+           "positions": np.arange(0), "timeout": None}
+# the count cube of the incidents in the selected date range (see get_map_cube)
+range_cube = {"key": None, "cube": None}
+# count the bytes that updates send to the browser
+track_payload(doc)
+
+def show_latency(trace):
+    """ Show the latency breakdown of the last callback below the status. """
+    if SHOW_LATENCY:
+        status.text = status.text.split("<br>")[0] + \
+                      "<br><small>{}</small>".format(format_trace(trace))
+
+@timed_callback(on_finish=show_latency)
 def update_time_series(filter_, attr, old, new):
     """ Updates the time series plot when filters have changed.
 
     params
     ------
     filter_: identifier for the filter that has been changed.
-             One of {'agg', 'pattern', 'group', 'types'}.
+             One of {'agg', 'pattern', 'group', 'types', 'map', 'dates',
+             'data', 'mode'}.
     attr: the attribute that changed.
     old: old value of 'attr'.
     new: new value of 'attr'.
@@ -86,14 +160,24 @@ def update_time_series(filter_, attr, old, new):
     -----
     The callback input (attr, old, new) is not used in order 
     to make the function callable from different filters changes.
+
+    The update itself starts after TIME_SERIES_DEBOUNCE milliseconds 
+    without further changes and runs in a worker thread 
+    (see start_time_series_update).
+
+    If the views are computed in the browser (client_cube_toggle), the
+    pattern, aggregation and grouping are handled there, and other 
+    filters update the cube that the browser computes them from.
     """
+    if client_cube_toggle.active and (filter_ in ("agg", "pattern", "group")):
+        return
+
     status.style = status_unavailable_style
     status.text = "<i>Status: calculating...</i>"
     
     agg_by = aggregate_select.labels[aggregate_select.active]
     pattern = pattern_select.labels[pattern_select.active]
     group_by = groupby_select.labels[groupby_select.active]
-    types = type_filter.value
 
     # check for feasibility and possibly cancel update
     perform_update = True
@@ -112,51 +196,177 @@ def update_time_series(filter_, attr, old, new):
             groupby_select.active = 3 # No groupby
 
     if perform_update:
-        # filter on location if map selection is made
-        if len(geo_source.selected.indices)>0:
-            loc_indices = geo_source.selected.indices
-            loc_ids = [locdata.iloc[int(idx)]["location_id"] for idx in loc_indices]
-            #incidents = dfincident[np.isin(dfincident["hub_vak_bk"], loc_ids)]
-        else:
-            loc_ids=None
-            #incidents = dfincident
-
-        # aggregate and prepare data
-        x, y, labels = aggregate_data_for_time_series(dfincident, agg_by, 
-                                                      pattern, group_by,
-                                                      types, loc_ids)
-
-        if group_by != "None":
-            colors, ngroups = get_colors(len(labels))
-            #ts_figure.y_range.start = 0.9*np.min(y)
-            #ts_figure.y_range.end = 1.1*np.max(y)+1
-            
-            ts_glyph.data_source.data = {"xs": x[0:ngroups],
-                                         "ys": y[0:ngroups],
-                                         "cs": colors,
-                                         "label": labels[0:ngroups]}
-            ts_figure.x_range.factors = x[0]            
-        else:
-            #ts_figure.y_range.start = 0.9*np.min(y)
-            #ts_figure.y_range.end = 1.1*np.max(y)
-            ts_glyph.data_source.data = {"xs": [x],
-                                         "ys": [y],
-                                         "cs": ["green"],
-                                         "label": ["avg incident count"]}
-            ts_figure.x_range.factors = x
-
+        # wait until the widgets stop changing, every change restarts the wait
+        if time_series_update["timeout"] is not None:
+            doc.remove_timeout_callback(time_series_update["timeout"])
+        time_series_update["timeout"] = doc.add_timeout_callback(
+            start_time_series_update, TIME_SERIES_DEBOUNCE)
     else:
         print("Update cancelled due to impossible filter combination.")
+        if (time_series_update["timeout"] is None) and (time_series_update["future"] is None):
+            status.style = status_available_style
+            status.text = "<i>Status: at your service</i>"
+
+@timed_callback(on_finish=show_latency)
+def start_time_series_update():
+    """ Aggregate the data for the current filters in a worker thread, 
+        so that the session stays responsive, and apply the result when
+        it is ready (see finish_time_series_update). If the views are
+        computed in the browser, the client cube is built instead.
+    """
+    time_series_update["timeout"] = None
 
-    status.style = status_available_style
-    status.text = "<i>Status: at your service</i>"
+    agg_by = aggregate_select.labels[aggregate_select.active]
+    pattern = pattern_select.labels[pattern_select.active]
+    group_by = groupby_select.labels[groupby_select.active]
+    types = type_filter.value
+    time_range = get_selected_time_range()
 
-def update_map(filtered_incidents):
-    locdata = prepare_data_for_geoplot(filtered_incidents, gdflocations)
-    # udpate source of map plot
-    map_glyph.data_source.geojson = locdata.to_json()
+    # filter on location if map selection is made
+    if len(geo_source.selected.indices)>0:
+        loc_indices = geo_source.selected.indices
+        loc_ids = [locdata.iloc[int(idx)]["location_id"] for idx in loc_indices]
+    else:
+        loc_ids=None
+
+    # a newer update makes any update that has not started yet redundant
+    if time_series_update["future"] is not None:
+        time_series_update["future"].cancel()
+    time_series_update["generation"] += 1
+    generation = time_series_update["generation"]
+
+    submitted = time.perf_counter()
+    client = client_cube_toggle.active
+    if client:
+        future = get_worker_pool().submit(run_timed, build_client_cube, dfincident,
+                                          types, loc_ids, index=incident_index,
+                                          time_range=time_range)
+    else:
+        future = get_worker_pool().submit(run_timed, cached_aggregate_data_for_time_series,
+                                          dfincident, agg_by, pattern, group_by,
+                                          types, loc_ids, index=incident_index,
+                                          data_version=data_store["version"],
+                                          time_range=time_range)
+    time_series_update["future"] = future
+    future.add_done_callback(lambda f: doc.add_next_tick_callback(
+        partial(finish_time_series_update, generation, group_by, client, submitted, f)))
+
+@timed_callback(on_finish=show_latency)
+def finish_time_series_update(generation, group_by, client, submitted, future):
+    """ Apply the result of an update started by start_time_series_update,
+        unless a newer update has been started since. The result is the 
+        client cube if client is True, the time series otherwise.
+    """
+    if (generation != time_series_update["generation"]) or future.cancelled():
+        return
+    time_series_update["future"] = None
+
+    try:
+        result, started, seconds = future.result()
+    except Exception as e:
+        print("Update of the time series failed: {}".format(e))
+        status.style = status_unavailable_style
+        status.text = "<i>Status: update failed</i>"
+        return
+    add_stage("queue", started - submitted)
+    add_stage("aggregate", seconds)
+
+    if client:
+        with timed_stage("send_client_cube"):
+            show_client_cube(result)
+    else:
+        with timed_stage("send_time_series"):
+            show_time_series(group_by, *result)
 
+    status.style = status_available_style
+    status.text = "<i>Status: at your service</i>"
+    record_value("update.time_series.seconds", time.perf_counter() - submitted)
+
+def show_time_series(group_by, x, y, labels):
+    """ Show the result of aggregate_data_for_time_series in the plot, 
+        downsampled to the width of the plot (see show_time_series_window). """
+    factors, ys, colors, labels = get_time_series_lines(x, y, labels, group_by)
+    ts_view.update(factors=factors, ys=ys, colors=colors, labels=labels)
+    show_time_series_window(0, len(factors))
+
+def show_time_series_window(start, stop):
+    """ Show the factors from start to stop of the time series, at full
+        resolution when they fit the width of the plot and downsampled
+        otherwise (see ihelpers.downsample_min_max). """
+    if ts_view["timeout"] is not None:
+        doc.remove_timeout_callback(ts_view["timeout"])
+        ts_view["timeout"] = None
+    with timed_stage("downsample"):
+        positions, ys = downsample_min_max(ts_view["ys"][:, start:stop],
+                                           ts_figure.plot_width // 2)
+        positions = positions + start
+        factors = [ts_view["factors"][i] for i in positions]
+    ts_view.update(window=(start, stop), positions=positions)
+    ts_glyph.data_source.data = {"xs": [factors] * len(ys),
+                                 "ys": list(ys),
+                                 "cs": ts_view["colors"],
+                                 "label": ts_view["labels"]}
+    ts_figure.x_range.factors = factors
+
+def get_selected_time_range():
+    """ Get the rows of the incidents in the selected range of dates (see
+        ihelpers.get_time_range_rows), or None if all dates are selected. """
+    start, end = date_range_slider.value_as_date
+    first, last = get_date_span(data_store["incident_times"])
+    if (start <= first) and (end >= last):
+        return None
+    return get_time_range_rows(data_store["incident_times"], start,
+                               end + datetime.timedelta(days=1))
+
+def get_map_cube():
+    """ Get the count cube of the incidents in the selected range of dates,
+        which is only built (from the rows of the range) when the range 
+        differs from all dates. """
+    time_range = get_selected_time_range()
+    if time_range is None:
+        return incident_cube
+    key = (data_store["version"], time_range.start, time_range.stop)
+    if range_cube["key"] != key:
+        with timed_stage("range_cube"):
+            range_cube["cube"] = build_incident_count_cube(
+                dfincident.iloc[time_range], incident_cube["locations"], incident_types)
+        range_cube["key"] = key
+    return range_cube["cube"]
+
+def show_client_cube(cube):
+    """ Send the result of ihelpers.build_client_cube to the browser, which
+        then shows the view of the current widgets (see callback_client_cube). """
+    cube_periods.data = cube["periods"]
+    cube_types.data = {"type": list(cube["types"])}
+    # the browser computes the view when the cells change, so they go last
+    cube_cells.data = cube["cells"]
+
+@timed_callback(on_finish=show_latency)
+def update_map():
+    # get incident rates for the current filters from the count cube
+    cube = get_map_cube()
+    with timed_stage("map_rates"):
+        if slider_active_toggle.active:
+            rates = cube_incident_rates(cube, type_filter.value,
+                                        slider_time_unit, time_slider.value)
+        else:
+            rates = cube_incident_rates(cube, type_filter.value)
+    # udpate source of map plot, only the rates are sent to the browser
+    with timed_stage("send_map"):
+        map_glyph.data_source.data["incident_rate"] = rates.astype(float)
+
+@timed_callback(on_finish=show_latency)
+def update_animation_frames():
+    # precompute the map for every slider value, the animation runs in the browser
+    cube = get_map_cube()
+    with timed_stage("animation_frames"):
+        frames = cube_animation_frames(cube, type_filter.value, slider_time_unit)
+    with timed_stage("send_animation_frames"):
+        animation_source.data = {"rates": frames.ravel().astype(np.float32)}
+
+@timed_callback(on_finish=show_latency)
 def update_time_slider(pattern):
+    global slider_time_unit
     slider_time_unit = slider_time_unit_mapping[pattern]
     start, end, value, step, title = _get_slider_params(slider_time_unit)
     time_slider.start = start
@@ -164,10 +374,65 @@ def update_time_slider(pattern):
     time_slider.value = value
     time_slider.step = step
     time_slider.title = title
-
-# Javascript callback that plays the animation
+    update_animation_frames()
+
+@timed_callback(on_finish=show_latency)
+def update_data(new_data_store):
+    """ Switch to a new version of the data store, e.g., with newly 
+        ingested incidents, and update the plots and widgets. """
+    global data_store, gdflocations, dfincident, locdata, incident_types, \
+           incident_cube, incident_index
+    old_types = incident_types
+    old_locations = locdata["location_id"].values
+    old_first, old_last = get_date_span(data_store["incident_times"])
+
+    data_store = new_data_store
+    gdflocations = data_store["gdflocations"]
+    dfincident = data_store["dfincident"]
+    locdata = data_store["locdata"]
+    incident_types = data_store["incident_types"]
+    incident_cube = data_store["incident_cube"]
+    incident_index = data_store["incident_index"]
+
+    # the map needs new polygons if incidents occurred at new locations
+    if not np.array_equal(old_locations, locdata["location_id"].values):
+        geo_source.selected.indices = []
+        geo_source.data = {"xs": data_store["map_levels"][map_level]["xs"],
+                           "ys": data_store["map_levels"][map_level]["ys"],
+                           "location_id": locdata["location_id"].values,
+                           "incident_rate": locdata["incident_rate"].values.astype(float)}
+
+    # a date range that ended at the last date (or started at the first) 
+    # extends to the new dates
+    first, last = get_date_span(data_store["incident_times"])
+    start, end = date_range_slider.value_as_date
+    date_range_slider.start = first
+    date_range_slider.end = last
+    date_range_slider.value = (first if start <= old_first else max(start, first),
+                               last if end >= old_last else min(end, last))
+
+    type_filter.options = [(t, t) for t in incident_types]
+    if (len(incident_types) > len(old_types)) and (set(type_filter.value) == set(old_types)):
+        # keep all types selected, which updates the plots (callback_type_filter)
+        type_filter.value = list(incident_types)
+    else:
+        update_time_series("data", "value", None, None)
+        update_map()
+        update_animation_frames()
+        update_density()
+
+def check_for_new_data():
+    # the data store is replaced when new incidents are ingested
+    if get_data_store() is not data_store:
+        update_data(get_data_store())
+
+# Javascript callback that plays the animation from the precomputed frames
+animation_source = ColumnDataSource({"rates": []})
 callback_play = CustomJS(args=dict(slider=time_slider,
-                                   active_button=slider_active_toggle),
+                                   active_button=slider_active_toggle,
+                                   frames=animation_source,
+                                   map_source=geo_source,
+                                   interval=ANIMATION_FRAME_INTERVAL),
                          code="""
 
 // set slider to active
@@ -178,53 +443,208 @@ var a = cb_obj.active;
 if(a==true){
     cb_obj.label = "STOP";
     cb_obj.button_type = "danger";
-    mytimer = setInterval(add_one, 1000);             
+    show_frame();
+    mytimer = setInterval(add_one, interval);
 } else {
     cb_obj.label = "PLAY";
     cb_obj.button_type = "primary";
     clearInterval(mytimer);
+    // tell the server the value that playing stopped at
+    slider.setv({value: slider.value});
 }
 
-// function that loops the value of the slider
+// function that loops the value of the slider, without sending every
+// value to the server, which has nothing to do while playing
 function add_one() {
-    if(slider.value+1 <= slider.end){
-        slider.value++;
-    } else {
-        slider.value = slider.start;
-    }
+    var value = slider.value+1 <= slider.end ? slider.value+1 : slider.start;
+    slider.setv({value: value}, {silent: true});
+    slider.properties.value.change.emit();
+    show_frame();
+}
+
+// function that shows the frame of the current slider value on the map
+function show_frame() {
+    var rates = frames.data["rates"];
+    var n = map_source.data["incident_rate"].length;
+    var start = (slider.value - slider.start) * n;
+    map_source.data["incident_rate"] = rates.slice(start, start + n);
+    map_source.change.emit();
 }
 """)
 
 # wrappers for update to include the changed filter
+@timed_callback(on_finish=show_latency)
 def callback_pattern_selection(attr, old, new):
     update_time_series("pattern", attr, old, new)
     update_time_slider(new)
 
+@timed_callback(on_finish=show_latency)
 def callback_aggregation_selection(attr, old, new):
     update_time_series("agg", attr, old, new)
 
+@timed_callback(on_finish=show_latency)
 def callback_groupby_selection(attr, old, new):
     update_time_series("group", attr, old, new)
 
+@timed_callback(on_finish=show_latency)
 def callback_type_filter(attr, old, new):
     update_time_series("types", attr, old, new)
-    filtered_data = filter_on_slider_value(dfincident, slider_time_unit, time_slider.value)
-    filtered_data = filtered_data[np.isin(filtered_data["dim_incident_incident_type"], new)]
-    update_map(filtered_data)
+    update_map()
+    update_animation_frames()
+    update_density()
+
+@timed_callback(on_finish=show_latency)
+def callback_date_range(attr, old, new):
+    update_time_series("dates", attr, old, new)
+    update_map()
+    update_animation_frames()
 
+@timed_callback(on_finish=show_latency)
 def callback_map_selection(attr, old, new):
     update_time_series("map", attr, old, new)    
 
+def get_map_view():
+    """ Get the part of the map that is shown.
+
+    return
+    ------
+    tuple of (meters per pixel, (lon_start, lon_end, lat_start, lat_end)),
+    or None if the browser has not reported the ranges of the map yet.
+    """
+    x_range, y_range = map_figure.x_range, map_figure.y_range
+    # the ranges of the map are (0, 1) until the browser reports them
+    if (None in (x_range.start, x_range.end, y_range.start, y_range.end)) or \
+       (x_range.end - x_range.start <= 1) or (y_range.end - y_range.start <= 1):
+        return None
+    meters_per_pixel = get_meters_per_pixel(x_range.start, x_range.end,
+                                            map_figure.plot_width, MAP_CENTER[0])
+    lon, lat = mercator_to_lonlat([x_range.start, x_range.end],
+                                  [y_range.start, y_range.end])
+    return meters_per_pixel, (lon[0], lon[1], lat[0], lat[1])
+
+@timed_callback(on_finish=show_latency)
+def update_density():
+    """ Show the density grid that fits the zoom level of the map, for 
+        the part of the map in view and the selected incident types (see
+        ihelpers.build_density_grids). The density includes all times,
+        regardless of the time slider and the date range.
+    """
+    density_update["timeout"] = None
+    if not density_toggle.active:
+        return
+    view = get_map_view()
+    if view is None:
+        meters_per_pixel = get_gmap_meters_per_pixel(MAP_ZOOM, MAP_CENTER[0])
+        bounds = None
+    else:
+        meters_per_pixel, (lon_start, lon_end, lat_start, lat_end) = view
+        # include a margin, so that panning shows the cells right away
+        lon_margin, lat_margin = (lon_end - lon_start) / 2, (lat_end - lat_start) / 2
+        bounds = (lon_start - lon_margin, lon_end + lon_margin,
+                  lat_start - lat_margin, lat_end + lat_margin)
+    grids = data_store["density_grids"]
+    with timed_stage("density_cells"):
+        data = density_grid_data(grids[select_density_level(grids, meters_per_pixel)],
+                                 incident_types, type_filter.value, bounds)
+    with timed_stage("send_density"):
+        density_source.data = data
+
+@timed_callback(on_finish=show_latency)
+def update_time_series_window():
+    """ Show the part of the time series that the user zoomed or panned to,
+        at full resolution when it fits the width of the plot. """
+    ts_view["timeout"] = None
+    x_range = ts_figure.x_range
+    # the browser shows its own views, see callback_client_cube
+    if client_cube_toggle.active or (len(ts_view["positions"]) == 0) or \
+       (x_range.start is None) or (x_range.end is None):
+        return
+    # the x-axis counts the shown factors, which are 1 apart
+    first, last = int(np.floor(x_range.start)), int(np.ceil(x_range.end)) - 1
+    n_shown = len(ts_view["positions"])
+    start, stop = ts_view["window"]
+    if (n_shown == stop - start) and (first >= 0) and (last < n_shown):
+        # not downsampled, the browser already shows the zoomed part
+        return
+    window = get_time_series_window(ts_view["positions"], ts_view["window"],
+                                    len(ts_view["factors"]), first, last)
+    if window != ts_view["window"]:
+        show_time_series_window(*window)
+
+def callback_time_series_range(attr, old, new):
+    # zooming reports many ranges, only the last counts; the range that the
+    # browser resets to after new factors maps to the shown window
+    if ts_view["timeout"] is not None:
+        doc.remove_timeout_callback(ts_view["timeout"])
+    ts_view["timeout"] = doc.add_timeout_callback(update_time_series_window,
+                                                  TIME_SERIES_ZOOM_DEBOUNCE)
+
+@timed_callback(on_finish=show_latency)
+def callback_time_series_reset(event):
+    # the reset tool shows the whole time series again
+    if not client_cube_toggle.active and ts_view["window"] != (0, len(ts_view["factors"])):
+        show_time_series_window(0, len(ts_view["factors"]))
+
+def schedule_density_update():
+    # the map reports many ranges while panning or zooming, only the last counts
+    if density_update["timeout"] is not None:
+        doc.remove_timeout_callback(density_update["timeout"])
+    density_update["timeout"] = doc.add_timeout_callback(update_density,
+                                                         DENSITY_DEBOUNCE)
+
+@timed_callback(on_finish=show_latency)
+def callback_map_range(attr, old, new):
+    """ Send the polygons at the level of detail that fits the zoom level
+        of the map, when it changes (see ihelpers.build_map_levels), and
+        update the density layer if it is shown.
+    """
+    global map_level
+    if density_toggle.active:
+        schedule_density_update()
+    view = get_map_view()
+    if view is None:
+        return
+    level = select_map_level(data_store["map_levels"], view[0])
+    if level != map_level:
+        map_level = level
+        with timed_stage("send_map_level"):
+            geo_source.data.update(xs=data_store["map_levels"][level]["xs"],
+                                   ys=data_store["map_levels"][level]["ys"])
+
+@timed_callback(on_finish=show_latency)
+def callback_density_toggle(active):
+    # the density layer replaces the polygons
+    map_glyph.visible = not active
+    density_glyph.visible = active
+    if active:
+        density_toggle.label = "show vakken"
+        update_density()
+    else:
+        density_toggle.label = "show density"
+        density_source.data = {"left": [], "right": [], "bottom": [], "top": [],
+                               "count": []}
+
+@timed_callback(on_finish=show_latency)
+def callback_client_cube_toggle(active):
+    if active:
+        client_cube_toggle.label = "views on server"
+    else:
+        client_cube_toggle.label = "views in browser"
+        cube_periods.data, cube_types.data, cube_cells.data = {}, {}, {}
+    update_time_series("mode", "active", not active, active)
+
+@timed_callback(on_finish=show_latency)
 def callback_select_all_types():
     type_filter.value = list(incident_types)
 
+@timed_callback(on_finish=show_latency)
 def callback_time_slider(attr, old, new):
-    if slider_active_toggle.active:
-        filtered_data = filter_on_slider_value(dfincident, slider_time_unit, new)
-        filtered_data = filtered_data[np.isin(filtered_data["dim_incident_incident_type"], 
-                                              type_filter.value)]
-        update_map(filtered_data)
+    # while playing, the browser shows the precomputed frames itself and 
+    # only sends the value when it stops
+    if slider_active_toggle.active and not play_button.active:
+        update_map()
 
+@timed_callback(on_finish=show_latency)
 def callback_toggle_slider_activity(active):
     
     if active==True:
@@ -234,22 +654,29 @@ def callback_toggle_slider_activity(active):
         slider_active_toggle.button_type = "warning"
     
     if active==False:
-        filtered_data = dfincident[np.isin(dfincident["dim_incident_incident_type"], 
-                                           type_filter.value)]
-        update_map(filtered_data)
+        update_map()
         slider_active_toggle.label = "slider not active"
         slider_active_toggle.button_type = "default"
 
 # assign callbacks
 play_button = Toggle(label="PLAY", button_type="primary", width=100, callback=callback_play)
 time_slider.on_change('value', callback_time_slider)
+date_range_slider.on_change('value_throttled', callback_date_range)
 slider_active_toggle.on_click(callback_toggle_slider_activity)
 pattern_select.on_change('active', callback_pattern_selection)
 aggregate_select.on_change('active', callback_aggregation_selection)
 groupby_select.on_change('active', callback_groupby_selection)
 type_filter.on_change('value', callback_type_filter)
-geo_source.on_change('selected', callback_map_selection)
+geo_source.selected.on_change('indices', callback_map_selection)
+map_figure.x_range.on_change('start', callback_map_range)
+map_figure.x_range.on_change('end', callback_map_range)
+ts_figure.x_range.on_change('start', callback_time_series_range)
+ts_figure.x_range.on_change('end', callback_time_series_range)
+ts_figure.on_event(Reset, callback_time_series_reset)
 select_all_types_button.on_click(callback_select_all_types)
+density_toggle.on_click(callback_density_toggle)
+client_cube_toggle.on_click(callback_client_cube_toggle)
+doc.add_periodic_callback(check_for_new_data, DATA_CHECK_INTERVAL)
 ## end callbacks
 
 # headers
@@ -264,19 +691,87 @@ pattern_head = Div(text="Pattern:", css_classes=["filter-head"])
 agg_head = Div(text="Aggregate by:", css_classes=["filter-head"])
 groupby_head = Div(text="Group by:", css_classes=["filter-head"])
 
+# names that clients without a browser find the models by (see iloadtest)
+for model_name, model in [("type_filter", type_filter), ("time_slider", time_slider),
+                          ("slider_active_toggle", slider_active_toggle),
+                          ("pattern_select", pattern_select), ("geo_source", geo_source),
+                          ("status", status)]:
+    model.name = model_name
+
+# Javascript callback that shows the view of the time series from the client
+# cube, without a round trip to the server (see ihelpers.build_client_cube)
+callback_client_cube = CustomJS(args=dict(active_toggle=client_cube_toggle,
+                                          pattern_select=pattern_select,
+                                          aggregate_select=aggregate_select,
+                                          groupby_select=groupby_select,
+                                          periods=cube_periods, types=cube_types,
+                                          cells=cube_cells,
+                                          ts_source=ts_glyph.data_source,
+                                          x_range=ts_figure.x_range, status=status,
+                                          feasible=feasible_combos,
+                                          colors=[list(get_colors(n)[0]) for n in range(12)]),
+                                code=CLIENT_CUBE_JS + """
+
+if (!active_toggle.active || !("count" in cells.data)) {
+    return;
+}
+var pattern = pattern_select.labels[pattern_select.active];
+var agg = aggregate_select.labels[aggregate_select.active];
+var group = groupby_select.labels[groupby_select.active];
+
+// keep the combination feasible like update_time_series does, this callback
+// runs again for the corrected value; cells.tags holds the shown view
+var shown = cells.tags;
+var aggs = feasible[pattern]["agg"], groups = feasible[pattern]["group"];
+if (aggs.indexOf(agg) < 0) {
+    var previous = (cb_obj === aggregate_select) && (shown.length == 3) ?
+                   aggregate_select.labels[shown[1]] : null;
+    aggregate_select.active = aggregate_select.labels.indexOf(
+        aggs.indexOf(previous) >= 0 ? previous : aggs[0]);
+    return;
+}
+if (groups.indexOf(group) < 0) {
+    var previous = (cb_obj === groupby_select) && (shown.length == 3) ?
+                   groupby_select.labels[shown[2]] : null;
+    groupby_select.active = groups.indexOf(previous) >= 0 ? shown[2] : 3;
+    return;
+}
+
+var cube = {"periods": periods.data, "cells": cells.data, "types": types.data["type"]};
+var result = aggregate_cube(cube, pattern, agg, group);
+if (group != "None") {
+    var n = Math.min(result.labels.length, colors.length - 1);
+    ts_source.data = {"xs": result.x.slice(0, n), "ys": result.y.slice(0, n),
+                      "cs": colors[n], "label": result.labels.slice(0, n)};
+    x_range.factors = n > 0 ? result.x[0] : [];
+} else {
+    ts_source.data = {"xs": [result.x], "ys": [result.y], "cs": ["green"],
+                      "label": ["avg incident count"]};
+    x_range.factors = result.x;
+}
+cells.tags = [pattern_select.active, aggregate_select.active, groupby_select.active];
+status.style = {"font-size": "8pt", "color": "green"};
+status.text = "<i>Status: at your service</i>";
+""")
+for widget in [pattern_select, aggregate_select, groupby_select]:
+    widget.js_on_change('active', callback_client_cube)
+cube_cells.js_on_change('data', callback_client_cube)
+
 # create layout of application
-radios_widgetbox = widgetbox(children=[status, pattern_head, pattern_select, 
+radios_widgetbox = widgetbox(children=[status, client_cube_toggle, pattern_head, pattern_select, 
                                        agg_head, aggregate_select,
                                        groupby_head, groupby_select])
 type_widgetbox = column(children=[type_filter, select_all_types_button])
 
-widgets = column(children=[row(children=[time_slider], width=RIGHT_COLUMN_WIDTH),
+widgets = column(children=[row(children=[date_range_slider], width=RIGHT_COLUMN_WIDTH),
+                           row(children=[time_slider], width=RIGHT_COLUMN_WIDTH),
                            row(children=[play_button, slider_active_toggle], width=RIGHT_COLUMN_WIDTH),
                            row(children=[type_widgetbox, radios_widgetbox])])
 
-main_left = column(children=[map_head, map_figure], width=LEFT_COLUMN_WIDTH, 
+main_left = column(children=[map_head, density_toggle, map_figure], width=LEFT_COLUMN_WIDTH, 
                    height=COLUMN_HEIGHT)
 main_right = column(children=[ts_head, ts_figure, widgets], 
                     width=RIGHT_COLUMN_WIDTH, height=COLUMN_HEIGHT)
 root = layout([[main_left, main_right]])
-curdoc().add_root(root)
\ No newline at end of file
+update_animation_frames()
+doc.add_root(root)
\ No newline at end of file
@@ -0,0 +1,46 @@
+import os
+
+from idatastore import DATA_DIR, SHARED_DIR, INGEST_INTERVAL, WARMUP_PROCESSES, \
+                       get_data_store, get_worker_pool, refresh_data_store, \
+                       warm_up_aggregation_cache
+from imetrics import METRICS_PORT, start_metrics_server, log_metrics
+
+def _refresh_in_background():
+    """ Refresh the data store in a worker thread, so that reading new
+        incidents does not block the sessions. """
+    def refresh():
+        try:
+            refresh_data_store()
+        except Exception as e:
+            print("Could not refresh the data: {}".format(e))
+    get_worker_pool().submit(refresh)
+
+def on_server_loaded(server_context):
+    """ Load the data store when the server starts, so that not even the
+        first session has to wait for it. If the data directory cannot be
+        found from the server's working directory, the data is loaded by
+        the first session instead (after main.py has set the directory).
+
+        Also serves the metrics of the callbacks if METRICS_PORT is set
+        (see imetrics), checks for new incidents every INGEST_INTERVAL
+        seconds (see idatastore.refresh_data_store), and warms up the
+        aggregation cache in the background if WARMUP_PROCESSES is set
+        (see idatastore.warm_up_aggregation_cache).
+    """
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if os.path.isdir(DATA_DIR):
+        get_data_store()
+        if WARMUP_PROCESSES > 0:
+            get_worker_pool().submit(warm_up_aggregation_cache)
+    if INGEST_INTERVAL > 0:
+        if SHARED_DIR is None:
+            server_context.add_periodic_callback(_refresh_in_background,
+                                                 INGEST_INTERVAL * 1000)
+        else:
+            print("New incidents are not ingested while sharing the data "
+                  "between processes (IDASHBOARD_SHARED_DIR).")
+
+def on_server_unloaded(server_context):
+    """ Log the histograms of the callback metrics, if METRICS_LOG is set. """
+    log_metrics()
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# the modules of the dashboard are imported from the directory of main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from isynthetic import generate_dataset
+from ihelpers import load_and_preprocess_incidents
+
+# the number of incidents of the synthetic data set of the tests
+TEST_ROWS = 20000
+# the number of vakken per side of the synthetic grid of vakken
+TEST_GRID_SIZE = 5
+
+@pytest.fixture(scope="session")
+def data_paths(tmp_path_factory):
+    """ The paths of the incident file and the geodata of a small synthetic
+        data set (see isynthetic.generate_dataset). """
+    directory = str(tmp_path_factory.mktemp("data"))
+    return generate_dataset(directory, TEST_ROWS, grid_size=TEST_GRID_SIZE)
+
+@pytest.fixture(scope="session")
+def incidents(data_paths):
+    """ The preprocessed incidents of the synthetic data set, which the
+        tests must not modify. """
+    incident_path, geo_path = data_paths
+    return load_and_preprocess_incidents(incident_path, use_cache=False,
+                                         geo_path=geo_path)
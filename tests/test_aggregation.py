@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ihelpers import aggregate_data_for_time_series, build_incident_index, \
+                     create_time_index, filter_on_slider_value, get_time_range_rows, \
+                     feasible_combos
+
+# the columns of the time units of a pattern and of an aggregation within
+# a pattern, as aggregate_data_for_time_series uses them
+PATTERN_COLUMNS = {"Daily": ["dim_datum_datum"],
+                   "Weekly": ["dim_datum_jaar", "week_nr"],
+                   "Yearly": ["dim_datum_jaar"]}
+AGG_COLUMNS = {("Hour", "Daily"): ["hour"],
+               ("Hour", "Weekly"): ["day_name", "hour"],
+               ("Hour", "Yearly"): ["month", "day_nr", "hour"],
+               ("Day", "Weekly"): ["day_name"],
+               ("Day", "Yearly"): ["month", "day_nr"],
+               ("Week", "Yearly"): ["week_nr"],
+               ("Month", "Yearly"): ["month"]}
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+FEASIBLE = [(pattern, agg, group) for pattern, combos in feasible_combos.items()
+            for agg in combos["agg"] for group in combos["group"]]
+
+def _as_strings(incidents, cols):
+    """ Get columns of incidents as plain strings, with the integer time
+        units zero-padded like the x-axis. """
+    return pd.DataFrame({col: incidents[col].astype(str).str.zfill(2)
+                              if col in ("hour", "day_nr", "week_nr")
+                              else incidents[col].astype(str)
+                         for col in cols})
+
+def _key(x):
+    return x if isinstance(x, tuple) else (x,)
+
+def reference_time_series(incidents, pattern, agg, group, types):
+    """ Compute the time series of aggregate_data_for_time_series for group
+        "None" or "Type" with plain pandas on string columns.
+
+    return
+    ------
+    dict of {(label, x): y}, where label is "None" for group "None".
+    """
+    agg_cols = AGG_COLUMNS[(agg, pattern)]
+    cols = PATTERN_COLUMNS[pattern] + agg_cols
+    units = _as_strings(incidents, cols)
+    # the time units come from all incidents, see create_time_index
+    if ("day_name" in cols) or ("month" in cols):
+        levels = [DAYS if col == "day_name" else MONTHS if col == "month"
+                  else sorted(units[col].unique()) for col in cols]
+        index = pd.MultiIndex.from_product(levels, names=cols)
+    else:
+        index = units.groupby(cols).size().index
+
+    selected = incidents["dim_incident_incident_type"].isin(types).values
+    units = units[selected]
+    units["type"] = incidents["dim_incident_incident_type"].astype(str).values[selected]
+    counts = units.groupby(cols + ["type"]).size().unstack("type").reindex(index).fillna(0)
+    if group == "None":
+        counts = pd.DataFrame({"None": counts.sum(axis=1)})
+    means = counts.groupby(level=agg_cols).mean()
+    return {(label, _key(x)): y for label in means.columns
+            for x, y in means[label].items()}
+
+def as_dict(result, group):
+    """ Convert the result of aggregate_data_for_time_series to the format
+        of reference_time_series. """
+    x, y, labels = result
+    if group == "None":
+        x, y, labels = [x], [y], ["None"]
+    return {(label, _key(xi)): yi for xs, ys, label in zip(x, y, labels)
+            for xi, yi in zip(xs, ys)}
+
+@pytest.mark.parametrize("pattern,agg", [(pattern, agg) for pattern, agg, group in FEASIBLE
+                                         if group == "None"])
+@pytest.mark.parametrize("group", ["None", "Type"])
+def test_aggregation_matches_reference(incidents, pattern, agg, group):
+    types = ["Brand", "Hulpverlening", "Ongeval"]
+    result = as_dict(aggregate_data_for_time_series(incidents, agg, pattern, group,
+                                                    types, None), group)
+    expected = reference_time_series(incidents, pattern, agg, group, types)
+    assert sorted(result) == sorted(expected)
+    assert np.allclose([result[key] for key in expected], list(expected.values()))
+
+@pytest.mark.parametrize("pattern,agg,group", FEASIBLE)
+def test_index_matches_filter(incidents, pattern, agg, group):
+    index = build_incident_index(incidents)
+    types = list(incidents["dim_incident_incident_type"].cat.categories[1:4])
+    locations = list(np.unique(incidents["hub_vak_bk"])[::3])
+    for locations in [None, locations]:
+        filtered = aggregate_data_for_time_series(incidents, agg, pattern, group,
+                                                  types, locations)
+        indexed = aggregate_data_for_time_series(incidents, agg, pattern, group,
+                                                 types, locations, index=index)
+        assert repr(indexed) == repr(filtered)
+
+def test_time_range_matches_slice(incidents):
+    index = build_incident_index(incidents)
+    types = list(incidents["dim_incident_incident_type"].cat.categories)
+    rows = get_time_range_rows(incidents["timestamp"].values,
+                               np.datetime64("2010-03-01"), np.datetime64("2012-06-01"))
+    sliced = incidents.iloc[rows].reset_index(drop=True)
+    for pattern, agg, group in FEASIBLE:
+        ranged = aggregate_data_for_time_series(incidents, agg, pattern, group, types,
+                                                None, index=index, time_range=rows)
+        expected = aggregate_data_for_time_series(sliced, agg, pattern, group, types, None)
+        assert repr(ranged) == repr(expected)
+
+def test_time_index_is_full_product_with_day_names():
+    data = pd.DataFrame({"week_nr": [1, 3, 3],
+                         "day_name": pd.Categorical(["Mon", "Tue", "Mon"],
+                                                    categories=DAYS, ordered=True),
+                         "hour": [0, 0, 5]})
+    index = create_time_index(data, ["week_nr", "day_name", "hour"])
+    assert list(index.names) == ["week_nr", "day_name", "hour"]
+    assert len(index) == 2 * 7 * 2
+    assert (3, "Sun", 0) in index
+
+def test_time_index_is_observed_without_day_names():
+    data = pd.DataFrame({"week_nr": [1, 3, 3], "hour": [0, 0, 5]})
+    index = create_time_index(data, ["week_nr", "hour"])
+    assert sorted(index) == [(1, 0), (3, 0), (3, 5)]
+
+def test_filter_on_slider_value(incidents):
+    for time_unit, column, value in [("hour", "hour", 5), ("week", "week_nr", 12),
+                                     ("month", "dim_datum_maand_nr", 3)]:
+        filtered = filter_on_slider_value(incidents, time_unit, value)
+        assert len(filtered) > 0
+        assert (filtered[column] == value).all()
+    # the day slider counts from Monday = 1
+    assert (filter_on_slider_value(incidents, "day", 2)["day_name"] == "Tue").all()
+
+def test_filter_on_slider_value_invalid_time_unit(incidents):
+    with pytest.raises(ValueError):
+        filter_on_slider_value(incidents, "year", 2010)
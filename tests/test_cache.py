@@ -0,0 +1,53 @@
+from ihelpers import aggregate_data_for_time_series, aggregation_cache_key, \
+                     cached_aggregate_data_for_time_series, create_lru_cache, \
+                     lru_cache_get, lru_cache_put, lru_cache_stats
+
+def test_cache_key_ignores_order_of_types_and_locations():
+    assert aggregation_cache_key("Hour", "Daily", "Type", ["a", "b"], [1, 2], 0) == \
+           aggregation_cache_key("Hour", "Daily", "Type", ["b", "a"], [2, 1], 0)
+
+def test_cache_key_changes_with_data_version_and_time_range():
+    keys = [aggregation_cache_key("Hour", "Daily", "Type", ["a"], None, 0),
+            aggregation_cache_key("Hour", "Daily", "Type", ["a"], None, 1),
+            aggregation_cache_key("Hour", "Daily", "Type", ["a"], None, 1, slice(0, 10)),
+            aggregation_cache_key("Hour", "Daily", "Type", ["a"], None, 1, slice(5, 10))]
+    assert len(set(keys)) == len(keys)
+
+def test_cached_aggregation_uses_the_data_version(incidents):
+    cache = create_lru_cache(2**26)
+    types = list(incidents["dim_incident_incident_type"].cat.categories)
+    older = incidents.iloc[:len(incidents) // 2]
+    args = ("Day", "Weekly", "Type", types, None)
+    first = cached_aggregate_data_for_time_series(older, *args, data_version=0, cache=cache)
+    assert cached_aggregate_data_for_time_series(older, *args, data_version=0,
+                                                 cache=cache) is first
+    # a new version of the data is aggregated again
+    second = cached_aggregate_data_for_time_series(incidents, *args, data_version=1,
+                                                   cache=cache)
+    assert repr(second) == repr(aggregate_data_for_time_series(incidents, *args))
+    assert repr(second) != repr(first)
+    assert lru_cache_stats(cache)["hits"] == 1
+
+def test_lru_cache_evicts_least_recently_used():
+    values = {key: list(range(100)) for key in "abc"}
+    cache = create_lru_cache(2 * _size(values["a"]) + 1)
+    lru_cache_put(cache, "a", values["a"])
+    lru_cache_put(cache, "b", values["b"])
+    lru_cache_get(cache, "a")
+    lru_cache_put(cache, "c", values["c"])
+    assert lru_cache_get(cache, "b") is None
+    assert lru_cache_get(cache, "a") is values["a"]
+    assert lru_cache_stats(cache)["evictions"] == 1
+
+def test_lru_cache_put_without_evicting():
+    values = {key: list(range(100)) for key in "ab"}
+    cache = create_lru_cache(_size(values["a"]) + 1)
+    assert lru_cache_put(cache, "a", values["a"], evict=False)
+    assert not lru_cache_put(cache, "b", values["b"], evict=False)
+    assert lru_cache_get(cache, "a") is values["a"]
+    assert lru_cache_get(cache, "b") is None
+
+def _size(value):
+    cache = create_lru_cache(2**30)
+    lru_cache_put(cache, "value", value)
+    return lru_cache_stats(cache)["nbytes"]
@@ -0,0 +1,87 @@
+import json
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from ihelpers import aggregate_data_for_time_series, build_client_cube, feasible_combos
+from iplotcreators import CLIENT_CUBE_JS
+
+FEASIBLE = [(pattern, agg, group) for pattern, combos in feasible_combos.items()
+            for agg in combos["agg"] for group in combos["group"]]
+
+def _selections(incidents):
+    """ Selections of incident types and locations to build cubes of. """
+    types = list(incidents["dim_incident_incident_type"].cat.categories)
+    locations = list(np.unique(incidents["hub_vak_bk"])[::3])
+    return [(types, None), (types[1:4], locations)]
+
+def _normalize(x, y, labels, group):
+    """ Convert a time series (x, y, labels) to a dict of
+        {(label, x): y} with x and the labels as strings. """
+    if group == "None":
+        x, y, labels = [x], [y], ["None"]
+
+    def key(xi):
+        return tuple(str(v) for v in xi) if isinstance(xi, (tuple, list)) else (str(xi),)
+
+    return {(str(label), key(xi)): yi for xs, ys, label in zip(x, y, labels)
+            for xi, yi in zip(xs, ys)}
+
+@pytest.mark.parametrize("selection", [0, 1])
+def test_client_cube_counts(incidents, selection):
+    types, locations = _selections(incidents)[selection]
+    cube = build_client_cube(incidents, types, locations)
+
+    # a period for every date with incidents, with the hours of its incidents
+    by_date = incidents.groupby("dim_datum_datum", observed=True)
+    first = by_date.head(1).sort_values("dim_datum_datum")
+    periods = cube["periods"]
+    assert len(periods["hours"]) == len(first)
+    assert np.array_equal(periods["year"], first["dim_datum_jaar"].values)
+    assert np.array_equal(periods["week"], first["week_nr"].values)
+    assert np.array_equal(periods["month"], first["month"].cat.codes.values)
+    assert np.array_equal(periods["day"], first["day_nr"].values)
+    assert np.array_equal(periods["weekday"], first["day_name"].cat.codes.values)
+    hours = by_date["hour"].agg(lambda h: sum(1 << int(v) for v in set(h)))
+    assert np.array_equal(periods["hours"], hours.values)
+
+    # a cell for every date, hour and type with selected incidents
+    selected = incidents["dim_incident_incident_type"].isin(types)
+    if locations is not None:
+        selected &= incidents["hub_vak_bk"].isin(locations)
+    expected = incidents[selected].groupby(
+        [incidents["dim_datum_datum"].cat.codes, "hour",
+         incidents["dim_incident_incident_type"].astype(str)]).size()
+    dates = np.asarray(first["dim_datum_datum"].cat.codes)
+    cells = cube["cells"]
+    result = {(int(dates[d]), int(h), cube["types"][t]): int(c) for d, h, t, c in
+              zip(cells["date"], cells["hour"], cells["type"], cells["count"])}
+    assert result == {(int(d), int(h), t): int(c) for (d, h, t), c in expected.items()}
+    assert list(cube["types"]) == sorted(set(t for _, _, t in expected.index))
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+@pytest.mark.parametrize("selection", [0, 1])
+def test_client_cube_matches_server(incidents, selection):
+    types, locations = _selections(incidents)[selection]
+    cube = build_client_cube(incidents, types, locations)
+    cube = {"periods": {k: v.tolist() for k, v in cube["periods"].items()},
+            "cells": {k: v.tolist() for k, v in cube["cells"].items()},
+            "types": cube["types"].tolist()}
+    script = CLIENT_CUBE_JS + """
+var input = JSON.parse(require("fs").readFileSync(0, "utf-8"));
+console.log(JSON.stringify(input.views.map(function(view) {
+    return aggregate_cube(input.cube, view[0], view[1], view[2]);
+})));
+"""
+    output = subprocess.run(["node", "-e", script], check=True, stdout=subprocess.PIPE,
+                            input=json.dumps({"cube": cube, "views": FEASIBLE}).encode())
+    for (pattern, agg, group), result in zip(FEASIBLE, json.loads(output.stdout.decode())):
+        expected = aggregate_data_for_time_series(incidents, agg, pattern, group,
+                                                  types, locations)
+        expected = _normalize(*expected, group)
+        result = _normalize(result["x"], result["y"], result["labels"], group)
+        assert list(result) == list(expected), (pattern, agg, group)
+        assert np.allclose(list(result.values()), list(expected.values())), \
+               (pattern, agg, group)
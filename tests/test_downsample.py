@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from ihelpers import downsample_min_max, get_time_series_window
+
+def _random_lines(n_lines, n, seed=0):
+    """ Lines of random values with some missing ones. """
+    rng = np.random.RandomState(seed)
+    ys = rng.poisson(10, size=(n_lines, n)).astype(float)
+    ys[rng.rand(n_lines, n) < 0.1] = np.nan
+    return ys
+
+@pytest.mark.parametrize("n", [1, 50, 100])
+def test_short_series_unchanged(n):
+    ys = _random_lines(3, n)
+    positions, values = downsample_min_max(ys, 50)
+    assert np.array_equal(positions, np.arange(n))
+    assert np.array_equal(values, ys, equal_nan=True)
+
+@pytest.mark.parametrize("n, n_buckets", [(101, 50), (1000, 50), (9999, 37)])
+def test_downsample_keeps_min_max_per_bucket(n, n_buckets):
+    ys = _random_lines(4, n)
+    ys[2] = np.nan
+    positions, values = downsample_min_max(ys, n_buckets)
+    assert len(positions) == 2 * n_buckets
+    assert values.shape == (len(ys), 2 * n_buckets)
+
+    # the buckets follow each other and cover all x values
+    starts, ends = positions[0::2], positions[1::2]
+    assert starts[0] == 0 and ends[-1] == n - 1
+    assert np.array_equal(starts[1:], ends[:-1] + 1)
+    assert (ends >= starts).all()
+
+    for line, expected in zip(values, ys):
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            bucket = expected[start:end + 1]
+            shown = line[2 * i:2 * i + 2]
+            if np.isnan(bucket).all():
+                assert np.isnan(shown).all()
+            else:
+                assert sorted(shown) == [np.nanmin(bucket), np.nanmax(bucket)]
+
+def test_window_of_shown_factors():
+    # factors 100 to 300 of 1000, downsampled to 20 positions
+    positions, _ = downsample_min_max(np.zeros((1, 200)), 10)
+    positions = positions + 100
+    window = (100, 300)
+    assert get_time_series_window(positions, window, 1000, 0, 19) == (100, 300)
+    assert get_time_series_window(positions, window, 1000, 2, 5) == \
+           (positions[2], positions[5] + 1)
+
+def test_window_beyond_shown_factors():
+    positions = np.arange(100, 300, 10)
+    window = (100, 300)
+    # the shown factors are 10 apart, zooming out extends by as much
+    assert get_time_series_window(positions, window, 1000, -5, 24) == (50, 350)
+    # but not beyond the full time series
+    assert get_time_series_window(positions, window, 1000, -50, 200) == (0, 1000)
+    assert get_time_series_window(positions, window, 1000, 100, 120) == (999, 1000)
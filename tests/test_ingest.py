@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import idatastore
+from ihelpers import get_time_range_rows
+from idatastore import get_data_store, load_data_store, refresh_data_store
+
+def _split_lines(incident_path, in_order):
+    """ Get the header and the rows of an incident file, sorted by time
+        if in_order (the synthetic rows are in random order). """
+    with open(incident_path, "rb") as f:
+        lines = f.read().splitlines(True)
+    rows = lines[1:]
+    if in_order:
+        # by date and hour
+        rows = sorted(rows, key=lambda row: (row.split(b";")[2], int(row.split(b";")[9])))
+    return lines[0], rows
+
+def _ingest(monkeypatch, tmp_path, data_paths, in_order, steps):
+    """ Load the first rows of the synthetic incident file, append the
+        others in steps and ingest them after every step.
+
+    return
+    ------
+    tuple of (the data stores after every step, starting with the loaded
+    one, the data store of loading the whole file).
+    """
+    _, geo_path = data_paths
+    header, rows = _split_lines(data_paths[0], in_order)
+    incident_path = str(tmp_path / "incidents.csv")
+    # the last 5% fit in the spare room of the incidents after the first
+    # ingest (see ihelpers.INCIDENT_SPARE_CAPACITY)
+    cuts = np.linspace(int(0.95 * len(rows)), len(rows), steps + 1).astype(int)
+    with open(incident_path, "wb") as f:
+        f.writelines([header] + rows[:cuts[0]])
+
+    monkeypatch.setattr(idatastore, "_DATA_STORE",
+                        load_data_store(incident_path, geo_path, shared_dir=None))
+    stores = [get_data_store()]
+    for start, stop in zip(cuts[:-1], cuts[1:]):
+        with open(incident_path, "ab") as f:
+            f.writelines(rows[start:stop])
+        assert refresh_data_store()
+        stores.append(get_data_store())
+    return stores, load_data_store(incident_path, geo_path, shared_dir=None)
+
+def _assert_same_data(store, expected):
+    pd.testing.assert_frame_equal(store["dfincident"], expected["dfincident"])
+    assert np.array_equal(store["incident_times"], expected["dfincident"]["timestamp"].values)
+    assert np.array_equal(store["incident_types"], expected["incident_types"])
+    assert np.array_equal(store["locdata"]["incident_rate"].values,
+                          expected["locdata"]["incident_rate"].values)
+
+    cube, expected_cube = store["incident_cube"], expected["incident_cube"]
+    assert np.array_equal(cube["locations"], expected_cube["locations"])
+    assert np.array_equal(cube["counts"], expected_cube["counts"])
+    assert np.array_equal(cube["totals"], expected_cube["totals"])
+    for unit in ["hour", "day", "month"]:
+        assert np.array_equal(cube["marginals"][unit], expected_cube["marginals"][unit])
+
+    for key in ["type", "location"]:
+        for part in ["values", "rows", "offsets"]:
+            assert np.array_equal(store["incident_index"][key][part],
+                                  expected["incident_index"][key][part])
+
+    for grid, expected_grid in zip(store["density_grids"], expected["density_grids"]):
+        for part in ["ix", "iy", "counts"]:
+            assert np.array_equal(grid[part], expected_grid[part])
+
+@pytest.mark.parametrize("in_order", [True, False])
+def test_ingest_matches_reload(monkeypatch, tmp_path, data_paths, in_order):
+    stores, expected = _ingest(monkeypatch, tmp_path, data_paths, in_order, steps=1)
+    _assert_same_data(stores[-1], expected)
+    assert stores[-1]["version"] == 1
+
+def test_ingest_assigns_vakken(monkeypatch, tmp_path, data_paths):
+    # some synthetic incidents have no vak, which is assigned by location
+    header, rows = _split_lines(data_paths[0], True)
+    assert any(row.split(b";")[10] == b"" for row in rows[int(0.95 * len(rows)):])
+    stores, expected = _ingest(monkeypatch, tmp_path, data_paths, True, steps=1)
+    assert stores[-1]["dfincident"]["hub_vak_bk"].notnull().all()
+    _assert_same_data(stores[-1], expected)
+
+def test_ingest_in_steps_does_not_copy(monkeypatch, tmp_path, data_paths):
+    stores, expected = _ingest(monkeypatch, tmp_path, data_paths, True, steps=4)
+    _assert_same_data(stores[-1], expected)
+    # after the first ingest, new incidents are written in the spare room
+    # of the same arrays, while the (read-only) count cube is replaced
+    for previous, store in zip(stores[1:-1], stores[2:]):
+        assert np.shares_memory(previous["incident_times"], store["incident_times"])
+        assert not np.shares_memory(previous["incident_cube"]["counts"],
+                                    store["incident_cube"]["counts"])
+        assert previous["incident_cube"]["totals"].sum() < store["incident_cube"]["totals"].sum()
+
+def test_time_range_after_ingest(monkeypatch, tmp_path, data_paths):
+    stores, expected = _ingest(monkeypatch, tmp_path, data_paths, False, steps=2)
+    times = stores[-1]["incident_times"]
+    assert (np.diff(times) >= np.timedelta64(0)).all()
+    rows = get_time_range_rows(times, "2012-01-01", "2013-01-01")
+    selected = stores[-1]["dfincident"].iloc[rows]
+    assert (selected["dim_datum_jaar"] == 2012).all()
+    assert len(selected) == (expected["dfincident"]["dim_datum_jaar"] == 2012).sum()
@@ -0,0 +1,42 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from ihelpers import load_and_preprocess_geodata, load_and_preprocess_incidents, \
+                     preprocess_incidents, read_and_preprocess_incidents, \
+                     read_incidents, split_incident_file
+
+def test_split_incident_file_into_whole_lines(data_paths):
+    incident_path, _ = data_paths
+    ranges = split_incident_file(incident_path, chunk_bytes=10000)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == os.path.getsize(incident_path)
+    with open(incident_path, "rb") as f:
+        data = f.read()
+    for (_, stop), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert stop == start
+        assert data[stop - 1:stop] == b"\n"
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_chunked_load_matches_single_pass(data_paths, processes):
+    incident_path, geo_path = data_paths
+    vakken = load_and_preprocess_geodata(geo_path, use_cache=False)[["vak", "geometry"]]
+    chunk_bytes = os.path.getsize(incident_path) // 7
+    assert len(split_incident_file(incident_path, chunk_bytes=chunk_bytes)) > 1
+
+    chunked = read_and_preprocess_incidents(incident_path, processes=processes,
+                                            chunk_bytes=chunk_bytes, vakken=vakken)
+    expected = preprocess_incidents(read_incidents(incident_path), vakken)
+    pd.testing.assert_frame_equal(chunked, expected)
+
+def test_cached_load_matches_parse(data_paths, tmp_path):
+    # a copy, so that the cache is not shared with other tests
+    incident_path = str(tmp_path / os.path.basename(data_paths[0]))
+    shutil.copy(data_paths[0], incident_path)
+    parsed = load_and_preprocess_incidents(incident_path, use_cache=True)
+    cached = load_and_preprocess_incidents(incident_path, use_cache=True)
+    pd.testing.assert_frame_equal(cached, parsed)
+    # the first load wrote the cache that the second one read (see get_cache_path)
+    assert len(os.listdir(str(tmp_path / "cache"))) == 1
@@ -0,0 +1,85 @@
+from collections import Counter
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+from ihelpers import build_map_levels, convert_polygons_from_xy_to_lonlat
+
+def _wiggle(geometry):
+    """ Replace the horizontal edges of a synthetic (square) vak by a
+        zigzag, which is the same for the vakken on either side of it. """
+    coords = shapely.get_coordinates(shapely.segmentize(geometry, 10))
+    # zero at the corners, which lie on multiples of the cell size
+    amplitude = 10 + 60 * (np.sin(coords[:, 0] / 700.0) ** 2)
+    coords[:, 1] += np.where(coords[:, 1] % 500 == 0,
+                             amplitude * np.sin(np.pi * coords[:, 0] / 50.0), 0)
+    return shapely.MultiPolygon([shapely.Polygon(coords)])
+
+def _segments(xs, ys):
+    """ Get the (undirected) segments of the rings of a polygon. """
+    segments = []
+    for part_x, part_y in zip(xs, ys):
+        for ring_x, ring_y in zip(part_x, part_y):
+            points = list(zip(ring_x, ring_y))
+            segments += [tuple(sorted(pair)) for pair in zip(points[:-1], points[1:])]
+    return segments
+
+def _polygon(xs, ys):
+    return shapely.MultiPolygon([shapely.Polygon(np.column_stack([part_x[0], part_y[0]]),
+                                                 [np.column_stack(hole) for hole in
+                                                  zip(part_x[1:], part_y[1:])])
+                                 for part_x, part_y in zip(xs, ys)])
+
+@pytest.mark.parametrize("wiggle", [False, True])
+def test_map_levels_share_edges(data_paths, wiggle):
+    geometries = gpd.read_file(data_paths[1])["geometry"].values
+    if wiggle:
+        geometries = [_wiggle(geometry.geoms[0]) for geometry in geometries]
+        assert all(shapely.is_valid(geometries))
+    geometries = convert_polygons_from_xy_to_lonlat(geometries).values
+    neighbours = [(i, j) for i in range(len(geometries)) for j in range(i)
+                  if geometries[i].intersection(geometries[j]).length > 0]
+    assert len(neighbours) > 0
+
+    levels = build_map_levels(geometries)
+    sizes = []
+    for level in levels:
+        polygons = [_polygon(xs, ys) for xs, ys in zip(level["xs"], level["ys"])]
+        assert all(polygon.is_valid for polygon in polygons), level["tolerance"]
+        sizes.append(sum(len(shapely.get_coordinates(p)) for p in polygons))
+
+        # every segment is shared by the neighbour on the other side, or
+        # lies on the outer boundary of all vakken
+        segments = [_segments(xs, ys) for xs, ys in zip(level["xs"], level["ys"])]
+        for i, j in neighbours:
+            assert len(set(segments[i]) & set(segments[j])) > 0
+        counts = Counter(segment for polygon in segments for segment in polygon)
+        assert max(counts.values()) <= 2
+        outer = sum(shapely.LineString(segment).length
+                    for segment, count in counts.items() if count == 1)
+        union = shapely.union_all(polygons)
+        assert union.geom_type == "Polygon"
+        assert np.isclose(outer, union.exterior.length)
+
+    if wiggle:
+        # the zigzags are simplified away at coarser levels
+        assert sizes == sorted(sizes, reverse=True)
+        assert sizes[-1] < sizes[0]
+
+def test_map_levels_revert_collapsed_polygons():
+    # a low polygon on top of a high one, which simplifying collapses to
+    # the edge that they share (in meters around lon/lat 0)
+    top = np.array([[0, 0], [100, 0], [100, 10], [50, 12], [0, 10], [0, 0]])
+    bottom = np.array([[0, 0], [0, -50], [100, -50], [100, 0], [0, 0]])
+    geometries = [shapely.MultiPolygon([shapely.Polygon(ring / 111320.0)])
+                  for ring in [top, bottom]]
+    levels = build_map_levels(geometries, tolerances=[0, 32])
+    original, simplified = levels
+    # the collapsed polygon keeps its original (rounded) arcs
+    assert len(simplified["xs"][0][0][0]) == len(original["xs"][0][0][0])
+    for xs, ys in zip(simplified["xs"], simplified["ys"]):
+        assert _polygon(xs, ys).is_valid
+    assert len(set(_segments(simplified["xs"][0], simplified["ys"][0])) &
+               set(_segments(simplified["xs"][1], simplified["ys"][1]))) == 1